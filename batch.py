@@ -0,0 +1,100 @@
+"""
+Generates the reports of several B.S. months at once, e.g. every month of a fiscal year at audit time.
+Each month is fetched, transformed and written by its own worker process into sheets/<FY>/<month>,
+months whose records are unchanged since their reports were written are left as they are.
+
+    python batch.py --fiscal-year 2080/81 --workers 4
+    python batch.py --from 2080-04 --to 2080-09
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bs_ad_date_helpers import get_end_date_of_month, get_months_between_np, get_months_of_fiscal_year_np
+
+from my_logging import log_setup, show_full_frames
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+
+def generate_month(year: int, month: int, batch_size=None, annex_only=False, force=False, exports=None,
+                   use_cache=None, refresh=False) -> dict:
+    """Worker entry point, generates the reports of one B.S. month"""
+    from main import generate_report
+    return generate_report(get_end_date_of_month(year, month), batch_size, use_cache, refresh, annex_only=annex_only,
+                           force=force, exports=exports)
+
+
+def generate_months(months: list, workers=None, batch_size=None, annex_only=False, force=False, exports=None,
+                    use_cache=None, refresh=False) -> dict:
+    """
+    Generates the reports of every (year, month) on a pool of worker processes.
+    Returns {(year, month): files} of the months that succeeded, failures are logged.
+    """
+    if exports is not None:
+        from reportwriters import check_exports
+        exports = check_exports(exports)  # once here instead of failing on every worker
+    workers = workers or min(len(months), os.cpu_count() or 1)
+    results = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(generate_month, year, month, batch_size, annex_only, force, exports,
+                                   use_cache, refresh): (year, month) for year, month in months}
+        for future in as_completed(futures):
+            year, month = futures[future]
+            try:
+                results[(year, month)] = future.result()
+                logger.info(f'---- Generated reports for {year}-{month:02} ----')
+            except BaseException as e:  # SystemExit from DBConnection included
+                logger.error(f'---- Failed to generate reports for {year}-{month:02} ----')
+                logger.exception(e)
+    logger.info(f'Generated {len(results)}/{len(months)} months in {time.perf_counter() - start:.1f}s with {workers} workers')
+    return results
+
+
+def parse_month(value: str) -> tuple:
+    """Parses a B.S. month given as 2080-04 or 2080/04"""
+    year, month = value.replace('/', '-').split('-')
+    return int(year), int(month)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate VAT reports for several B.S. months in parallel')
+    period = parser.add_mutually_exclusive_group(required=True)
+    period.add_argument('--fiscal-year', help='fiscal year formatted as 2080/81')
+    period.add_argument('--from', dest='start', type=parse_month, help='first B.S. month, e.g. 2080-04')
+    parser.add_argument('--to', dest='end', type=parse_month, help='last B.S. month, e.g. 2081-03 (defaults to --from)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (defaults to cpu count)')
+    parser.add_argument('--batch-size', type=int, default=None, help='rows fetched per round trip')
+    parser.add_argument('--annex-only', action='store_true', help='only build transactions_above_1L.xls of each month')
+    parser.add_argument('--force', action='store_true', help='rewrite the reports of unchanged months too')
+    parser.add_argument('--refresh', action='store_true', help='fetch the whole months into the local cache again')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=None,
+                        help='query the database directly, bypassing the local cache')
+    parser.add_argument('--export', nargs='+', choices=['csv', 'parquet'], metavar='FORMAT',
+                        help='also export the books and the annex as csv and/or parquet')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log whole frames instead of their head and tail')
+    args = parser.parse_args()
+    if args.export:
+        from reportwriters import check_exports
+        try:
+            check_exports(args.export)
+        except ImportError as e:  # before any month is fetched
+            parser.error(str(e))
+
+    if args.verbose:
+        show_full_frames()
+
+    if args.fiscal_year:
+        months = get_months_of_fiscal_year_np(args.fiscal_year)
+    else:
+        months = get_months_between_np(args.start, args.end or args.start)
+
+    results = generate_months(months, args.workers, args.batch_size, args.annex_only, args.force, args.export,
+                              args.use_cache, args.refresh)
+    if len(results) < len(months):
+        raise SystemExit(1)
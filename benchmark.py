@@ -0,0 +1,228 @@
+"""
+End to end benchmark of the report pipeline on the synthetic stand-in database (synthetic_db.py).
+Times each stage (query, DataFrame build, PAN aggregation, workbook write, csv and Parquet exports)
+at several bill counts and prints throughput and peak traced memory, so regressions can be tracked
+without SQL Server.
+
+    python benchmark.py --bills 1000 10000 100000 1000000 --json bench.json
+    python benchmark.py --bills 100000 --query-strategy grouped two-phase
+    python benchmark.py --import-time main batch
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from bs_ad_date_helpers import get_calendar_index, get_end_date_of_month, get_start_to_end_date_object_in_ad
+from masterquery import DEFAULT_QUERY_STRATEGY, QUERY_STRATEGIES, master_query_batches
+from synthetic_db import SQLiteDBConnection, generate
+
+BENCHMARK_DIR = Path('.cache') / 'benchmark'
+FORMAT_DIR = Path('sheets') / 'format'
+
+
+@contextmanager
+def stage(results: list, name: str, bills: int):
+    """Records wall time and peak traced memory of the block, the block sets result['rows']"""
+    result = {'bills': bills, 'stage': name, 'rows': 0}
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result['seconds'] = time.perf_counter() - start
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        result['rows_per_sec'] = result['rows'] / result['seconds'] if result['seconds'] else 0
+        results.append(result)
+
+
+def synthetic_database(bills: int, start_date, end_date, seed: int) -> Path:
+    """Returns the database of `bills` bills, generated once and reused by later runs"""
+    db_path = BENCHMARK_DIR / f'bills-{bills}-seed{seed}.sqlite'
+    if not db_path.exists():
+        generate(db_path, bills, start_date, end_date, seed)
+    return db_path
+
+
+def check_same_rows(expected_batches: list, batches: list, name: str, expected_name: str):
+    """
+    Raises AssertionError unless the batches hold the rows of expected_batches in the same order,
+    telling rows missing or added apart from rows in another order
+    """
+    expected = [tuple(row) for rows in expected_batches for row in rows]
+    rows = [tuple(row) for rows in batches for row in rows]
+    if Counter(rows) != Counter(expected):
+        raise AssertionError(f'{name} fetched other rows than {expected_name}')
+    position = next((index for index, (row, expected_row) in enumerate(zip(rows, expected)) if row != expected_row), None)
+    if position is not None:
+        raise AssertionError(f'{name} fetched the rows of {expected_name} in another order from row {position}, '
+                             f'both order by Transaction Date and Transaction ID')
+
+
+def run(bills: int, batch_size: int, seed: int = 0, strategies=(DEFAULT_QUERY_STRATEGY,)) -> list:
+    """
+    Times the stages on a database of `bills` bills. The master query is run with every query strategy given,
+    they have to fetch the same rows, the first one feeds the later stages
+    """
+    import pandas as pd
+    from main import aggregate_PAN_customers, build_report_frame, default_transactions, split_batches
+    from reconciliation import Reconciler, from_report_rows
+    from reportrows import rows_to_frame
+    from reportwriters import EXPORT_WRITERS, XlsxRowWriter, check_exports, export_writers
+
+    end_date_np = get_end_date_of_month(2080, 4)
+    start_date, end_date = get_start_to_end_date_object_in_ad(end_date_np)
+    db_path = synthetic_database(bills, start_date, end_date, seed)
+    transactions = list(default_transactions())
+    transaction_types = [transaction.transaction_type for transaction in transactions]
+    results = []
+
+    row_batches = None
+    for strategy in strategies:
+        name = 'query' if strategy == DEFAULT_QUERY_STRATEGY else f'query {strategy}'
+        with SQLiteDBConnection(db_path, batch_size) as db:
+            with stage(results, name, bills) as result:
+                batches = list(master_query_batches(db, transaction_types, [*transaction_types, start_date, end_date], strategy))
+                result['rows'] = sum(map(len, batches))
+        if row_batches is None:
+            row_batches = batches
+        else:
+            check_same_rows(row_batches, batches, f'The {strategy} query', f'the {strategies[0]} one')
+        del batches
+
+    typed = []
+    with stage(results, 'dataframe build', bills) as result:
+        frames = {transaction.transaction_type: [] for transaction in transactions}
+        for batch in split_batches(row_batches, transaction_types):
+            typed.append(batch)
+            for transaction in transactions:
+                records = batch[transaction.transaction_type]
+                if len(records):
+                    frames[transaction.transaction_type].append(build_report_frame(transaction, records))
+        frames = {transaction_type: pd.concat(dfs) if dfs else build_report_frame(transaction, rows_to_frame([]))
+                  for transaction, (transaction_type, dfs) in zip(transactions, frames.items())}
+        result['rows'] = sum(map(len, frames.values()))
+    del row_batches
+
+    with stage(results, 'reconciliation', bills) as result:
+        reconcilers = {transaction_type: Reconciler() for transaction_type in transaction_types}
+        for batch in typed:
+            for transaction_type, records in batch.items():
+                if len(records):
+                    reconcilers[transaction_type].add_batch(from_report_rows(records))
+        for reconciler in reconcilers.values():
+            reconciler.finish()
+            result['rows'] += reconciler.bills
+
+    with stage(results, 'PAN aggregation', bills) as result:
+        for transaction_type in transaction_types:
+            records = pd.concat([batch[transaction_type] for batch in typed], ignore_index=True)
+            aggregate_PAN_customers(records[records['PAN No'].notna()])
+            result['rows'] += len(records)
+    del typed
+
+    with tempfile.TemporaryDirectory() as tmp, stage(results, 'workbook write', bills) as result:
+        for transaction in transactions:
+            book = Path(tmp) / f'{transaction.transaction_name}.xlsx'
+            shutil.copyfile(FORMAT_DIR / f'{transaction.transaction_name}-format.xlsx', book)
+            df = frames[transaction.transaction_type]
+            with XlsxRowWriter(book, transaction.sheet_name) as writer:
+                writer.append_frame(df)
+            result['rows'] += len(df)
+
+    for export in EXPORT_WRITERS:
+        try:
+            check_exports([export])
+        except ImportError:
+            continue  # pyarrow not installed
+        with tempfile.TemporaryDirectory() as tmp, stage(results, f'{export} write', bills) as result:
+            for transaction in transactions:
+                df = frames[transaction.transaction_type]
+                for writer in export_writers(Path(tmp) / f'{transaction.transaction_name}.xlsx', [export]):
+                    with writer:
+                        writer.append_frame(df)
+                result['rows'] += len(df)
+    return results
+
+
+def print_results(results: list):
+    print(f"{'bills':>9} {'stage':<16} {'rows':>9} {'seconds':>9} {'rows/sec':>11} {'peak MB':>9}")
+    for result in results:
+        print(f"{result['bills']:>9} {result['stage']:<16} {result['rows']:>9} {result['seconds']:>9.3f} "
+              f"{result['rows_per_sec']:>11.0f} {result['peak_mb']:>9.1f}")
+
+
+def import_time(module: str, repeat: int = 5) -> dict:
+    """
+    Cold start of `module`: `python -X importtime -c "import module"` in fresh interpreters,
+    the fastest of repeat runs with the heaviest packages it pulled in
+    """
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                   capture_output=True, text=True)
+        if completed.returncode:
+            errors = [line for line in completed.stderr.splitlines() if not line.startswith('import time:')]
+            raise RuntimeError(f'import {module} failed: {" ".join(errors[-1:])}')
+        # import time: self [us] | cumulative | imported package, nested imports are indented
+        # below and printed before the package importing them
+        children, ms, imported = [], None, []
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or line.endswith('imported package'):
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            if depth == 1:
+                children.append((name.strip(), int(cumulative) / 1000))
+            elif depth == 0:
+                if name.strip() == module:
+                    ms, imported = int(cumulative) / 1000, children
+                children = []
+        if best is None or ms < best['ms']:
+            heaviest = sorted(imported, key=lambda item: item[1], reverse=True)[:5]
+            best = {'module': module, 'ms': ms, 'heaviest': heaviest}
+    return best
+
+
+def print_import_times(results: list):
+    print(f"{'module':<16} {'import ms':>10}  heaviest imports")
+    for result in results:
+        heaviest = ', '.join(f'{name} {ms:.0f}' for name, ms in result['heaviest'])
+        print(f"{result['module']:<16} {result['ms']:>10.1f}  {heaviest}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline on a synthetic database')
+    parser.add_argument('--bills', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--query-strategy', nargs='+', choices=QUERY_STRATEGIES, default=[DEFAULT_QUERY_STRATEGY],
+                        help='time the master query with each strategy and check they fetch the same rows')
+    parser.add_argument('--json', type=Path, help='also write the results to this file')
+    parser.add_argument('--import-time', nargs='+', metavar='MODULE',
+                        help='only measure the cold import time of these modules, e.g. main batch')
+    args = parser.parse_args()
+
+    if args.import_time:
+        results = [import_time(module) for module in args.import_time]
+        print_import_times(results)
+        if args.json:
+            args.json.write_text(json.dumps(results, indent=2))
+        sys.exit()
+
+    get_calendar_index().to_bs_strings([], zero_pad=False)  # built once per process, kept out of the first timings
+    results = []
+    for bills in args.bills:
+        results.extend(run(bills, args.batch_size, args.seed, args.query_strategy))
+    print_results(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
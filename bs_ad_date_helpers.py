@@ -1,22 +1,36 @@
 import datetime
+from dataclasses import dataclass
+from functools import lru_cache
+from importlib import metadata
+from pathlib import Path
+import numpy as np
 from pyBSDate import bsdate, addate
 import nepali_datetime
 
+CALENDAR_CACHE_FILE = Path(__file__).parent / '.cache' / 'bs_calendar.npz'
+CALENDAR_LAYOUT = 2  # of the cached table, 2: days of the gaps between pyBSDate years
+MAX_MONTH_DAYS = 32  # longest B.S. month, a gap is only filled up to it
 
-def get_end_date_of_previous_month(year: int = nepali_datetime.date.today().year, month: int = nepali_datetime.date.today().month):
+
+def get_end_date_of_previous_month(year: int = None, month: int = None):
     """ 
     Retruns the previous month's last date in B.S. in the format of 2079-12-30 
-    Day is hardcoded to first day of passed current month.
+    Day is hardcoded to first day of passed current month (today's month by default).
     """
+    if year is None or month is None:
+        today = nepali_datetime.date.today()
+        year = today.year if year is None else year
+        month = today.month if month is None else month
     previous_month_date = nepali_datetime.date(
         year, month, 1) - datetime.timedelta(days=1)
     return previous_month_date
 
 
-def get_start_to_end_date_object_in_ad(end_date_of_a_month_np=get_end_date_of_previous_month()):
+def get_start_to_end_date_object_in_ad(end_date_of_a_month_np=None):
     """
     Returns tuple of (start_date: datetime.date, end_date: datetime.date) in AD format (conversion)
     """
+    end_date_of_a_month_np = end_date_of_a_month_np or get_end_date_of_previous_month()
     ne_date_start = bsdate(year=end_date_of_a_month_np.year, month=end_date_of_a_month_np.month, day=1)
     ne_date_end = bsdate(year=end_date_of_a_month_np.year,
                          month=end_date_of_a_month_np.month, day=end_date_of_a_month_np.day)
@@ -25,27 +39,276 @@ def get_start_to_end_date_object_in_ad(end_date_of_a_month_np=get_end_date_of_pr
     return datetime.date(en_date_start.year, en_date_start.month, en_date_start.day), datetime.date(en_date_end.year, en_date_end.month, en_date_end.day)
 
 
-def get_start_to_end_date_object_in_bs(end_date_of_a_month_np=get_end_date_of_previous_month()):
+def get_start_to_end_date_object_in_bs(end_date_of_a_month_np=None):
     """
     Returns tuple of (start_date: datetime.date, end_date: datetime.date) in BS format
     """
+    end_date_of_a_month_np = end_date_of_a_month_np or get_end_date_of_previous_month()
     ne_date_start = bsdate(year=end_date_of_a_month_np.year, month=end_date_of_a_month_np.month, day=1)
     ne_date_end = bsdate(year=end_date_of_a_month_np.year,
                          month=end_date_of_a_month_np.month, day=end_date_of_a_month_np.day)
     return ne_date_start, ne_date_end
 
 
-def get_previous_month_name_np() -> str:
-    """Returns the previous month name as per nepali calander"""
-    return nepali_datetime._FULLMONTHNAMES[get_end_date_of_previous_month().month]
+def get_end_date_of_month(year: int, month: int):
+    """Returns the last date of the given B.S. month"""
+    if month == 12:
+        return get_end_date_of_previous_month(year + 1, 1)
+    return get_end_date_of_previous_month(year, month + 1)
+
+
+def get_end_date_of_current_month():
+    """Returns the last date of the current B.S. month"""
+    today = nepali_datetime.date.today()
+    return get_end_date_of_month(today.year, today.month)
 
-def get_fiscal_year_acc_prev_month_np() -> str:
-    """Returns the fiscal year value as per previous month"""
-    year = get_end_date_of_previous_month().year
-    month = get_end_date_of_previous_month().month
+
+def get_previous_month_name_np(end_date_of_a_month_np=None) -> str:
+    """Returns the previous month name (or the month name of the passed date) as per nepali calander"""
+    end_date_of_a_month_np = end_date_of_a_month_np or get_end_date_of_previous_month()
+    return nepali_datetime._FULLMONTHNAMES[end_date_of_a_month_np.month]
+
+def get_fiscal_year_acc_prev_month_np(end_date_of_a_month_np=None) -> str:
+    """Returns the fiscal year value as per previous month (or as per the month of the passed date)"""
+    end_date_of_a_month_np = end_date_of_a_month_np or get_end_date_of_previous_month()
+    year = end_date_of_a_month_np.year
+    month = end_date_of_a_month_np.month
     year_int = int(year)
     if int(month) > 3:
         fiscal_year = f'{year_int}/{str(year_int+1)[2:]}'
     else:
         fiscal_year = f'{year_int-1}/{str(year_int)[2:]}'
-    return fiscal_year
\ No newline at end of file
+    return fiscal_year
+
+
+@dataclass(frozen=True)
+class ReportingPeriod:
+    """Dates and names of the B.S. month a report is generated for"""
+    end_date_np: nepali_datetime.date
+    month_name: str
+    fiscal_year: str  # 2080/81
+    start_date_ad: datetime.date
+    end_date_ad: datetime.date
+    start_date_bs: bsdate
+    end_date_bs: bsdate
+
+    @property
+    def key(self) -> str:
+        """B.S. 'YYYY-MM' of the month"""
+        return self.end_date_np.strftime('%Y-%m')
+
+    @property
+    def fiscal_year_folder(self) -> str:
+        """Fiscal year as in the sheets folders, 2080-81"""
+        return self.fiscal_year.replace('/', '-')
+
+    def __reduce__(self):
+        # pyBSDate's dates can't be pickled, worker processes compute the period again
+        return _reporting_period, (self.end_date_np.year, self.end_date_np.month, self.end_date_np.day)
+
+
+def reporting_period(end_date_of_a_month_np=None) -> ReportingPeriod:
+    """
+    Returns the period of the month ending at end_date_of_a_month_np (previous month by default).
+    Today is looked up on every call so long running processes move on to the next month,
+    the period itself is computed once per date.
+    """
+    end_date_of_a_month_np = end_date_of_a_month_np or get_end_date_of_previous_month()
+    return _reporting_period(end_date_of_a_month_np.year, end_date_of_a_month_np.month, end_date_of_a_month_np.day)
+
+
+@lru_cache(maxsize=64)
+def _reporting_period(year: int, month: int, day: int) -> ReportingPeriod:
+    end_date_np = nepali_datetime.date(year, month, day)
+    start_date_ad, end_date_ad = get_start_to_end_date_object_in_ad(end_date_np)
+    start_date_bs, end_date_bs = get_start_to_end_date_object_in_bs(end_date_np)
+    return ReportingPeriod(end_date_np, get_previous_month_name_np(end_date_np),
+                           get_fiscal_year_acc_prev_month_np(end_date_np),
+                           start_date_ad, end_date_ad, start_date_bs, end_date_bs)
+
+
+def get_months_of_fiscal_year_np(fiscal_year: str) -> list:
+    """
+    Returns [(year, month), ...] B.S. months of a fiscal year formatted as 2080/81,
+    from Shrawan of the first year to Asar of the next
+    """
+    start_year = int(fiscal_year.replace('-', '/').split('/')[0])
+    return [(start_year, month) for month in range(4, 13)] + [(start_year + 1, month) for month in range(1, 4)]
+
+
+def get_months_between_np(start: tuple, end: tuple) -> list:
+    """Returns [(year, month), ...] B.S. months from start to end (both (year, month)) inclusive"""
+    (year, month), months = start, []
+    while (year, month) <= tuple(end):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+class BSCalendarIndex:
+    """
+    Day by day B.S. calendar over the whole range supported by pyBSDate, the converter the
+    reporting periods come from (get_start_to_end_date_object_in_ad).
+    Every B.S. day has a position in the year, month, day and AD date arrays and every AD day from
+    `ad_start` onwards the position of its B.S. day, so converting an array of dates is a subtraction
+    and a take instead of a python call per date.
+    Given a ReportingPeriod, the AD days of its range are labelled as days of its month, counted from its
+    start as get_start_to_end_date_object_in_ad selects its bills: pyBSDate's years overlap or leave gaps
+    at some year ends, and the range of a period runs to the month end of nepali_datetime.
+    """
+
+    def __init__(self, years: np.ndarray, months: np.ndarray, days: np.ndarray, ad_dates: np.ndarray) -> None:
+        self.years = years
+        self.months = months
+        self.days = days
+        self.ad_dates = np.asarray(ad_dates, dtype='datetime64[D]')
+        # yyyymmdd keys increase with the days, hence are sorted for BS -> AD lookups
+        self.bs_keys = years.astype(np.int32) * 10000 + months.astype(np.int32) * 100 + days
+        self.ad_start = self.ad_dates.min()
+        # AD day -> position of its B.S. day, -1 where no B.S. day converts to it.
+        # Some years of pyBSDate overlap the next one by a day or two, the later B.S. day is kept there
+        # as pyBSDate and nepali_datetime convert it
+        offsets = (self.ad_dates - self.ad_start).astype(np.int64)
+        self.ad_positions = np.full(offsets.max() + 1, -1, dtype=np.int32)
+        np.maximum.at(self.ad_positions, offsets, np.arange(len(offsets), dtype=np.int32))
+        self._strings = {}
+
+    @classmethod
+    def build(cls) -> 'BSCalendarIndex':
+        """Builds the table from the first of Baisakh and the month lengths pyBSDate converts with"""
+        from pyBSDate.DateMap import DATE_MAP
+        bs_years = sorted(DATE_MAP, key=int)
+        lengths = np.array([DATE_MAP[year]['daysonmonth'] for year in bs_years])
+        year_lengths = lengths.sum(axis=1)
+        lengths = lengths.ravel()
+
+        years = np.repeat([int(year) for year in bs_years], year_lengths).astype(np.int16)
+        months = np.repeat(np.tile(np.arange(1, 13), len(bs_years)), lengths).astype(np.int8)
+        # day of month is the position within the run of each month
+        days = (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1).astype(np.int8)
+        # every year counts its days from its own first of Baisakh, as pyBSDate does
+        first_days = np.array([DATE_MAP[year]['1stbaisakh'] for year in bs_years], dtype='datetime64[D]')
+        day_of_year = np.arange(lengths.sum()) - np.repeat(np.cumsum(year_lengths) - year_lengths, year_lengths)
+        ad_dates = np.repeat(first_days, year_lengths) + day_of_year
+
+        # AD days between a year and the first of Baisakh of the next are further days of the last month
+        # before them, as pyBSDate converts a day past a month end (bsdate(...).addate)
+        offsets = (ad_dates - ad_dates.min()).astype(np.int64)
+        covered = np.zeros(offsets.max() + 1, dtype=bool)
+        covered[offsets] = True
+        uncovered = np.flatnonzero(~covered)
+        positions, continued = [], []
+        for gap in np.split(uncovered, np.flatnonzero(np.diff(uncovered) > 1) + 1) if uncovered.size else []:
+            # the latest B.S. day of the day before, the last day of a year
+            position = int(np.flatnonzero(offsets == gap[0] - 1).max())
+            length = min(len(gap), MAX_MONTH_DAYS - int(days[position]))
+            positions += [position] * length
+            continued += range(1, length + 1)
+        if positions:
+            at = np.array(positions) + 1  # keys (year, month, day past the end) sort right after the day
+            years = np.insert(years, at, years[positions])
+            months = np.insert(months, at, months[positions])
+            days = np.insert(days, at, days[positions] + np.array(continued, dtype=np.int8))
+            ad_dates = np.insert(ad_dates, at, ad_dates[positions] + np.array(continued))
+        return cls(years, months, days, ad_dates)
+
+    @classmethod
+    def load(cls, cache_file: Path = CALENDAR_CACHE_FILE) -> 'BSCalendarIndex':
+        """Loads the table from the disk cache, building and saving it on the first use"""
+        source = f'pyBSDate {metadata.version("pyBSDate")}, layout {CALENDAR_LAYOUT}'
+        if cache_file.exists():
+            with np.load(cache_file) as cached:
+                if str(cached['source']) == source:
+                    return cls(cached['years'], cached['months'], cached['days'], cached['ad_dates'])
+        index = cls.build()
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(cache_file, source=source, years=index.years, months=index.months,
+                            days=index.days, ad_dates=index.ad_dates)
+        return index
+
+    @property
+    def ad_end(self) -> np.datetime64:
+        return self.ad_start + len(self.ad_positions) - 1
+
+    def positions(self, ad_dates, strict: bool = True) -> np.ndarray:
+        """
+        Returns the table positions of the B.S. days of an array like of AD dates.
+        Raises ValueError on NaT and dates without a B.S. day, unless not strict, their positions are -1 then
+        """
+        ad_dates = np.asarray(ad_dates, dtype='datetime64[D]')
+        offsets = (ad_dates - self.ad_start).astype(np.int64)  # NaT is the lowest int64
+        in_range = (offsets >= 0) & (offsets < len(self.ad_positions))
+        positions = np.where(in_range, self.ad_positions[np.where(in_range, offsets, 0)], -1)
+        if strict and positions.size and positions.min() < 0:
+            if not in_range.all():
+                raise ValueError(f'AD dates must be between {self.ad_start} and {self.ad_end}')
+            raise ValueError(f'No B.S. date converts to {ad_dates.ravel()[positions.ravel() < 0][:5].tolist()}')
+        return positions
+
+    def to_bs(self, ad_dates):
+        """Returns (years, months, days) arrays in B.S. for an array like of AD dates"""
+        positions = self.positions(ad_dates)
+        return self.years[positions], self.months[positions], self.days[positions]
+
+    def to_bs_strings(self, ad_dates, zero_pad: bool = True, sep: str = '.', period: 'ReportingPeriod' = None) -> np.ndarray:
+        """
+        Returns B.S. dates formatted as 2080.04.01 (or 2080.4.1 without zero_pad)
+        for an array like of AD dates, None for NaT and dates outside the calendar.
+        The dates in the AD range of period are days of its month.
+        """
+        ad_dates = np.asarray(ad_dates, dtype='datetime64[D]')
+        strings = self.strings(zero_pad, sep)[self.positions(ad_dates, strict=False)]  # -1 is the trailing None
+        if period is not None:
+            offsets = (ad_dates - np.datetime64(period.start_date_ad, 'D')).astype(np.int64)
+            length = (period.end_date_ad - period.start_date_ad).days + 1
+            within = (offsets >= 0) & (offsets < length)
+            if within.any():
+                width = 2 if zero_pad else 0
+                year, month = period.end_date_np.year, period.end_date_np.month
+                days = np.array([f'{year}{sep}{month:0{width}}{sep}{day:0{width}}' for day in range(1, length + 1)],
+                                dtype=object)
+                strings[within] = days[offsets[within]]
+        return strings
+
+    def strings(self, zero_pad: bool = True, sep: str = '.') -> np.ndarray:
+        """Every day of the table formatted once and reused for all lookups, followed by None"""
+        key = (zero_pad, sep)
+        if key not in self._strings:
+            width = 2 if zero_pad else 0
+            self._strings[key] = np.array([f'{y}{sep}{m:0{width}}{sep}{d:0{width}}'
+                                           for y, m, d in zip(self.years.tolist(), self.months.tolist(), self.days.tolist())]
+                                          + [None], dtype=object)
+        return self._strings[key]
+
+    def key_positions(self, bs_keys) -> np.ndarray:
+        """Returns the table positions of an array like of B.S. yyyymmdd integers"""
+        bs_keys = np.asarray(bs_keys, dtype=np.int32)
+        positions = np.searchsorted(self.bs_keys, bs_keys)
+        found = positions < len(self.bs_keys)
+        found[found] = self.bs_keys[positions[found]] == bs_keys[found]
+        if not found.all():
+            raise ValueError(f'Invalid B.S. dates: {bs_keys[~found][:5].tolist()}')
+        return positions
+
+    def to_ad(self, bs_keys) -> np.ndarray:
+        """Returns datetime64[D] AD dates for an array like of B.S. yyyymmdd integers"""
+        return self.ad_dates[self.key_positions(bs_keys)]
+
+
+@lru_cache(maxsize=None)
+def get_calendar_index() -> BSCalendarIndex:
+    """Returns the process wide BS/AD calendar table"""
+    return BSCalendarIndex.load()
+
+
+def ad_to_bs_strings(ad_dates, zero_pad: bool = True, period: ReportingPeriod = None) -> np.ndarray:
+    """
+    Vectorized conversion of AD dates to B.S. strings in the format of 2080.04.01, None where there is no B.S. date.
+    The dates in the AD range of period are days of its month (see BSCalendarIndex)
+    """
+    return get_calendar_index().to_bs_strings(ad_dates, zero_pad, period=period)
+
+
+def bs_to_ad(bs_keys) -> np.ndarray:
+    """Vectorized conversion of B.S. yyyymmdd integers (20800401) to AD datetime64 dates"""
+    return get_calendar_index().to_ad(bs_keys)
@@ -3,76 +3,233 @@ from dotenv import load_dotenv
 from pathlib import Path
 import tomli
 import os
+import atexit
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from instrumentation import instrumentation, parse_server_statistics
 from my_logging import log_setup
 import logging
 
 log_setup()  # Initializing logging configurations
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 300  # seconds an idle connection is kept open
+HEALTH_CHECK_AFTER = 30  # seconds idle after which a connection is pinged before reuse
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of reusable ODBC connections.
+    At most max_size connections are open at once, connections idle for longer than
+    idle_timeout are closed and connections idle for a while are health checked before reuse.
+    """
+
+    def __init__(self, connect, max_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT) -> None:
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # (connection, last used) with the most recently used on the right
+        self._size = 0  # idle and leased connections
+        self._lock = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Returns a healthy connection, waiting for one to be released when the pool is exhausted"""
+        while True:
+            with self._lock:
+                self._evict_idle()
+                while not self._idle and self._size >= self.max_size:
+                    if not self._lock.wait(timeout):
+                        raise TimeoutError(f'No database connection released within {timeout}s')
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1  # reserve the slot before connecting outside the lock
+                    conn = None
+            if conn is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    self._discard(None)
+                    raise
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, broken=False):
+        """Returns a connection to the pool, broken connections are closed instead"""
+        if broken:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def close_all(self):
+        """Closes the idle connections, leased ones are closed when released broken"""
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._close(conn)
+                self._size -= 1
+
+    def _is_healthy(self, conn, last_used) -> bool:
+        if time.monotonic() - last_used < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            conn.cursor().execute('SELECT 1').fetchone()
+            return True
+        except odbc.Error:
+            logger.warning('Discarding a broken database connection')
+            return False
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._close(conn)
+            self._size -= 1
+            logger.debug('Closed an idle database connection')
+
+    def _discard(self, conn):
+        if conn is not None:
+            self._close(conn)
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except odbc.Error:
+            pass
+
+
+def cursor_messages(cursor) -> list:
+    """Informational messages of the last call on a cursor (pyodbc 4.0.31+)"""
+    return [message for _, message in getattr(cursor, 'messages', None) or []]
+
+
+def load_db_config(db_config_filename) -> dict:
+    db_config_file = Path().cwd().joinpath(db_config_filename)
+    if not db_config_file.exists():
+        logger.error(f'Config file {db_config_file} does not exist')
+        exit(1)
+
+    with open(db_config_file, 'rb') as config_file:
+        config_data: dict = tomli.load(config_file)
+    load_dotenv()  # Load the environment containing db password
+    config_data['password'] = os.getenv('DBpassword')
+    logger.debug('DB configurations loaded successfully')
+    return config_data
+
+
+def connect(config_data: dict):
+    """Opens a new connection to the database described by config_data"""
+    try:
+        logger.debug('Connecting to database...')
+        conn = odbc.connect(
+            f"driver={config_data['driver']['name']}",
+            host=config_data['server']['name'],
+            database=config_data['database']['name'],
+            user=config_data['user']['name'],
+            password=config_data['password']
+        )
+        logger.info('---- Database connected ! ----')
+        if config_data.get('instrumentation', {}).get('server_statistics', False):
+            # session wide, the output is read back from the cursor messages of every query
+            conn.cursor().execute('SET STATISTICS IO ON; SET STATISTICS TIME ON').close()
+        return conn
+
+    except Exception as e:
+        logger.error('---- Error connecting to database ----')
+        logger.exception(e)
+        raise SystemExit(1)
+
+
 class DBConnection:
-    _instance = None
-    
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(DBConnection)
-        return cls._instance
-    
+    """
+    Lease of a pooled connection, `with DBConnection('db_config.toml') as db:` checks a connection
+    out of the process wide pool of that config and returns it on exit.
+    """
+    _pools = {}
+    _configs = {}
+    _pools_lock = threading.Lock()
+
     def __init__(self, db_config_filename):
+        self.db_config_filename = db_config_filename
         self.loadDBConfig(db_config_filename)
-        try:
-            logger.debug('Connecting to database...')
-            self._conn = odbc.connect(
-                f'driver={self.DRIVER_NAME}',
-                host=self.SERVER_NAME,
-                database=self.DATABASE_NAME,
-                user=self.USERNAME,
-                password=self.password
-            )
-            self._cursor = self._conn.cursor()
-            logger.info('---- Database connected ! ----')
-
-        except Exception as e:
-            logger.error('---- Error connecting to database ----')
-            logger.exception(e)
-            raise SystemExit(1)
-    
+        self.pool = self.get_pool(db_config_filename)
+        self._conn = self.pool.acquire()
+        self._cursor = self._conn.cursor()
 
-    def loadDBConfig(self, db_config_filename):
-        db_config_file = Path().cwd().joinpath(db_config_filename)
-        if not db_config_file.exists():
-            logger.error(f'Config file {db_config_file} does not exist')
-            exit(1)
+    @classmethod
+    def get_pool(cls, db_config_filename) -> ConnectionPool:
+        """Returns the pool of a config file, creating it on the first use"""
+        with cls._pools_lock:
+            if db_config_filename not in cls._pools:
+                config_data = cls.get_config(db_config_filename)
+                pool_config = config_data.get('pool', {})
+                cls._pools[db_config_filename] = ConnectionPool(
+                    lambda: connect(config_data),
+                    max_size=pool_config.get('max_size', DEFAULT_POOL_SIZE),
+                    idle_timeout=pool_config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT),
+                )
+            return cls._pools[db_config_filename]
 
-        with open(db_config_file, 'rb') as config_file:
-            config_data: dict = tomli.load(config_file)
+    @classmethod
+    def get_config(cls, db_config_filename) -> dict:
+        """The TOML and .env are only read on the first use of a config file"""
+        if db_config_filename not in cls._configs:
+            cls._configs[db_config_filename] = load_db_config(db_config_filename)
+        return cls._configs[db_config_filename]
 
+    @classmethod
+    def close_pools(cls):
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.close_all()
+
+    def loadDBConfig(self, db_config_filename):
+        config_data = self.get_config(db_config_filename)
         self.DRIVER_NAME = config_data['driver']['name']
         self.SERVER_NAME = config_data['server']['name']
         self.DATABASE_NAME = config_data['database']['name']
         self.USERNAME = config_data['user']['name']
-        load_dotenv()  # Load the environment containing db password
-        self.password = os.getenv('DBpassword')
-        logger.debug('DB configurations loaded successfully')
-    
+        self.BATCH_SIZE = config_data.get('query', {}).get('batch_size', DEFAULT_BATCH_SIZE)
+        self.password = config_data['password']
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        self.close(broken=isinstance(exc_val, odbc.Error))
 
-    def close(self):
-        self.connection.close()
+    def close(self, broken=False):
+        """Returns the connection to the pool"""
+        if self._conn is None:
+            return
+        try:
+            self._cursor.close()
+        except odbc.Error:
+            broken = True
+        self.pool.release(self._conn, broken)
+        self._conn = self._cursor = None
 
     @property
     def connection(self):
         return self._conn
-    
+
     @property
     def cursor(self):
         return self._cursor
-    
+
     def execute(self, sql, params=None):
         self.cursor.execute(sql, params or ())
 
@@ -83,5 +240,67 @@ class DBConnection:
         return self.cursor.fetchone()
 
     def query(self, sql, params=None):
+        start = time.perf_counter()
+        self.cursor.execute(sql, params or ())
+        rows = self.fetchall()
+        seconds = time.perf_counter() - start
+        instrumentation.record('database query', seconds, len(rows), self.query_statistics(sql, len(rows), seconds))
+        return rows
+
+    def query_statistics(self, sql, rows, seconds) -> dict:
+        """
+        Summary of the query just fetched for the run report, with the SET STATISTICS IO/TIME
+        output of the server drained from the cursor messages when it is enabled
+        """
+        messages = cursor_messages(self.cursor)
+        try:
+            # the statistics of the statement follow its result set
+            while self.cursor.nextset():
+                messages.extend(cursor_messages(self.cursor))
+            messages.extend(cursor_messages(self.cursor))
+        except odbc.Error:
+            pass
+        statistics = {'sql': ' '.join(sql.split())[:120], 'rows': rows, 'seconds': seconds}
+        if messages:
+            statistics['server'] = parse_server_statistics(messages)
+        return statistics
+
+    def query_batches(self, sql, params=None, batch_size=None):
+        """
+        Executes the query and yields the result in lists of at most batch_size rows,
+        so only one batch of rows is held in memory at a time.
+        """
+        batch_size = batch_size or self.BATCH_SIZE
+        self.cursor.arraysize = batch_size
+        # only the time spent in the database and driver is recorded, not the time of the consumer
+        start = time.perf_counter()
         self.cursor.execute(sql, params or ())
-        return self.fetchall()
\ No newline at end of file
+        seconds = time.perf_counter() - start
+        fetched = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                rows = self.cursor.fetchmany(batch_size)
+                seconds += time.perf_counter() - start
+                if not rows:
+                    break
+                fetched += len(rows)
+                yield rows
+        finally:
+            instrumentation.record('database query', seconds, fetched, self.query_statistics(sql, fetched, seconds))
+
+    def query_many(self, queries, max_workers=None) -> list:
+        """
+        Runs [(sql, params), ...] at once, each on its own pooled connection.
+        Returns the fetched rows of every query in the same order.
+        """
+        def run(query):
+            sql, params = query
+            with DBConnection(self.db_config_filename) as db:
+                return db.query(sql, params)
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool.max_size) as executor:
+            return list(executor.map(run, queries))
+
+
+atexit.register(DBConnection.close_pools)
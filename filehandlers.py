@@ -1,7 +1,11 @@
+from dataclasses import dataclass
 from pathlib import Path
 from os import scandir
-from openpyxl import load_workbook
-from bs_ad_date_helpers import get_end_date_of_previous_month, get_fiscal_year_acc_prev_month_np
+import hashlib
+import os
+import shutil
+from bs_ad_date_helpers import reporting_period
+from instrumentation import stage
 
 from my_logging import log_setup
 import logging
@@ -10,6 +14,82 @@ log_setup()  # Initializing logging configurations
 logger = logging.getLogger(__name__)
 
 
+MAX_CACHED_TEMPLATES = 100
+
+REPORT_DETAILS = u'करदाता दर्ता नं (PAN) : {PAN}        करदाताको नाम: {name}         साल: {fiscal_year}    कर अवधि: {month}'
+
+
+@dataclass(frozen=True)
+class Taxpayer:
+    """Taxpayer the reports are filed for, printed in the header of every sheet"""
+    PAN: str
+    name: str
+
+
+DEFAULT_TAXPAYER = Taxpayer('301003001', 'SHANKER PARBATI OIL STORES')
+
+
+class TemplateCache:
+    """
+    Rendered copies of the format templates on disk.
+    Entries are keyed by the content hash of the template and the render parameters
+    (fiscal year, month, report details), so a warm run only copies bytes.
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = MAX_CACHED_TEMPLATES) -> None:
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._template_hashes = {}
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def template_hash(self, template: Path) -> str:
+        if template not in self._template_hashes:
+            self._template_hashes[template] = hashlib.sha256(template.read_bytes()).hexdigest()[:16]
+        return self._template_hashes[template]
+
+    def entry(self, template: Path, suffix: str, *params) -> Path:
+        """Returns the cache path of template rendered with params, it may not exist yet"""
+        params_hash = hashlib.sha256('\0'.join(map(str, params)).encode()).hexdigest()[:16]
+        return self.cache_dir / f'{template.stem}.{self.template_hash(template)}.{params_hash}{suffix}'
+
+    def fetch(self, entry: Path, dest: Path) -> bool:
+        """Copies a cached entry to dest, returns False on a cache miss"""
+        try:
+            shutil.copyfile(entry, dest)
+        except FileNotFoundError:
+            return False
+        os.utime(entry)  # recently used entries survive eviction
+        return True
+
+    def store(self, rendered: Path, entry: Path):
+        tmp = entry.with_name(entry.name + f'.{os.getpid()}.tmp')
+        shutil.copyfile(rendered, tmp)
+        os.replace(tmp, entry)
+
+    def evict(self, templates):
+        """Removes entries rendered from older versions of templates and the least recently used ones"""
+        current = {(template.stem, self.template_hash(template)) for template in templates}
+        stems = {stem for stem, _ in current}
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            stem, _, rest = entry.name.partition('.')
+            template_hash = rest.split('.', 1)[0]
+            if stem in stems and (stem, template_hash) not in current:
+                logger.debug(f'Evicting stale template cache entry {entry.name}')
+                entry.unlink(missing_ok=True)
+            else:
+                entries.append(entry)
+        used = []
+        for entry in entries:
+            try:
+                used.append((entry.stat().st_mtime, entry))
+            except FileNotFoundError:
+                pass  # evicted by a concurrent run
+        used.sort(reverse=True)
+        for _, entry in used[self.max_entries:]:
+            entry.unlink(missing_ok=True)
+
+
 class TransactionFileHandler():
     
     _instance = None
@@ -19,24 +99,34 @@ class TransactionFileHandler():
             cls._instance = super().__new__(TransactionFileHandler)
         return cls._instance
 
-    def __init__(self, folder_name) -> None:
+    def __init__(self, folder_name, end_date_of_a_month_np=None, annex_only=False, keep_books=False,
+                 output_root: Path = None, taxpayer: Taxpayer = None, books: list = None) -> None:
         self.cwd = Path.cwd()
+        self.folder_name = folder_name
+        self.taxpayer = taxpayer or DEFAULT_TAXPAYER
+        self.books = books  # names of the books (format templates) to set up, all of them by default
+        # reports are for the previous month unless the last date of another B.S. month is given
+        self.period = reporting_period(end_date_of_a_month_np)
+        self.end_date_np = self.period.end_date_np
         # Different directories
         self.sheetsD = self.cwd / 'sheets'
         self.formatD = self.sheetsD / 'format'
         self.create_dir_if_not_exists(self.formatD)
         self.transactionAbove1LD = self.formatD / 'transactionAbove1L'
 
-        self.saveD = self.sheetsD / get_fiscal_year_acc_prev_month_np().replace('/', '-') /folder_name
+        self.fiscal_year = self.period.fiscal_year
+        # the reports go to output_root/sheets, the format templates are shared
+        outputD = Path(output_root) / 'sheets' if output_root is not None else self.sheetsD
+        self.saveD = outputD / self.period.fiscal_year_folder /folder_name
         self.create_dir_if_not_exists(self.saveD)
 
         # Different files
         self.trans_above_1L_file = self.transactionAbove1LD / 'template.xls'
         self.transaction_above_1L_file_check(self.trans_above_1L_file)
 
-        self.fiscal_year = get_fiscal_year_acc_prev_month_np()
+        self.template_cache = TemplateCache(self.cwd / '.cache' / 'templates')
 
-        self.files = self.initialize_sheets(folder_name)
+        self.files = self.initialize_sheets(folder_name, annex_only, keep_books)
 
     def create_dir_if_not_exists(self, path: Path):
         path.mkdir(parents=True, exist_ok=True)
@@ -44,8 +134,18 @@ class TransactionFileHandler():
     def check_file_exists(self, path: Path):
         return path.exists()
     
+    def report_details(self, fiscal_year, month) -> str:
+        return REPORT_DETAILS.format(PAN=self.taxpayer.PAN, name=self.taxpayer.name, fiscal_year=fiscal_year, month=month)
+
+    def report_inputs(self) -> list:
+        """What the books and the annex are rendered from besides the records: the templates and header details"""
+        templates = sorted(Path(entry.path) for entry in scandir(self.formatD) if entry.is_file()) + [self.trans_above_1L_file]
+        return [(template.name, self.template_cache.template_hash(template)) for template in templates] + \
+            [self.report_details(self.fiscal_year, self.end_date_np.strftime('%m'))]
+
     def add_report_details(self, src: Path, dest: Path, fiscal_year, month):
-        desired = u'करदाता दर्ता नं (PAN) : 301003001        करदाताको नाम: SHANKER PARBATI OIL STORES         साल: {}    कर अवधि: {}'.format(fiscal_year, month)
+        from openpyxl import load_workbook
+        desired = self.report_details(fiscal_year, month)
         workbook = load_workbook(filename=src)
         sheet = workbook.active
         sheet["A4"] = desired
@@ -53,10 +153,12 @@ class TransactionFileHandler():
 
 
     def delete_rows_in_excel(self, src: Path, dest: Path, index: list):
+        """Writes src without the rows at index to dest, returns the remaining rows"""
         import pandas as pd
         df = pd.read_excel(src)
         df = df.drop(df.index[index])
         df.to_excel(dest, index=False)
+        return df
 
 
     def transaction_above_1L_file_check(self, file_path: Path):
@@ -74,27 +176,81 @@ class TransactionFileHandler():
             logger.info('Template file found for transaction above one lakh')
     
 
-    def initialize_sheets(self, folder_name):
-        """Copies the sheets to saveD to work with the sheets"""
-        
+    def render_book(self, src: Path, dest: Path, month):
+        """Copies the format template src with the report header details to dest"""
+        cached = self.template_cache.entry(src, '.xlsx', self.report_details(self.fiscal_year, month))
+        if self.template_cache.fetch(cached, dest):
+            logger.debug(f'Copied rendered {src.name} from template cache')
+        else:
+            self.add_report_details(src, dest, self.fiscal_year, month)
+            self.template_cache.store(dest, cached)
+
+    def render_kept_books(self, folder: Path) -> dict:
+        """Fresh copies of the kept books in folder, to write them anew while the kept ones stay as they are"""
+        month = self.end_date_np.strftime('%m')
+        rendered = {}
+        for book, src in self.kept_templates.items():
+            rendered[book] = Path(folder) / book.name
+            self.render_book(src, rendered[book], month)
+        return rendered
+
+    def initialize_sheets(self, folder_name, annex_only=False, keep_books=False):
+        """
+        Copies the sheets to saveD to work with the sheets, only the annex with annex_only.
+        With keep_books sheets and the annex already in saveD are kept, to be appended to or left as they are.
+        """
+        with stage('initialize sheets'):
+            return self._initialize_sheets(folder_name, annex_only, keep_books)
+
+    def _initialize_sheets(self, folder_name, annex_only=False, keep_books=False):
+        import pandas as pd
+
         logger.info('Initializing sheets and copying it to previous month folder')
         files = {}
+        self.kept_files = []  # books and annex of saveD kept as they were
+        self.kept_templates = {}  # format template of each kept book
+        templates = [self.trans_above_1L_file]
+        month = self.end_date_np.strftime('%m')
         # Scanning the format directory to copy the initial sales-purchase sheets to saveD
         for entry in scandir(self.formatD):
-            if entry.is_file():
+            if entry.is_file() and not annex_only:
                 original_name = entry.name
                 logger.debug(f'Found {original_name} in format directory')
                 sheets_name = original_name.split(".")[0].split("-")[0]
+                if self.books is not None and sheets_name not in self.books:
+                    continue
                 dest = self.saveD.joinpath(sheets_name + " - " + folder_name + ".xlsx")
                 files[sheets_name] = dest
-                month = get_end_date_of_previous_month().strftime('%m')
-                # add report header details and also copy to the destination folder
-                self.add_report_details(self.formatD.joinpath(original_name), dest, self.fiscal_year, month)
+                src = self.formatD.joinpath(original_name)
+                templates.append(src)
+                if keep_books and dest.exists():
+                    logger.debug(f'Keeping {dest.name}')
+                    self.kept_files.append(dest)
+                    self.kept_templates[dest] = src
+                    continue
+                self.render_book(src, dest, month)
                 # self.copy(self.formatD.joinpath(original_name), dest)
-        
+
         trans_above_1L_file_dest = self.saveD / 'transactions_above_1L.xls'
         files['1L'] = trans_above_1L_file_dest
-        self.delete_rows_in_excel(self.trans_above_1L_file, trans_above_1L_file_dest, [0, 1])
+        # the cleaned rows are cached with the file so the annex can be written without reading it back
+        cached = self.template_cache.entry(self.trans_above_1L_file, '.xls')
+        cached_df = self.template_cache.entry(self.trans_above_1L_file, '.pkl')
+        if keep_books and trans_above_1L_file_dest.exists() and cached_df.exists():
+            # the annex is written as a whole from the cleaned rows, it needn't be a fresh copy
+            logger.debug(f'Keeping {trans_above_1L_file_dest.name}')
+            self.kept_files.append(trans_above_1L_file_dest)
+            self.trans_above_1L_df = pd.read_pickle(cached_df)
+            os.utime(cached_df)
+        elif self.template_cache.fetch(cached, trans_above_1L_file_dest) and cached_df.exists():
+            self.trans_above_1L_df = pd.read_pickle(cached_df)
+            os.utime(cached_df)
+        else:
+            self.trans_above_1L_df = self.delete_rows_in_excel(self.trans_above_1L_file, trans_above_1L_file_dest, [0, 1])
+            self.template_cache.store(trans_above_1L_file_dest, cached)
+            tmp = cached_df.with_name(cached_df.name + f'.{os.getpid()}.tmp')
+            self.trans_above_1L_df.to_pickle(tmp)
+            os.replace(tmp, cached_df)
         logger.info('Cleaned up pre data')
+        self.template_cache.evict(templates)
         return files
-    
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+Per stage instrumentation of a report run.
+Every stage records its wall time, rows processed, rows/sec and the peak RSS of the process,
+database queries also keep the SET STATISTICS IO/TIME output of the server.
+The stages of a run are written to run_report.json next to the workbooks, setting the
+REPORT_PROFILE environment variable also dumps a cProfile of the run to run_profile.prof.
+"""
+import cProfile
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = 'REPORT_PROFILE'
+REPORT_FILE = 'run_report.json'
+PROFILE_FILE = 'run_profile.prof'
+
+LOGICAL_READS_RE = re.compile(r'logical reads (\d+)')
+PHYSICAL_READS_RE = re.compile(r'physical reads (\d+)')
+EXECUTION_TIMES_RE = re.compile(r'Execution Times:\s*CPU time = (\d+) ms,\s*elapsed time = (\d+) ms')
+DRIVER_PREFIX_RE = re.compile(r'^(\[[^\]]*\])+\s*')
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of the process so far in MB, None where it can not be read"""
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss_mb()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _windows_peak_rss_mb() -> Optional[float]:
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize / 2**20
+    except (AttributeError, OSError):
+        return None
+
+
+def parse_server_statistics(messages: List[str]) -> dict:
+    """Sums the reads and execution times reported by SET STATISTICS IO/TIME, keeping the messages"""
+    messages = [DRIVER_PREFIX_RE.sub('', message) for message in messages]
+    text = '\n'.join(messages)
+    execution_times = EXECUTION_TIMES_RE.findall(text)
+    return {
+        'logical_reads': sum(map(int, LOGICAL_READS_RE.findall(text))),
+        'physical_reads': sum(map(int, PHYSICAL_READS_RE.findall(text))),
+        'cpu_ms': sum(int(cpu) for cpu, _ in execution_times),
+        'elapsed_ms': sum(int(elapsed) for _, elapsed in execution_times),
+        'messages': messages,
+    }
+
+
+@dataclass
+class StageStats:
+    """Totals of every call of a stage"""
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    peak_rss_mb: Optional[float] = None
+    queries: list = field(default_factory=list)
+
+    @property
+    def rows_per_sec(self) -> Optional[float]:
+        return self.rows / self.seconds if self.rows and self.seconds else None
+
+    def to_dict(self) -> dict:
+        stats = asdict(self)
+        stats['rows_per_sec'] = self.rows_per_sec
+        if not self.queries:
+            del stats['queries']
+        return stats
+
+
+@dataclass
+class StageCall:
+    """Handed to the block of a stage to report the rows it processed"""
+    rows: int = 0
+    query: Optional[dict] = None
+
+
+class Run:
+    """A report run, the report is written to folder once it is known"""
+
+    def __init__(self) -> None:
+        self.folder: Optional[Path] = None
+        self.status = 'ok'
+
+
+class Instrumentation:
+    """Collects the stages of the current run, shared by all modules and threads of the process"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = datetime.datetime.now()
+            self._start = time.perf_counter()
+            self.stages = {}  # name: StageStats in the order they first ran
+
+    def record(self, name: str, seconds: float, rows: int = 0, query: dict = None):
+        """Adds one call of a stage"""
+        rss = peak_rss_mb()
+        with self._lock:
+            stats = self.stages.setdefault(name, StageStats(name))
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.rows += rows
+            stats.peak_rss_mb = rss
+            if query is not None:
+                stats.queries.append(query)
+
+    def merge(self, stages: List[dict]):
+        """Adds the stages another process reported (report()['stages']), e.g. a worker writing a book"""
+        with self._lock:
+            for other in stages:
+                stats = self.stages.setdefault(other['name'], StageStats(other['name']))
+                stats.calls += other['calls']
+                stats.seconds += other['seconds']
+                stats.rows += other['rows']
+                if other['peak_rss_mb'] is not None:
+                    stats.peak_rss_mb = max(stats.peak_rss_mb or 0, other['peak_rss_mb'])
+                stats.queries.extend(other.get('queries', []))
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the block as a call of stage `name`, the block sets the rows it processed on the yielded call"""
+        call = StageCall()
+        start = time.perf_counter()
+        try:
+            yield call
+        finally:
+            self.record(name, time.perf_counter() - start, call.rows, call.query)
+
+    def report(self, status='ok') -> dict:
+        with self._lock:
+            stages = [stats.to_dict() for stats in self.stages.values()]
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': time.perf_counter() - self._start,
+            'status': status,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages,
+        }
+
+    @contextmanager
+    def run(self):
+        """
+        Instruments a report run from scratch, the block sets run.folder to have the report
+        (and the profile with REPORT_PROFILE set) written there when it ends
+        """
+        self.reset()
+        run = Run()
+        profiler = cProfile.Profile() if os.environ.get(PROFILE_ENV) else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield run
+        except BaseException:
+            run.status = 'failed'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if run.folder is not None:
+                self.write_report(run.folder, run.status, profiler)
+
+    def write_report(self, folder: Path, status='ok', profiler: cProfile.Profile = None) -> Path:
+        report = self.report(status)
+        if profiler is not None:
+            profiler.dump_stats(folder / PROFILE_FILE)
+            report['profile'] = PROFILE_FILE
+        path = folder / REPORT_FILE
+        path.write_text(json.dumps(report, indent=2, default=str))
+        logger.info(f'Run report written to {path}')
+        return path
+
+
+instrumentation = Instrumentation()
+stage = instrumentation.stage
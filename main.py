@@ -1,21 +1,38 @@
-import pandas as pd
-from dataclasses import dataclass, fields
-from typing import List, Any
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+from dataclasses import dataclass, fields, replace
+from decimal import Decimal, localcontext
+from typing import TYPE_CHECKING, List, Any, Iterable, Optional
 
 from dbconnection import DBConnection
-from filehandlers import TransactionFileHandler
+from queries import build_PAN_summary_query, build_voided_transactions_query
+from masterquery import DEFAULT_QUERY_STRATEGY, QUERY_STRATEGIES, check_query_strategy, master_query_batches, query_strategy
+from transactioncache import TransactionCache
+from reportmanifest import BookState, ContentHasher, ReportManifest
+from instrumentation import instrumentation, stage
 
-from my_logging import log_setup
+from my_logging import log_frame, log_setup, show_full_frames
 import logging
-from bs_ad_date_helpers import (get_previous_month_name_np,
-                     get_start_to_end_date_object_in_ad,
-                     get_start_to_end_date_object_in_bs,
-                     )
+
+# pandas and the modules built on it (reportrows, reconciliation, reportwriters, panindex, filehandlers and the
+# numpy calendar of bs_ad_date_helpers) are imported where a report needs them, main.py --help loads none of them
+if TYPE_CHECKING:
+    import pandas as pd
+    from bs_ad_date_helpers import ReportingPeriod
+    from filehandlers import Taxpayer, TransactionFileHandler
+    from panindex import PANIndex
 
 
 log_setup()  # Initializing logging configurations
 logger = logging.getLogger(__name__)
 
+DB_CONFIG = 'db_config.toml'
+ANNEX_THRESHOLD = 1_00_000  # PANs with a Total above this go to transactions_above_1L.xls
+REPORT_VERSION = 3  # part of the content hash of the reports, bump it when the way they are written changes
+CROSSED_1L_FILE = 'PANs_crossed_1L.xlsx'
+
 @dataclass
 class Transaction:
     transaction_type: int
@@ -24,164 +41,816 @@ class Transaction:
     remove_cols: List[str]
     item_col: str
     trans_char: str
-    records: List[List[Any]]
 
 @dataclass
 class Transactions:
-    sales: Transaction
-    purchase: Transaction
+    sales: Optional[Transaction] = None
+    purchase: Optional[Transaction] = None
 
     def __iter__(self):
+        """The transactions reported on, the ones left out are None"""
         for field in fields(self):
-            yield getattr(self, field.name)
+            transaction = getattr(self, field.name)
+            if transaction is not None:
+                yield transaction
 
 def append_transactions_above_1L(transactions: list, PAN_no, name, transaction_type_char, taxable_amount):
     transactions.append([PAN_no, name, 'E', transaction_type_char, taxable_amount, 0])
 
 
-def save_transactions_above_1L(files: dict, transactions: List[List[Any]]):
-    df = pd.read_excel(files['1L'])
-    new_df = pd.DataFrame(transactions, columns=df.columns)
-    df = pd.concat([df, new_df], ignore_index=True)
-    df.to_excel(files['1L'], index=False)
-    # Output in the console
-    print(f"\n##### Transactions above 1 Lakh #####\n")
-    print(new_df)
-
-
-def main(transactions: Transactions):
-
-    master_query = """
-    SELECT [Transaction Date]
-        ,CONCAT_WS('.',[Year], [Month], [Day]) as 'Nepali Date'
-        ,sysTran.[Transaction ID]
-        ,[Reference No]
-        ,[Bill Receiveable Person]
-        ,accProfInfo.[Vat Pan No]
-        ,STRING_AGG([Inventory Name], '/') as 'Item'
-        ,SUM([Item In]) as 'In'
-        ,SUM([Item Out]) as 'Out'
-        ,amtTran.[Grand Total]
-        ,amtTran.[Taxable Amount]
-        ,amtTran.[Tax Amount]
-        -- ,[Transaction Type]
-    FROM [VatBillingSoftware].[dbo].[SystemTransaction] sysTran
-    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesAmount] amtTran
-    ,[VatBillingSoftware].[dbo].[AccountProfileProduct] accProfInfo
-    ,[VatBillingSoftware].[dbo].[SystemCalenderDate]
-    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesItem] psiTran
-    ,[VatBillingSoftware].[dbo].[InventoryItem]
-    WHERE sysTran.[Transaction Type] = ?
-    AND [Transaction Date] BETWEEN ? AND ?
-    AND sysTran.[Transaction ID] = amtTran.[Transaction ID]
-    AND sysTran.Status != '001-03'
-    AND amtTran.[Account ID] = accProfInfo.[ACCOUNT ID]
-    AND [Bill Date] = [English Date]
-    AND [Inventory Item Code] = [Inventory ID]
-    AND psiTran.[Transaction ID] = sysTran.[Transaction ID]
-    GROUP BY [Transaction Date], [Year], [Month], [Day], sysTran.[Transaction ID]
-        ,psiTran.[Transaction ID]
-        ,[Bill Receiveable Person]
-        ,accProfInfo.[Vat Pan No]
-        ,amtTran.[Grand Total]
-        ,amtTran.[Taxable Amount]
-        ,amtTran.[Tax Amount]
-        ,[Reference No]
-    ORDER BY [Transaction Date]
-    """
-
-    with DBConnection('db_config.toml') as db:
-        purchase_records = db.query(master_query,
-                        [transactions.purchase.transaction_type, START_DATE_AD, END_DATE_AD]
-                        )
-        sales_records = db.query(master_query,
-                        [transactions.sales.transaction_type, START_DATE_AD, END_DATE_AD]
-                        )
-
-    transactions.purchase.records = [list(row) for row in purchase_records]
-    transactions.sales.records = [list(row) for row in sales_records]
+def append_PAN_customers_above_1L(transactions_above_1L: list, transaction: Transaction, PAN_customers_df: pd.DataFrame):
+    """Adds the PANs of the aggregates (amounts in paisa) whose Total is above the threshold, Taxable in whole rupees"""
+    from reportrows import PAISA
+    PAN_customers_df_filter = PAN_customers_df[PAN_customers_df['Total'].gt(ANNEX_THRESHOLD * PAISA)].reset_index()
+
+    for index, row in PAN_customers_df_filter.iterrows():
+        append_transactions_above_1L(transactions_above_1L, row['PAN No'], row['Bill Receiveable Person'], transaction.trans_char,
+                                     round(Decimal(int(row['Taxable'])) / PAISA))
+
+
+def save_transactions_above_1L(files: dict, transactions: List[List[Any]], template_df: pd.DataFrame, exports=()):
+    """Writes the cleaned template rows followed by the transactions in one pass, and their exports"""
+    import pandas as pd
+    from reportwriters import export_writers, remove_exports
+    new_df = pd.DataFrame(transactions, columns=template_df.columns)
+    df = pd.concat([template_df, new_df], ignore_index=True)
+    with stage('annex write') as call:
+        df.to_excel(files['1L'], index=False)
+        call.rows = len(df)
+    if exports:
+        with stage('export write') as call:
+            for writer in export_writers(files['1L'], exports):
+                with writer:
+                    writer.append_frame(df)
+            call.rows = len(df)
+    remove_exports(files['1L'], keep=exports)
+    add_export_files(files, '1L', exports)
+    log_frame(logger, new_df, 'Transactions above 1 Lakh')
+
+
+def add_export_files(files: dict, key: str, exports=()):
+    """Adds the exports of files[key] to files, as '<key>.<format>'"""
+    from reportwriters import export_path
+    for export in exports:
+        files[f'{key}.{export}'] = export_path(files[key], export)
+
+
+def split_batches(row_batches, transaction_types: List[int]):
+    """Yields each batch of master query rows as a dict of transaction type to the typed rows of that type"""
+    from reportrows import rows_to_frame, split_by_transaction_type
+    for rows in row_batches:
+        yield split_by_transaction_type(rows_to_frame(rows), transaction_types)
+
+
+def stream_transactions(db: DBConnection, transactions: Iterable[Transaction], start_date, end_date, batch_size=None,
+                        after_transaction_id=None, strategy=DEFAULT_QUERY_STRATEGY):
+    """
+    Streams the master query in batches of at most batch_size rows,
+    only the rows entered after after_transaction_id if given.
+    Each batch is yielded as a dict of transaction type to the records of that type.
+    The rows are fetched with the query strategy given (see masterquery).
+    """
+    transaction_types = [transaction.transaction_type for transaction in transactions]
+    after = after_transaction_id is not None
+    params = [*transaction_types, start_date, end_date] + ([after_transaction_id] if after else [])
+    yield from split_batches(master_query_batches(db, transaction_types, params, strategy, after=after, batch_size=batch_size),
+                             transaction_types)
 
-    transactions_above_1L = []
 
-    transaction: Transaction
-    for transaction in transactions:
-        # adding headers here to make working with dataframe easier
-        headers = ['Date AD', 'Date', 'Transaction ID', 'PurchaseInvoiceNo', 'Bill Receiveable Person', 'PAN No', 'Item', 'Item_in', 'Item_out', 'Total', 'Taxable', 'VAT']
-        df = pd.DataFrame(transaction.records , columns=headers)
+def stream_cached_transactions(month: str, transactions: Iterable[Transaction], start_date, end_date, batch_size=None, refresh=False,
+                               after_transaction_id=None, db_config=DB_CONFIG, strategy=None, sync=True):
+    """
+    Like stream_transactions but served from the local TransactionCache,
+    which only fetches the rows changed since its last sync of the month.
+    Without sync the rows of the last sync are streamed again.
+    """
+    transaction_types = [transaction.transaction_type for transaction in transactions]
+    with TransactionCache(db_config, query_strategy=strategy) as cache:
+        if sync:
+            cache.sync(month, transaction_types, start_date, end_date, refresh, batch_size)
+        yield from split_batches(cache.query_batches(month, transaction_types, batch_size, after_transaction_id), transaction_types)
+
+
+def build_report_frame(transaction: Transaction, records: pd.DataFrame, period: ReportingPeriod = None) -> pd.DataFrame:
+    """
+    Lays typed master query rows (reportrows.rows_to_frame) out in the columns of the format templates,
+    the Bill Dates in the AD range of period as days of its month
+    """
+    from bs_ad_date_helpers import ad_to_bs_strings
+    from reportrows import RECONCILIATION_COLUMNS, amounts_in_rupees
+    # removing Date AD column, didnt remove from the query for future use also removing other
+    # column like item_In or item_Out, invoiceno, transaction id, based on transaction type
+    df = records.drop(columns=['Date AD', 'Transaction Type'] + RECONCILIATION_COLUMNS + transaction.remove_cols)
+
+    # insertion of extra columns as required by format templates
+    df.insert(6, 'unit', 'L')
+    df.insert(8, 'blank', '')
 
-        # removing Date AD column, didnt remove from the query for future use also removing other
-        # column like item_In or item_Out, invoiceno, transaction id, based on transaction type
-        df.drop(columns=['Date AD']+transaction.remove_cols, axis=1, inplace=True)
+    # B.S. Bill Date as CONCAT_WS('.', [Year], [Month], [Day]) of SystemCalenderDate did
+    df['Date'] = ad_to_bs_strings(df['Date'].to_numpy('datetime64[D]'), zero_pad=False, period=period)
+    return amounts_in_rupees(df)
 
-        # insertion of extra columns as required by format templates
-        df.insert(6, 'unit', 'L')
-        df.insert(8, 'blank', '')
 
-        # logic to convert string to numeric for missing PANs in the column
-        df['PAN No'].mask(df['PAN No'] == '', 000, inplace=True)
-        df['PAN No'] = df['PAN No'].astype(int)
-        df['PAN No'].mask(df['PAN No'] == 000, '', inplace=True)
+def aggregate_PAN_customers(df: pd.DataFrame) -> pd.DataFrame:
+    """Sums Taxable and Total (paisa) per PAN No. keeping the first Bill Receiveable Person"""
+    return df.groupby('PAN No').agg({'Bill Receiveable Person': 'first', 'Taxable': 'sum', 'Total': 'sum'}).reset_index()
 
-        # conversion stiring to numeric (shouldn't have missing values)
-        df[transaction.item_col] = df[transaction.item_col].astype(float)
-        df['Total'] = df['Total'].astype(float)
-        df['Taxable'] = df['Taxable'].astype(float)
-        df['VAT'] = df['VAT'].astype(float)
 
+def book_PAN_totals(state: BookState) -> pd.DataFrame:
+    """PAN aggregates of a book written before, in the layout of aggregate_PAN_customers"""
+    import pandas as pd
+    return pd.DataFrame(state.PAN_totals, columns=['PAN No', 'Bill Receiveable Person', 'Taxable', 'Total']) \
+        .astype({'PAN No': 'Int64', 'Taxable': 'Int64', 'Total': 'Int64'})
+
+
+@dataclass
+class WrittenBook:
+    """A finished book, what the annex, the reconciliation workbook and the manifest take from it"""
+    transaction: Transaction
+    rows: int  # written by this run
+    PAN_customers_df: pd.DataFrame
+    exceptions: pd.DataFrame  # of the bills reconciled while writing
+    bills: int  # reconciled
+    state: BookState
+
+
+class TransactionReport:
+    """
+    Builds the report of a transaction batch by batch.
+    Only running column totals and PAN aggregates are kept between batches,
+    the rows themselves are written to the sheet as they arrive.
+    Given the BookState of a book written before, the report carries on from it:
+    bills up to its last Transaction ID are skipped and new rows replace its Column_Total row.
+    The bills written are reconciled as they go (see reconciliation).
+    The rows are exported in the formats of exports too, without the Column_Total row.
+    The Bill Dates within the range of period are written as days of its month (see build_report_frame).
+    With template, a fresh copy of the format template of a kept book, the book is written from it
+    and only replaces file on write.
+    """
+
+    def __init__(self, transaction: Transaction, file, state: BookState = None, exports=(),
+                 period: ReportingPeriod = None, template: Path = None) -> None:
+        from reconciliation import Reconciler
+        from reportwriters import XlsxRowWriter, export_writers
+        self.transaction = transaction
+        self.file = file
+        self.state = state
+        self.exports = list(exports)
+        self.period = period
+        self.rows = 0
+        self.columns = None
+        self.totals = {}  # exact Decimal sums, independent of how the rows are batched
+        self.PAN_customers_df = None
+        self.last_transaction_id = None
+        self.last_date = None
+        self.reconciler = Reconciler(period)
+
+        if state is None:
+            # rows are appended right after the header rows of the format template
+            self.writer = XlsxRowWriter(file, transaction.sheet_name, source=template)
+        else:
+            self.columns = state.columns
+            self.totals = {column: Decimal(total) for column, total in state.totals.items()}
+            self.PAN_customers_df = book_PAN_totals(state)
+            self.last_transaction_id = state.last_transaction_id
+            self.last_date = state.last_date
+            self.writer = XlsxRowWriter(file, transaction.sheet_name, replace_from=state.total_row)
+        self.export_writers = export_writers(file, self.exports, append=state is not None)
+
+    def add_batch(self, records: pd.DataFrame):
+        import pandas as pd
+        from reconciliation import from_report_rows
+        from reportrows import AMOUNT_COLUMNS, PAISA
+        if self.state is not None and self.state.last_transaction_id is not None:
+            # bills up to the last written one are in the book already
+            records = records[records['Transaction ID'].to_numpy() > self.state.last_transaction_id]
+            if not len(records):
+                return
+        if len(records):
+            last_transaction_id = records['Transaction ID'].max()
+            last_date = records['Date AD'].max().date().isoformat()
+            if self.last_transaction_id is None or last_transaction_id > self.last_transaction_id:
+                self.last_transaction_id = last_transaction_id
+            if self.last_date is None or last_date > self.last_date:
+                self.last_date = last_date
+
+        with stage('reconciliation') as call:
+            self.reconciler.add_batch(from_report_rows(records))
+            call.rows = len(records)
+
+        with stage('transform') as call:
+            df = build_report_frame(self.transaction, records, self.period)
+            # a NULL Bill Date or one outside the calendar has no B.S. date to write, the reconciliation lists them
+            undated = df['Date'].isna().to_numpy()
+            if undated.any():
+                logger.warning(f'{self.transaction.transaction_name.capitalize()}: leaving {undated.sum()} bills without a '
+                               f'B.S. Bill Date out of the book, see the Bill Date exceptions of the reconciliation')
+                df, records = df[~undated], records[~undated]
+            call.rows = len(df)
+        if self.columns is None:
+            self.columns = df.columns
+
+        with stage('excel write') as call:
+            self.writer.append_frame(df)
+            call.rows = len(df)
+        if self.export_writers:
+            with stage('export write') as call:
+                for writer in self.export_writers:
+                    writer.append_frame(df)
+                call.rows = len(df)
+        self.rows += len(df)
+
+        with stage('PAN aggregation') as call:
+            # PAN No is numeric but not an amount
+            with localcontext(prec=60):
+                for column, values in df.drop(columns='PAN No').select_dtypes('number').items():
+                    if column in AMOUNT_COLUMNS:  # exact sums of the paisa of the records
+                        total = Decimal(int(records[column].sum())) / PAISA
+                    else:
+                        total = sum(map(Decimal, values.tolist()), Decimal(0))
+                    self.totals[column] = self.totals.get(column, Decimal(0)) + total
+
+            # filtering transactions having PAN no field value
+            PAN_customers_df = aggregate_PAN_customers(records[records['PAN No'].notna()])
+            if self.PAN_customers_df is not None:
+                PAN_customers_df = aggregate_PAN_customers(pd.concat([self.PAN_customers_df, PAN_customers_df]))
+            self.PAN_customers_df = PAN_customers_df
+            call.rows = len(df)
+
+    def finish(self) -> pd.DataFrame:
+        """Writes the Column_Total row, saves the workbook and returns the PAN aggregates"""
+        import pandas as pd
+        from reportrows import rows_to_frame
+        from reportwriters import remove_exports
+        if self.columns is None:
+            self.add_batch(rows_to_frame([]))  # no records, still write the totals row like an empty month
         # adding new row as total of all numeric columns
-        df.loc['Column_Total']= df.sum(numeric_only=True, axis=0)
+        totals = {column: float(total) for column, total in self.totals.items()}
+        total_row = pd.DataFrame([totals], columns=self.columns, index=['Column_Total'])
+        if self.state is not None and not self.rows:
+            self.discard()  # no new bills, the book already ends with these totals
+        else:
+            with stage('excel write') as call:
+                self.writer.append_frame(total_row)
+                self.writer.close()
+                call.rows = len(total_row)
+            if self.export_writers:
+                with stage('export write'):
+                    for writer in self.export_writers:
+                        writer.close()
+            remove_exports(self.file, keep=self.exports)
+
+        name = self.transaction.transaction_name.capitalize()
+        logger.info(f'{name}: {self.rows} rows written to {self.file}, total Taxable {round(totals.get("Taxable", 0), 2)}')
+        log_frame(logger, total_row, f'{name} totals')
+        return self.PAN_customers_df
+
+    def discard(self):
+        """Drops the rows added, the book and its exports are left as they are"""
+        self.writer.discard()
+        for writer in self.export_writers:
+            writer.discard()
+
+    def write(self) -> WrittenBook:
+        """Finishes the book and the reconciliation of its bills"""
+        PAN_customers_df = self.finish()
+        with stage('reconciliation') as call:
+            exceptions = self.reconciler.finish()
+            call.rows = len(exceptions)
+        return WrittenBook(self.transaction, self.rows, PAN_customers_df, exceptions, self.reconciler.bills,
+                           self.book_state())
+
+    def book_state(self) -> BookState:
+        """State of the finished book for the manifest"""
+        if self.state is not None and not self.rows:
+            total_row = self.state.total_row
+        else:
+            total_row = self.writer.next_row - 1
+        # the PANs went through to_PAN, the missing (invalid) ones are not aggregated
+        PAN_customers_df = self.PAN_customers_df.dropna(subset=['PAN No'])
+        PAN_totals = [list(row) for row in zip(PAN_customers_df['PAN No'].astype('int64').tolist(),
+                                               PAN_customers_df['Bill Receiveable Person'].tolist(),
+                                               PAN_customers_df['Taxable'].astype('int64').tolist(),
+                                               PAN_customers_df['Total'].astype('int64').tolist())]
+        return BookState(self.transaction.transaction_type, Path(self.file).name, self.transaction.sheet_name,
+                         (self.state.rows if self.state else 0) + self.rows, total_row,
+                         self.last_transaction_id, self.last_date, list(self.columns),
+                         {column: str(total) for column, total in self.totals.items()}, PAN_totals)
+
+
+def write_book(transaction: Transaction, file, state: Optional[BookState], exports, frames: List[pd.DataFrame],
+               period: ReportingPeriod = None):
+    """
+    Worker entry point of write_books, writes the book of a transaction from its typed records.
+    Returns the WrittenBook and the stages the worker recorded
+    """
+    instrumentation.reset()
+    report = TransactionReport(transaction, file, state, exports, period)
+    for records in frames:
+        report.add_batch(records)
+    return report.write(), instrumentation.report()['stages']
+
+
+def hold_batches(transactions: Transactions, batches) -> dict:
+    """The records of the batches by transaction type, as a list of frames each"""
+    frames = {transaction.transaction_type: [] for transaction in transactions}
+    for batch in batches:
+        for transaction_type, records in batch.items():
+            if len(records):
+                frames[transaction_type].append(records)
+    return frames
+
 
-        print(f"\n#### {transaction.transaction_name.capitalize()} transactions ####\n")
-        print(df)
+def write_books(transactions: Transactions, files: dict, books: Optional[dict], frames: dict, exports=(),
+                period: ReportingPeriod = None) -> List[WrittenBook]:
+    """
+    Writes the book of every transaction on its own worker process from the frames held by hold_batches.
+    The books are the same, byte for byte, as the ones written in process.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    written = []
+    with stage('book workers') as call, ProcessPoolExecutor(max_workers=len(frames)) as executor:
+        futures = [executor.submit(write_book, transaction, files[transaction.transaction_name],
+                                   books and books[transaction.transaction_type], exports, frames[transaction.transaction_type],
+                                   period)
+                   for transaction in transactions]
+        for future in futures:
+            book, stages = future.result()
+            instrumentation.merge(stages)
+            written.append(book)
+        call.rows = sum(book.rows for book in written)
+    return written
+
+
+def main(transactions: Transactions, trans_file: TransactionFileHandler, start_date, end_date, batch_size=None,
+         use_cache=None, refresh=False, append=False, db_config=DB_CONFIG, force=False, exports=(), parallel_books=False,
+         strategy=None):
+    with stage('main') as call:
+        call.rows = write_reports(transactions, trans_file, start_date, end_date, batch_size, use_cache, refresh, append,
+                                  db_config, force, exports, parallel_books, strategy)
+
+
+def fetch_voided_ids(db: DBConnection, transactions: Transactions, start_date, end_date) -> list:
+    transaction_types = [transaction.transaction_type for transaction in transactions]
+    return sorted(row[0] for row in db.query(build_voided_transactions_query(transaction_types),
+                                             [*transaction_types, start_date, end_date]))
+
+
+def resume_books(manifest: Optional[ReportManifest], trans_file: TransactionFileHandler, transactions: Transactions,
+                 voided: list, exports=()) -> Optional[dict]:
+    """
+    Returns {transaction_type: BookState} of the books of the month folder to append to,
+    None when they have to be written from scratch
+    """
+    if manifest is None:
+        reason = f'no manifest in {trans_file.saveD}'
+    elif manifest.month != trans_file.period.key:
+        reason = f'manifest is of {manifest.month}'
+    elif set(manifest.books) != {transaction.transaction_type for transaction in transactions}:
+        reason = 'manifest is of other transaction types'
+    elif not all(book.unchanged(trans_file.saveD) for book in manifest.books.values()):
+        reason = 'books changed since the manifest was written'
+    elif not books_exported(manifest, trans_file, exports):
+        reason = f'books were not exported to {", ".join(exports)}'
+    else:
+        # voided bills can't be taken out of a book, only ones entered after it was written are fine
+        last_ids = [book.last_transaction_id for book in manifest.books.values() if book.last_transaction_id is not None]
+        newly_voided = set(voided) - set(manifest.voided or [])
+        if last_ids and any(transaction_id <= max(last_ids) for transaction_id in newly_voided):
+            reason = 'written bills were voided since'
+        else:
+            return manifest.books
+    logger.info(f'Rewriting the books of {trans_file.period.key}: {reason}')
+    return None
+
+
+def books_exported(manifest: ReportManifest, trans_file: TransactionFileHandler, exports=()) -> bool:
+    """Whether the books of the manifest have exports in every format of exports"""
+    from reportwriters import export_path
+    return all(export_path(trans_file.saveD / book.file, export).exists()
+               for book in manifest.books.values() for export in exports)
+
+
+def write_reports(transactions: Transactions, trans_file: TransactionFileHandler, start_date, end_date, batch_size=None,
+                  use_cache=None, refresh=False, append=False, db_config=DB_CONFIG, force=False, exports=(),
+                  parallel_books=False, strategy=None) -> int:
+    """
+    Writes the workbooks and the annex of the transactions and their exports, returns the number of rows written.
+    With parallel_books each book is written on its own worker process (see write_books).
+    The rows are fetched with the query strategy given, the one of db_config by default (see masterquery).
+    With append only the bills entered since the books of the month were last written are added to them.
+    Otherwise the books are left as they are when the records and inputs hash like the ones they were
+    written from (see report_hasher), unless force. The books kept by trans_file are rewritten if not.
+    The records are hashed as they are written, to temporary books while the kept ones may still be left
+    as they are (held until the hash is known with parallel_books), so the month is streamed once.
+    """
+    from reportrows import amounts_in_rupees
+    if use_cache is None:
+        use_cache = DBConnection.get_config(db_config).get('cache', {}).get('enabled', False)
+    if strategy is None:
+        strategy = query_strategy(DBConnection.get_config(db_config))
+
+    # voided bills are checked on every append run, even when the rows come from the cache
+    db = DBConnection(db_config) if append or not use_cache else None
+    try:
+        voided = fetch_voided_ids(db, transactions, start_date, end_date) if db is not None else None
+        books = None
+        if append:
+            books = resume_books(ReportManifest.load(trans_file.saveD), trans_file, transactions, voided, exports)
+            if books is None:
+                trans_file.files = trans_file.initialize_sheets(trans_file.folder_name)
+
+        # bills after the lowest watermark, each report skips the ones it has already
+        last_ids = [book.last_transaction_id for book in (books or {}).values()]
+        after_transaction_id = min(last_ids) if last_ids and None not in last_ids else None
+        if after_transaction_id is not None:
+            logger.info(f'Appending the bills entered after Transaction ID {after_transaction_id}')
+
+        def open_batches(sync=True):
+            if use_cache:
+                return stream_cached_transactions(trans_file.period.key, transactions, start_date, end_date, batch_size,
+                                                  refresh, after_transaction_id, db_config, strategy, sync=sync)
+            return stream_transactions(db, transactions, start_date, end_date, batch_size, after_transaction_id, strategy)
+
+        batches = open_batches()
+        hasher = None
+        if not append:
+            # the manifest gets the hash of the rows written
+            hasher = report_hasher(transactions, trans_file)
+            batches = hash_batches(batches, hasher)
+            manifest = None if force else ReportManifest.load(trans_file.saveD)
+            if manifest is None and trans_file.kept_files:
+                trans_file.files = trans_file.initialize_sheets(trans_file.folder_name)
+
+        def keep_unchanged() -> bool:
+            """Leaves the kept reports as they are if the records and inputs hashed like the ones they were written from"""
+            if not reports_unchanged(manifest, trans_file, transactions, hasher.hexdigest(), exports):
+                return False
+            logger.info(f'Records and inputs of {trans_file.period.key} are unchanged, keeping its reports')
+            keep_reports(manifest, transactions, trans_file, db_config, exports)
+            return True
+
+        kept = not append and bool(trans_file.kept_files)
+        if parallel_books:
+            frames = hold_batches(transactions, batches)
+            if kept:
+                if keep_unchanged():
+                    return 0
+                trans_file.files = trans_file.initialize_sheets(trans_file.folder_name)
+            files = trans_file.files
+            written = write_books(transactions, files, books, frames, exports, trans_file.period)
+        else:
+            files = trans_file.files
+            with tempfile.TemporaryDirectory(dir=trans_file.saveD) as folder:
+                # the kept books are written anew from fresh templates, they are replaced only if the hash changed
+                templates = trans_file.render_kept_books(folder) if kept else {}
+                reports = {transaction.transaction_type: TransactionReport(transaction, files[transaction.transaction_name],
+                                                                           books and books[transaction.transaction_type],
+                                                                           exports, trans_file.period,
+                                                                           templates.get(files[transaction.transaction_name]))
+                           for transaction in transactions}
+
+                for batch in batches:
+                    for transaction_type, records in batch.items():
+                        if len(records):
+                            reports[transaction_type].add_batch(records)
+                if kept and keep_unchanged():
+                    for report in reports.values():
+                        report.discard()
+                    return 0
+                written = [report.write() for report in reports.values()]
+    finally:
+        if db is not None:
+            db.close()
 
-        # Totals
-        total_taxable = round(df['Taxable'].iloc[-1], 2)
-        print(f'\n[+] {transaction.transaction_name.capitalize()} total Taxable: {total_taxable}\n')
+    transactions_above_1L = []
+    PAN_totals = {}
 
-        # filtering transactions having PAN no field value
-        PAN_customers_df = df[df['PAN No'].astype(bool)].copy()
-        PAN_customers_df = PAN_customers_df.drop('Column_Total')
-        PAN_customers_df = PAN_customers_df.groupby('PAN No').agg({'Bill Receiveable Person': 'first', 'Taxable': 'sum', 'Total': 'sum'}).reset_index()
+    for book in written:
+        PAN_totals[book.transaction.transaction_type] = book.PAN_customers_df
 
-        print(f'\n##### Transactions with PAN No. #####\n')
-        print(PAN_customers_df)
+        log_frame(logger, amounts_in_rupees(book.PAN_customers_df),
+                  f'{book.transaction.transaction_name.capitalize()} transactions with PAN No.', totals=['Taxable', 'Total'])
 
-        PAN_customers_df_filter = PAN_customers_df[PAN_customers_df['Total'].gt(1_00_000)].reset_index()
+        append_PAN_customers_above_1L(transactions_above_1L, book.transaction, book.PAN_customers_df)
+        add_export_files(files, book.transaction.transaction_name, exports)
 
-        for index, row in PAN_customers_df_filter.iterrows():
-            append_transactions_above_1L(transactions_above_1L, row['PAN No'], row['Bill Receiveable Person'], transaction.trans_char, round(row['Taxable']))
+    save_transactions_above_1L(files, transactions_above_1L, trans_file.trans_above_1L_df, exports)
+    write_reconciliation(written, trans_file, append=books is not None)
+    ReportManifest(trans_file.period.key, voided, {book.transaction.transaction_type: book.state for book in written},
+                   content_hash=hasher and hasher.hexdigest()).save(trans_file.saveD)
+    if PAN_index_enabled(db_config):
+        update_PAN_index(transactions, trans_file, PAN_totals, db_config)
+    return sum(book.rows for book in written)
 
-        file = files[transaction.transaction_name]
 
-        reader = pd.read_excel(file)
-        with pd.ExcelWriter(
-                file,
-                mode="a",
-                engine="openpyxl",
-                if_sheet_exists="overlay",
-                # engine_kwargs={'options': {'strings_to_numbers': True}},
-            ) as writer:
-                df.to_excel(writer, index=False, header=False,
-                            sheet_name=transaction.sheet_name, startrow=len(reader) + 1)
-    save_transactions_above_1L(files, transactions_above_1L)
+def report_hasher(transactions: Transactions, trans_file: TransactionFileHandler) -> ContentHasher:
+    """Hasher of the records of a month and everything else its reports are rendered from"""
+    layouts = [(transaction.transaction_type, transaction.transaction_name, transaction.sheet_name, transaction.remove_cols,
+                transaction.trans_char) for transaction in transactions]
+    inputs = [REPORT_VERSION, trans_file.period.key, ANNEX_THRESHOLD, layouts, trans_file.report_inputs()]
+    return ContentHasher([transaction.transaction_type for transaction in transactions], inputs)
 
 
-if __name__ == '__main__':
+def hash_batches(batches, hasher: ContentHasher):
+    """Yields the batches, feeding their records to hasher on the way"""
+    for batch in batches:
+        for transaction_type, records in batch.items():
+            if len(records):
+                hasher.update(transaction_type, records)
+        yield batch
 
-    previous_month_np = get_previous_month_name_np()
 
-    START_DATE_AD, END_DATE_AD = get_start_to_end_date_object_in_ad()
+def reports_unchanged(manifest: Optional[ReportManifest], trans_file: TransactionFileHandler, transactions: Transactions,
+                      content_hash: str, exports=()) -> bool:
+    """
+    Whether the reports kept in the month folder were written from records and inputs of content_hash,
+    exported in the formats of exports
+    """
+    from reconciliation import RECONCILIATION_FILE
+    from reportwriters import export_path
+    if manifest is None or manifest.content_hash != content_hash:
+        return False
+    if set(manifest.books) != {transaction.transaction_type for transaction in transactions}:
+        return False
+    if trans_file.files['1L'] not in trans_file.kept_files:
+        return False  # a fresh copy of the annex template
+    if not books_exported(manifest, trans_file, exports) or \
+            not all(export_path(trans_file.files['1L'], export).exists() for export in exports):
+        return False
+    reconciliation = trans_file.saveD / RECONCILIATION_FILE.format(month=trans_file.folder_name)
+    return all(book.unchanged(trans_file.saveD) for book in manifest.books.values()) and reconciliation.exists()
+
+
+def keep_reports(manifest: ReportManifest, transactions: Transactions, trans_file: TransactionFileHandler, db_config=DB_CONFIG,
+                 exports=()):
+    """
+    Leaves the reports of an unchanged month as they are. The PAN index still takes the PAN totals of
+    the manifest, PANs_crossed_1L.xlsx depends on the months before this one too.
+    """
+    from reconciliation import RECONCILIATION_FILE
+    for key in [transaction.transaction_name for transaction in transactions] + ['1L']:
+        add_export_files(trans_file.files, key, exports)
+    trans_file.files['reconciliation'] = trans_file.saveD / RECONCILIATION_FILE.format(month=trans_file.folder_name)
+    if PAN_index_enabled(db_config):
+        PAN_totals = {transaction_type: book_PAN_totals(book) for transaction_type, book in manifest.books.items()}
+        update_PAN_index(transactions, trans_file, PAN_totals, db_config)
 
-    START_DATE_BS, END_DATE_BS = get_start_to_end_date_object_in_bs()
 
-    logger.info(f"#### Fetching transactions for {START_DATE_BS} to {END_DATE_BS} ({previous_month_np}) ####")
+def write_reconciliation(books: List[WrittenBook], trans_file: TransactionFileHandler, append=False):
+    """
+    Writes the exceptions of the bills of the books to the reconciliation workbook of the month folder.
+    With append they are added to the ones of the bills written before (duplicate reference numbers
+    are only looked for among the bills of this run then).
+    """
+    from reconciliation import RECONCILIATION_FILE, concat_exceptions, log_summary, write_exceptions
+    with stage('reconciliation') as call:
+        exceptions = concat_exceptions([book.exceptions for book in books])
+        path = trans_file.saveD / RECONCILIATION_FILE.format(month=trans_file.folder_name)
+        trans_file.files['reconciliation'] = write_exceptions(path, exceptions, append)
+        call.rows = len(exceptions)
+    log_summary(exceptions, sum(book.bills for book in books))
 
-    trans_file = TransactionFileHandler(previous_month_np)
-    files = trans_file.files
 
-    purchase = Transaction(1, 'purchase', 'Nepali PB', ['Item_out', 'Transaction ID'], 'Item_in', 'P', None)
-    sales = Transaction(2, 'sales', 'Nepali SB', ['Item_in', 'PurchaseInvoiceNo'], 'Item_out', 'S', None)
+def fetch_PAN_totals(db: DBConnection, transactions: Transactions, start_date, end_date, threshold=ANNEX_THRESHOLD) -> dict:
+    """
+    Returns {transaction_type: DataFrame} of the per PAN totals aggregated on the server,
+    in the layout of aggregate_PAN_customers. Only the PANs above threshold unless it is None.
+    """
+    import pandas as pd
+    from reportrows import to_paisa, to_PAN
+    transaction_types = [transaction.transaction_type for transaction in transactions]
+    sql = build_PAN_summary_query(transaction_types, above_threshold=threshold is not None)
+    params = [*transaction_types, start_date, end_date] + ([threshold] if threshold is not None else [])
+    with stage('PAN summary query'):
+        rows = db.query(sql, params)
+
+    by_type = {transaction_type: [] for transaction_type in transaction_types}
+    for PAN_no, name, taxable, total, transaction_type in rows:
+        by_type[int(transaction_type)].append((PAN_no, name, taxable, total))
+    PAN_totals = {}
+    for transaction_type, PAN_rows in by_type.items():
+        df = pd.DataFrame(PAN_rows, columns=['Vat Pan No', 'Bill Receiveable Person', 'Taxable', 'Total'])
+        for column in ['Taxable', 'Total']:
+            df[column] = to_paisa(df[column].tolist())
+        # the PANs as in the books, the server grouped the Vat Pan No text ('012' and '12' apart)
+        df.insert(0, 'PAN No', to_PAN(df['Vat Pan No'].tolist()))
+        invalid = df['PAN No'].isna()
+        if invalid.any():
+            logger.warning(f'Leaving out {invalid.sum()} invalid PANs of transaction type {transaction_type}: '
+                           f'{df.loc[invalid, "Vat Pan No"].head().tolist()}')
+        PAN_totals[transaction_type] = aggregate_PAN_customers(df)
+    return PAN_totals
+
+
+def main_annex_only(transactions: Transactions, trans_file: TransactionFileHandler, start_date, end_date, db_config=DB_CONFIG,
+                    exports=()):
+    """Writes only transactions_above_1L.xls, without fetching the invoices of the month"""
+    # the PAN index needs every PAN of the month, not only the ones above the threshold
+    index_PANs = PAN_index_enabled(db_config)
+    with stage('main') as call, DBConnection(db_config) as db:
+        PAN_totals = fetch_PAN_totals(db, transactions, start_date, end_date, None if index_PANs else ANNEX_THRESHOLD)
+        transactions_above_1L = []
+        for transaction in transactions:
+            append_PAN_customers_above_1L(transactions_above_1L, transaction, PAN_totals[transaction.transaction_type])
+        save_transactions_above_1L(trans_file.files, transactions_above_1L, trans_file.trans_above_1L_df, exports)
+        call.rows = len(transactions_above_1L)
+    if index_PANs:
+        update_PAN_index(transactions, trans_file, PAN_totals, db_config)
+
+
+def PAN_index_enabled(db_config=DB_CONFIG) -> bool:
+    return DBConnection.get_config(db_config).get('pan_index', {}).get('enabled', False)
+
+
+def update_PAN_index(transactions: Transactions, trans_file: TransactionFileHandler, PAN_totals: dict,
+                     db_config=DB_CONFIG) -> Optional[pd.DataFrame]:
+    """
+    Adds the PAN totals of the month to the fiscal year index and writes the PANs whose
+    fiscal year Total went above the threshold this month to PANs_crossed_1L.xlsx,
+    unless earlier months of the fiscal year are not indexed yet (see write_PAN_crossings).
+    The crossings of the later months of the fiscal year depend on this month too, their files are rewritten.
+    Runs of other months (batch.py) wait for the index meanwhile, so whichever month is indexed last
+    writes the crossings of the months after it with every month indexed so far.
+    """
+    from panindex import PANIndex
+    month = trans_file.period.key
+    index_file = DBConnection.get_config(db_config).get('pan_index', {}).get('file')
+    with stage('PAN index'), PANIndex(index_file) as index, index.transaction():
+        index.update(trans_file.fiscal_year, month, PAN_totals)
+        crossed_df = write_PAN_crossings(index, transactions, trans_file.fiscal_year, month, trans_file.saveD)
+        rewritten = refresh_PAN_crossings(index, trans_file.fiscal_year, trans_file.saveD.parent, after=month)
+    if rewritten:
+        logger.info(f'Rewrote {CROSSED_1L_FILE} of the later months {", ".join(rewritten)}')
+
+    if crossed_df is not None:
+        log_frame(logger, crossed_df, f'PANs above 1 Lakh in {trans_file.fiscal_year} since this month')
+    return crossed_df
+
+
+def write_PAN_crossings(index: PANIndex, transactions: Transactions, fiscal_year: str, month: str,
+                        folder: Path) -> Optional[pd.DataFrame]:
+    """
+    Writes the PANs whose fiscal year Total went above the threshold in month to PANs_crossed_1L.xlsx of folder.
+    Running sums without an earlier month of the fiscal year would be too low, while one is not indexed
+    no file is written (one written before is removed) and None is returned
+    """
+    import pandas as pd
+    from reportrows import PAISA, amounts_in_rupees
+    missing = sorted({earlier for transaction in transactions
+                      for earlier in index.missing_months(fiscal_year, month, transaction.transaction_type)})
+    if missing:
+        logger.warning(f'Not writing {CROSSED_1L_FILE} of {month}: months {", ".join(missing)} of {fiscal_year} '
+                       f'are not indexed, generate them with the PAN index enabled first')
+        (folder / CROSSED_1L_FILE).unlink(missing_ok=True)
+        return None
+    crossed = []
+    for transaction in transactions:
+        crossed_df = index.crossings(fiscal_year, month, transaction.transaction_type, ANNEX_THRESHOLD * PAISA)
+        crossed_df.insert(2, 'Transaction', transaction.trans_char)
+        crossed.append(crossed_df)
+    crossed_df = amounts_in_rupees(pd.concat(crossed, ignore_index=True), ['Taxable', 'Total', 'Month Total'])
+    crossed_df.to_excel(folder / CROSSED_1L_FILE, index=False)
+    return crossed_df
+
 
-    transactions = Transactions(purchase, sales)
+def refresh_PAN_crossings(index: PANIndex, fiscal_year: str, fiscal_year_folder: Path, after: str) -> List[str]:
+    """
+    Rewrites PANs_crossed_1L.xlsx of the indexed months of fiscal_year after the month `after` that have
+    a folder in fiscal_year_folder (sheets/<FY>), for the transaction types they were indexed with.
+    Their file may not have been written yet, when a month before them was not indexed.
+    Returns the rewritten months
+    """
+    from bs_ad_date_helpers import get_end_date_of_month, reporting_period
+    rewritten = []
+    for month, transaction_types in index.indexed_months(fiscal_year).items():
+        if month <= after:
+            continue
+        year, month_no = map(int, month.split('-'))
+        folder = fiscal_year_folder / reporting_period(get_end_date_of_month(year, month_no)).month_name
+        if not folder.exists():
+            continue
+        if write_PAN_crossings(index, select_transactions(transaction_types), fiscal_year, month, folder) is not None:
+            rewritten.append(month)
+    return rewritten
+
+
+def default_transactions() -> Transactions:
+    purchase = Transaction(1, 'purchase', 'Nepali PB', ['Item_out', 'Transaction ID'], 'Item_in', 'P')
+    sales = Transaction(2, 'sales', 'Nepali SB', ['Item_in', 'PurchaseInvoiceNo'], 'Item_out', 'S')
+    return Transactions(purchase, sales)
+
+
+def check_transaction_types(transaction_types) -> List[int]:
+    """The transaction types as ints, raises ValueError on unknown ones or none"""
+    try:
+        if isinstance(transaction_types, (str, bytes)):
+            raise TypeError
+        transaction_types = [int(transaction_type) for transaction_type in transaction_types]
+    except (TypeError, ValueError):
+        raise ValueError(f'Transaction types are a list of numbers, not {transaction_types!r}') from None
+    unknown = set(transaction_types) - {transaction.transaction_type for transaction in default_transactions()}
+    if unknown or not transaction_types:
+        raise ValueError(f'Unknown transaction types {sorted(unknown)}' if unknown else 'No transaction types given')
+    return transaction_types
+
+
+def select_transactions(transaction_types: List[int] = None) -> Transactions:
+    """The default transactions, only the ones of transaction_types if given"""
+    transactions = default_transactions()
+    if transaction_types is None:
+        return transactions
+    transaction_types = check_transaction_types(transaction_types)
+    return replace(transactions, **{field.name: None for field in fields(transactions)
+                                    if getattr(transactions, field.name).transaction_type not in transaction_types})
+
+
+def generate_report(end_date_of_a_month_np=None, batch_size=None, use_cache=None, refresh=False, annex_only=False,
+                    append=False, db_config=DB_CONFIG, output_root=None, taxpayer: Taxpayer = None, force=False,
+                    transaction_types: List[int] = None, exports: List[str] = None, parallel_books: bool = None,
+                    query_strategy: str = None) -> dict:
+    """
+    Fetches, transforms and writes the reports of the B.S. month ending at end_date_of_a_month_np
+    (previous month by default) into sheets/<FY>/<month> of output_root (working directory by default).
+    Returns the written files.
+    The database is the one of db_config, the sheet headers carry the PAN and name of taxpayer.
+    With annex_only only transactions_above_1L.xls is built from the PAN totals of the server.
+    With append the bills entered since the last run are added to the books already in the month folder
+    (see reportmanifest), e.g. for a daily preview of the current month.
+    Without append the reports of a month whose records and templates are unchanged since they were
+    written are left as they are, force rewrites them anyway.
+    Only the books of transaction_types are written if given, the annex then only has their PANs.
+    The books and the annex are exported as csv and/or parquet next to them if exports names the formats
+    (the exports of the output section of db_config by default).
+    With parallel_books the books are written on a worker process each (parallel_books of the output section
+    of db_config by default).
+    query_strategy picks how the rows are fetched, grouped or two-phase (see masterquery), the strategy of the
+    query section of db_config by default.
+    """
+    from bs_ad_date_helpers import reporting_period
+    from filehandlers import TransactionFileHandler
+    from reportwriters import check_exports
+    transactions = select_transactions(transaction_types)
+    output_config = DBConnection.get_config(db_config).get('output', {})
+    exports = check_exports(output_config.get('exports', []) if exports is None else exports)
+    if parallel_books is None:
+        parallel_books = output_config.get('parallel_books', False)
+    if query_strategy is not None:
+        check_query_strategy(query_strategy)
+    period = reporting_period(end_date_of_a_month_np)
+    start_date_ad, end_date_ad = period.start_date_ad, period.end_date_ad
+
+    logger.info(f"#### Fetching transactions for {period.start_date_bs} to {period.end_date_bs} ({period.month_name}) ####")
+
+    # stage timings go to run_report.json in the month folder
+    with instrumentation.run() as run:
+        # books are kept until it is known whether they have to be rewritten
+        trans_file = TransactionFileHandler(period.month_name, period.end_date_np, annex_only,
+                                            keep_books=not annex_only and (append or not force),
+                                            output_root=output_root, taxpayer=taxpayer,
+                                            books=[transaction.transaction_name for transaction in transactions])
+        run.folder = trans_file.saveD
+
+        if annex_only:
+            main_annex_only(transactions, trans_file, start_date_ad, end_date_ad, db_config, exports)
+        else:
+            main(transactions, trans_file, start_date_ad, end_date_ad, batch_size, use_cache, refresh, append,
+                 db_config, force, exports, parallel_books, query_strategy)
+    return trans_file.files
+
+
+if __name__ == '__main__':
 
-    main(transactions)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate the VAT reports of the previous B.S. month')
+    parser.add_argument('--annex-only', action='store_true', help='only build transactions_above_1L.xls')
+    parser.add_argument('--append', action='store_true',
+                        help='only add the bills entered since the last run to the books of the month')
+    parser.add_argument('--current-month', action='store_true', help='report the current month so far, e.g. with --append daily')
+    parser.add_argument('--force', action='store_true', help='rewrite the reports even if their records are unchanged')
+    parser.add_argument('--refresh', action='store_true',
+                        help='fetch the whole month into the local cache again, e.g. after older bills were corrected')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=None,
+                        help='query the database directly, the local cache is neither read nor updated')
+    parser.add_argument('--export', nargs='+', metavar='FORMAT',
+                        help='also export the books and the annex as csv and/or parquet')
+    parser.add_argument('--parallel-books', action='store_true', default=None,
+                        help='write the sales and purchase books on a worker process each')
+    parser.add_argument('--query-strategy', choices=QUERY_STRATEGIES,
+                        help='fetch the rows with the grouped master query or in two phases (see masterquery)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log whole frames instead of their head and tail')
+    args = parser.parse_args()
+    if args.export:
+        from reportwriters import check_exports
+        try:
+            check_exports(args.export)
+        except (ValueError, ImportError) as e:  # before the month is fetched
+            parser.error(str(e))
+
+    if args.verbose:
+        show_full_frames()
+    from bs_ad_date_helpers import get_end_date_of_current_month
+    generate_report(get_end_date_of_current_month() if args.current_month else None,
+                    use_cache=args.use_cache, refresh=args.refresh, annex_only=args.annex_only, append=args.append,
+                    force=args.force, exports=args.export,
+                    parallel_books=args.parallel_books, query_strategy=args.query_strategy)
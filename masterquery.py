@@ -0,0 +1,51 @@
+"""
+Fetching the rows of the master query, in one of two ways (the strategy of the query section of db_config):
+
+    grouped     MASTER_QUERY, the items are aggregated on the server grouping on every selected column
+    two-phase   the bill headers (HEADER_QUERY) and the item aggregates keyed by Transaction ID alone
+                (ITEM_AGGREGATE_QUERY), hash joined on the client
+
+Either way the rows come in the layout and order of the master query, by Transaction Date and then Transaction ID:
+the two-phase join keeps the order of the bill headers.
+"""
+from typing import Sequence
+
+from queries import build_master_query, build_two_phase_queries
+
+QUERY_STRATEGIES = ('grouped', 'two-phase')
+DEFAULT_QUERY_STRATEGY = 'grouped'
+
+
+def check_query_strategy(strategy: str) -> str:
+    if strategy not in QUERY_STRATEGIES:
+        raise ValueError(f'Unknown query strategy {strategy}, choose from {list(QUERY_STRATEGIES)}')
+    return strategy
+
+
+def query_strategy(config: dict) -> str:
+    """The query strategy of a db config"""
+    return check_query_strategy(config.get('query', {}).get('strategy', DEFAULT_QUERY_STRATEGY))
+
+
+def master_query_batches(db, transaction_types: Sequence[int], params: list, strategy: str = DEFAULT_QUERY_STRATEGY,
+                         delta: bool = False, after: bool = False, batch_size=None):
+    """
+    Yields the rows of the master query in lists of at most batch_size rows,
+    params and delta/after as of build_master_query
+    """
+    if check_query_strategy(strategy) == 'grouped':
+        yield from db.query_batches(build_master_query(transaction_types, delta, after), params, batch_size)
+        return
+
+    header_sql, items_sql = build_two_phase_queries(transaction_types, delta, after)
+    # the item aggregates are the build side, narrow rows of the bills of the month
+    items = {transaction_id: item for transaction_id, *item in db.query(items_sql, params)}
+    for headers in db.query_batches(header_sql, params, batch_size):
+        rows = []
+        for header in headers:
+            item = items.get(header[2])
+            if item is not None:  # bills without items aren't in the master query either
+                # Item, In, Out after the Vat Pan No, the item sums of the amounts before the Transaction Type
+                rows.append((*header[:6], *item[:3], *header[6:9], *item[3:], header[9]))
+        if rows:
+            yield rows
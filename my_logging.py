@@ -1,26 +1,125 @@
+import atexit
 import logging
 import logging.config
-import yaml
+import logging.handlers
 import os
+import queue
+import threading
 
 DEFAULT_LEVEL = logging.DEBUG
 
+_configured = set()  # config paths already applied in this process
+_lock = threading.Lock()
+_listener = None  # writes the records queued by the root logger
+
 
 def log_setup(log_cfg_path: str = 'logger_config.yaml') -> None:
     """
-    Initialize custom logging configuration
+    Initialize custom logging configuration, once per process
+    (every module calls it on import)
+    """
+    with _lock:
+        if log_cfg_path in _configured:
+            return
+        _configured.add(log_cfg_path)
+        if os.path.exists(log_cfg_path):
+            import yaml
+            with open(log_cfg_path, 'rt') as cfg_file:
+                try:
+                    config = yaml.safe_load(cfg_file.read())
+                    logging.config.dictConfig(config)
+                except yaml.YAMLError as exc:
+                    print(exc)
+                except Exception as exc:
+                    print('Error loading configuration; Using default configuration')
+                    logging.basicConfig(level=DEFAULT_LEVEL)
+        else:
+            logging.basicConfig(level=DEFAULT_LEVEL)
+            print('==== Config file for logging not found =====')
+            logging.info('Using default configuration')
+        frames = logging.getLogger(FRAMES_LOGGER)
+        if frames.level == logging.NOTSET:  # not set by the config file
+            frames.setLevel(logging.DEBUG if os.environ.get(FULL_FRAMES_ENV) else logging.INFO)
+        queue_root_handlers()
+
+
+def queue_root_handlers():
+    """
+    Puts the handlers of the root logger behind a queue, so logging calls only enqueue the record
+    and the console and file writes happen on a listener thread
+    """
+    global _listener
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers if not isinstance(handler, logging.handlers.QueueHandler)]
+    if not handlers:
+        return
+    if _listener is not None:
+        _listener.stop()
+        handlers += list(_listener.handlers)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener():
+    """A forked child has the queue but not the listener thread of its parent"""
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+    # worker processes of multiprocessing end with os._exit, atexit handlers don't run there
+    from multiprocessing import util
+    util.Finalize(None, stop_listener, exitpriority=-100)
+
+
+def stop_listener():
+    """Writes out the queued records, on exit"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+atexit.register(stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+FRAMES_LOGGER = 'frames'  # full DataFrame dumps, see log_frame
+FULL_FRAMES_ENV = 'REPORT_FULL_FRAMES'
+SUMMARY_ROWS = 5  # head and tail rows of a frame summary
+
+
+def show_full_frames():
+    """Logs whole frames too, in this process and the ones it starts"""
+    os.environ[FULL_FRAMES_ENV] = '1'
+    logging.getLogger(FRAMES_LOGGER).setLevel(logging.DEBUG)
+
+
+def summarize(df, title: str, totals=(), rows: int = SUMMARY_ROWS) -> str:
+    """Title, head and tail rows, row count and the sums of the totals columns of a frame"""
+    lines = [f'{title} ({len(df)} rows)']
+    if len(df):
+        lines.append(df.to_string(max_rows=2 * rows, min_rows=2 * rows))
+    sums = ', '.join(f'{column}: {df[column].sum():,.2f}' for column in totals if column in df)
+    if sums:
+        lines.append(f'Total {sums}')
+    return '\n'.join(lines)
+
+
+def log_frame(logger: logging.Logger, df, title: str, totals=()):
+    """
+    Logs the summary of a frame at INFO, the whole frame goes to the frames logger at DEBUG
+    (enabled by show_full_frames or a frames logger in logger_config.yaml)
     """
-    if os.path.exists(log_cfg_path):
-        with open(log_cfg_path, 'rt') as cfg_file:
-            try:
-                config = yaml.safe_load(cfg_file.read())
-                logging.config.dictConfig(config)
-            except yaml.YAMLError as exc:
-                print(exc)
-            except Exception as exc:
-                print('Error loading configuration; Using default configuration')
-                logging.basicConfig(level=DEFAULT_LEVEL)
-    else:
-        logging.basicConfig(level=DEFAULT_LEVEL)
-        print('==== Config file for logging not found =====')
-        logging.info('Using default configuration')
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(summarize(df, title, totals))
+    frames = logging.getLogger(FRAMES_LOGGER)
+    if frames.isEnabledFor(logging.DEBUG):
+        frames.debug(f'{title}\n{df.to_string()}')
@@ -0,0 +1,138 @@
+"""
+Fiscal year wide index of the Taxable and Total sums per PAN and transaction type.
+The one lakh threshold of the annex is cumulative over the fiscal year, every generated month
+stores its per PAN totals here so the running sums up to a month are known without
+re-reading the earlier months. Re-running a month replaces what it stored before.
+"""
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+
+from bs_ad_date_helpers import get_months_of_fiscal_year_np
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_FILE = Path('.cache') / 'pan_index.sqlite'
+
+# month is the B.S. 'YYYY-MM' of the month, which sorts in fiscal year order within a fiscal year
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pan_totals (
+        fiscal_year TEXT NOT NULL,
+        month TEXT NOT NULL,
+        transaction_type INTEGER NOT NULL,
+        pan INTEGER NOT NULL,
+        name TEXT,
+        taxable INTEGER NOT NULL,  -- paisa
+        total INTEGER NOT NULL,
+        PRIMARY KEY (fiscal_year, transaction_type, pan, month)
+    );
+    CREATE TABLE IF NOT EXISTS indexed_months (
+        fiscal_year TEXT NOT NULL,
+        month TEXT NOT NULL,
+        transaction_type INTEGER NOT NULL,
+        PRIMARY KEY (fiscal_year, month, transaction_type)
+    );
+    """
+
+# running sums up to and including a month, kept when they crossed the threshold in that month.
+# The name is the one of the earliest month of the PAN (SQLite takes bare columns from the MIN row)
+CROSSINGS_QUERY = """
+    SELECT transaction_type, pan, name, MIN(month),
+        SUM(taxable), SUM(total),
+        SUM(CASE WHEN month = :month THEN total ELSE 0 END) as month_total
+    FROM pan_totals
+    WHERE fiscal_year = :fiscal_year AND month <= :month AND transaction_type = :transaction_type
+    GROUP BY transaction_type, pan
+    HAVING SUM(total) > :threshold
+    AND SUM(CASE WHEN month < :month THEN total ELSE 0 END) <= :threshold
+    ORDER BY pan
+    """
+
+
+class PANIndex:
+
+    def __init__(self, index_file: Path = None) -> None:
+        self.index_file = Path(index_file or DEFAULT_INDEX_FILE)
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        # concurrent batch processes wait on each others writes instead of failing
+        self.conn = sqlite3.connect(self.index_file, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction taking the write lock of the index at once, so runs of other months wait until
+        this one has updated the index and read its crossings. Nested ones are part of the outer one
+        """
+        if self.conn.in_transaction:
+            yield
+            return
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def update(self, fiscal_year: str, month: str, PAN_totals: Dict[int, pd.DataFrame]):
+        """
+        Stores the per PAN totals of a month, {transaction_type: DataFrame of
+        'PAN No', 'Bill Receiveable Person', 'Taxable' and 'Total' (paisa)} as returned by aggregate_PAN_customers
+        """
+        with self.transaction():
+            for transaction_type, df in PAN_totals.items():
+                self.conn.execute('DELETE FROM pan_totals WHERE fiscal_year = ? AND month = ? AND transaction_type = ?',
+                                  [fiscal_year, month, transaction_type])
+                self.conn.executemany(
+                    'INSERT INTO pan_totals VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(fiscal_year, month, transaction_type, int(PAN_no), name, int(taxable), int(total))
+                     for PAN_no, name, taxable, total
+                     in df[['PAN No', 'Bill Receiveable Person', 'Taxable', 'Total']].itertuples(index=False, name=None)])
+                self.conn.execute('INSERT OR IGNORE INTO indexed_months VALUES (?, ?, ?)', [fiscal_year, month, transaction_type])
+        logger.debug(f'Indexed PAN totals of {month} ({fiscal_year})')
+
+    def indexed_months(self, fiscal_year: str) -> Dict[str, List[int]]:
+        """{month: indexed transaction types} of a fiscal year, in fiscal year order"""
+        months = {}
+        for month, transaction_type in self.conn.execute(
+                'SELECT month, transaction_type FROM indexed_months WHERE fiscal_year = ? ORDER BY month, transaction_type',
+                [fiscal_year]):
+            months.setdefault(month, []).append(transaction_type)
+        return months
+
+    def missing_months(self, fiscal_year: str, month: str, transaction_type: int) -> List[str]:
+        """Earlier months of the fiscal year that were never indexed, their sums are missing from the running totals"""
+        indexed = {row[0] for row in self.conn.execute(
+            'SELECT month FROM indexed_months WHERE fiscal_year = ? AND transaction_type = ?', [fiscal_year, transaction_type])}
+        months = [f'{year}-{month_no:02}' for year, month_no in get_months_of_fiscal_year_np(fiscal_year)]
+        return [earlier for earlier in months if earlier < month and earlier not in indexed]
+
+    def crossings(self, fiscal_year: str, month: str, transaction_type: int, threshold) -> pd.DataFrame:
+        """
+        PANs whose running Total went above threshold in month, with their running Taxable and Total
+        sums of the fiscal year up to that month. The threshold and the sums are in paisa.
+        Only indexed months are summed, see missing_months
+        """
+        rows = self.conn.execute(CROSSINGS_QUERY, {'fiscal_year': fiscal_year, 'month': month,
+                                                   'transaction_type': transaction_type, 'threshold': threshold}).fetchall()
+        return pd.DataFrame([row[1:3] + row[4:] for row in rows],
+                            columns=['PAN No', 'Bill Receiveable Person', 'Taxable', 'Total', 'Month Total']) \
+            .astype({'Taxable': 'Int64', 'Total': 'Int64', 'Month Total': 'Int64'})
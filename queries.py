@@ -0,0 +1,228 @@
+"""
+SQL statements used to extract the VAT billing reports from VatBillingSoftware
+"""
+from typing import Sequence
+
+
+# Transaction types are injected as a list of placeholders, see build_master_query.
+# Bill Date is converted to B.S. on the client (bs_ad_date_helpers.ad_to_bs_strings)
+# instead of joining SystemCalenderDate.
+# The item sums of the amounts are only read by the reconciliation (see reconciliation.py)
+MASTER_QUERY = """
+    SELECT [Transaction Date]
+        ,[Bill Date]
+        ,sysTran.[Transaction ID]
+        ,[Reference No]
+        ,[Bill Receiveable Person]
+        ,accProfInfo.[Vat Pan No]
+        ,STRING_AGG([Inventory Name], '/') as 'Item'
+        ,SUM([Item In]) as 'In'
+        ,SUM([Item Out]) as 'Out'
+        ,amtTran.[Grand Total]
+        ,amtTran.[Taxable Amount]
+        ,amtTran.[Tax Amount]
+        ,SUM(psiTran.[VATABLE AMOUNT]) as 'Item Taxable'
+        ,SUM(psiTran.[VAT AMOUNT]) as 'Item VAT'
+        ,sysTran.[Transaction Type]
+    FROM [VatBillingSoftware].[dbo].[SystemTransaction] sysTran
+    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesAmount] amtTran
+    ,[VatBillingSoftware].[dbo].[AccountProfileProduct] accProfInfo
+    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesItem] psiTran
+    ,[VatBillingSoftware].[dbo].[InventoryItem]
+    WHERE sysTran.[Transaction Type] IN ({transaction_types})
+    AND [Transaction Date] BETWEEN ? AND ?{delta_filter}
+    AND sysTran.[Transaction ID] = amtTran.[Transaction ID]
+    AND sysTran.Status != '001-03'
+    AND amtTran.[Account ID] = accProfInfo.[ACCOUNT ID]
+    AND [Inventory Item Code] = [Inventory ID]
+    AND psiTran.[Transaction ID] = sysTran.[Transaction ID]
+    GROUP BY [Transaction Date], [Bill Date], sysTran.[Transaction ID]
+        ,psiTran.[Transaction ID]
+        ,sysTran.[Transaction Type]
+        ,[Bill Receiveable Person]
+        ,accProfInfo.[Vat Pan No]
+        ,amtTran.[Grand Total]
+        ,amtTran.[Taxable Amount]
+        ,amtTran.[Tax Amount]
+        ,[Reference No]
+    ORDER BY [Transaction Date], sysTran.[Transaction ID]
+    """
+
+
+def placeholders(count: int) -> str:
+    """Returns `count` comma separated qmark placeholders for an IN (...) clause"""
+    if count < 1:
+        raise ValueError('At least one placeholder is required')
+    return ', '.join('?' * count)
+
+
+# Rows changed since a sync: dated on or after a date or entered after a Transaction ID
+DELTA_FILTER = """
+    AND ([Transaction Date] >= ? OR sysTran.[Transaction ID] > ?)"""
+
+# Rows entered after a Transaction ID, the bills not yet appended to a report
+AFTER_FILTER = """
+    AND sysTran.[Transaction ID] > ?"""
+
+
+def build_master_query(transaction_types: Sequence[int], delta: bool = False, after: bool = False) -> str:
+    """
+    Returns the master query filtering on every given transaction type at once.
+    The transaction type is selected as the last column so rows can be split on the client.
+    Parameters are expected in the order: *transaction_types, start_date, end_date
+    followed by since_date, after_transaction_id for a delta query or after_transaction_id with after
+    """
+    if delta and after:
+        raise ValueError('A master query is either a delta or an after query')
+    return MASTER_QUERY.format(transaction_types=placeholders(len(transaction_types)),
+                               delta_filter=DELTA_FILTER if delta else AFTER_FILTER if after else '')
+
+
+# The master query in two phases (see masterquery.py): the bill headers, one row per bill without grouping,
+# and the item aggregates keyed by Transaction ID alone, joined on the client.
+# Both take the parameters of the master query and select the same bills.
+HEADER_QUERY = """
+    SELECT [Transaction Date]
+        ,[Bill Date]
+        ,sysTran.[Transaction ID]
+        ,[Reference No]
+        ,[Bill Receiveable Person]
+        ,accProfInfo.[Vat Pan No]
+        ,amtTran.[Grand Total]
+        ,amtTran.[Taxable Amount]
+        ,amtTran.[Tax Amount]
+        ,sysTran.[Transaction Type]
+    FROM [VatBillingSoftware].[dbo].[SystemTransaction] sysTran
+    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesAmount] amtTran
+    ,[VatBillingSoftware].[dbo].[AccountProfileProduct] accProfInfo
+    WHERE sysTran.[Transaction Type] IN ({transaction_types})
+    AND [Transaction Date] BETWEEN ? AND ?{delta_filter}
+    AND sysTran.[Transaction ID] = amtTran.[Transaction ID]
+    AND sysTran.Status != '001-03'
+    AND amtTran.[Account ID] = accProfInfo.[ACCOUNT ID]
+    ORDER BY [Transaction Date], sysTran.[Transaction ID]
+    """
+
+ITEM_AGGREGATE_QUERY = """
+    SELECT psiTran.[Transaction ID]
+        ,STRING_AGG([Inventory Name], '/') as 'Item'
+        ,SUM([Item In]) as 'In'
+        ,SUM([Item Out]) as 'Out'
+        ,SUM(psiTran.[VATABLE AMOUNT]) as 'Item Taxable'
+        ,SUM(psiTran.[VAT AMOUNT]) as 'Item VAT'
+    FROM [VatBillingSoftware].[dbo].[SystemTransaction] sysTran
+    ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesItem] psiTran
+    ,[VatBillingSoftware].[dbo].[InventoryItem]
+    WHERE sysTran.[Transaction Type] IN ({transaction_types})
+    AND [Transaction Date] BETWEEN ? AND ?{delta_filter}
+    AND sysTran.Status != '001-03'
+    AND psiTran.[Transaction ID] = sysTran.[Transaction ID]
+    AND [Inventory Item Code] = [Inventory ID]
+    GROUP BY psiTran.[Transaction ID]
+    """
+
+
+def build_two_phase_queries(transaction_types: Sequence[int], delta: bool = False, after: bool = False) -> tuple:
+    """Returns (header query, item aggregate query), parameters as of build_master_query"""
+    if delta and after:
+        raise ValueError('A master query is either a delta or an after query')
+    delta_filter = DELTA_FILTER if delta else AFTER_FILTER if after else ''
+    return tuple(query.format(transaction_types=placeholders(len(transaction_types)), delta_filter=delta_filter)
+                 for query in (HEADER_QUERY, ITEM_AGGREGATE_QUERY))
+
+
+# Per PAN totals of the annex of transactions above one lakh, aggregated on the server.
+# Bills are the ones of the master query (each counted once, however many items it has),
+# the name is the one of the earliest bill like the first of the pandas groupby
+PAN_SUMMARY_QUERY = """
+    WITH bills AS (
+        SELECT sysTran.[Transaction Type]
+            ,accProfInfo.[Vat Pan No]
+            ,[Bill Receiveable Person]
+            ,amtTran.[Taxable Amount]
+            ,amtTran.[Grand Total]
+            ,ROW_NUMBER() OVER (PARTITION BY sysTran.[Transaction Type], accProfInfo.[Vat Pan No]
+                                ORDER BY [Transaction Date], sysTran.[Transaction ID]) as 'Bill No'
+        FROM [VatBillingSoftware].[dbo].[SystemTransaction] sysTran
+        ,[VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesAmount] amtTran
+        ,[VatBillingSoftware].[dbo].[AccountProfileProduct] accProfInfo
+        WHERE sysTran.[Transaction Type] IN ({transaction_types})
+        AND [Transaction Date] BETWEEN ? AND ?
+        AND sysTran.[Transaction ID] = amtTran.[Transaction ID]
+        AND sysTran.Status != '001-03'
+        AND amtTran.[Account ID] = accProfInfo.[ACCOUNT ID]
+        AND accProfInfo.[Vat Pan No] != ''
+        AND EXISTS (
+            SELECT 1
+            FROM [VatBillingSoftware].[dbo].[SystemTransactionPurchaseSalesItem] psiTran
+            ,[VatBillingSoftware].[dbo].[InventoryItem]
+            WHERE psiTran.[Transaction ID] = sysTran.[Transaction ID]
+            AND [Inventory Item Code] = [Inventory ID]
+        )
+    )
+    SELECT [Vat Pan No]
+        ,MAX(CASE WHEN [Bill No] = 1 THEN [Bill Receiveable Person] END) as 'Bill Receiveable Person'
+        ,SUM([Taxable Amount]) as 'Taxable'
+        ,SUM([Grand Total]) as 'Total'
+        ,[Transaction Type]
+    FROM bills
+    GROUP BY [Transaction Type], [Vat Pan No]{having}
+    """
+
+PAN_SUMMARY_HAVING = """
+    HAVING SUM([Grand Total]) > ?"""
+
+
+def build_PAN_summary_query(transaction_types: Sequence[int], above_threshold: bool = True) -> str:
+    """
+    Returns the per PAN and transaction type totals, only the ones above a threshold by default.
+    Parameters: *transaction_types, start_date, end_date followed by threshold with above_threshold
+    """
+    return PAN_SUMMARY_QUERY.format(transaction_types=placeholders(len(transaction_types)),
+                                    having=PAN_SUMMARY_HAVING if above_threshold else '')
+
+
+VOIDED_TRANSACTIONS_QUERY = """
+    SELECT [Transaction ID]
+    FROM [VatBillingSoftware].[dbo].[SystemTransaction]
+    WHERE [Transaction Type] IN ({transaction_types})
+    AND [Transaction Date] BETWEEN ? AND ?
+    AND Status = '001-03'
+    """
+
+
+def build_voided_transactions_query(transaction_types: Sequence[int]) -> str:
+    """Returns the IDs of voided transactions, parameters: *transaction_types, start_date, end_date"""
+    return VOIDED_TRANSACTIONS_QUERY.format(transaction_types=placeholders(len(transaction_types)))
+
+
+# Queries of the item wise extraction in zzz.py, all take [start_date, end_date, transaction_type]
+SYSTEM_TRANSACTION_QUERY = """
+    SELECT [Transaction ID], [Transaction Type], [Transaction Date], [Bill Date], [Transaction Amount], [Bill Receiveable Person]
+    FROM VatBillingSoftware.dbo.SystemTransaction
+    WHERE [Transaction Date] >= ? AND [Transaction Date] <= ? AND [Transaction Type] = ?
+    """
+
+TRANSACTION_ITEMS_QUERY = """
+    SELECT [Transaction ID], [Inventory Item Code], [Item In], [Item Out], [ACCOUNT ID], [VATABLE AMOUNT], [VAT AMOUNT]
+    FROM VatBillingSoftware.dbo.SystemTransactionPurchaseSalesItem
+    WHERE [Transaction ID] IN (
+        SELECT [Transaction ID]
+        FROM VatBillingSoftware.dbo.SystemTransaction
+        WHERE [Transaction Date] >= ? AND [Transaction Date] <= ? AND [Transaction Type] = ?
+    )
+    """
+
+ACCOUNT_PAN_QUERY = """
+    SELECT [ACCOUNT ID], [Vat Pan No]
+    FROM VatBillingSoftware.dbo.AccountProfileProduct
+    WHERE [ACCOUNT ID] IN (
+        SELECT [ACCOUNT ID]
+        FROM VatBillingSoftware.dbo.SystemTransactionPurchaseSalesItem
+        WHERE [Transaction ID] IN (
+            SELECT [Transaction ID]
+            FROM VatBillingSoftware.dbo.SystemTransaction
+            WHERE [Transaction Date] >= ? AND [Transaction Date] <= ? AND [Transaction Type] = ?
+        )
+    )
+    """
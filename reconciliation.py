@@ -0,0 +1,238 @@
+"""
+Reconciliation of the bills of a month.
+The checks run vectorized over a frame of bills (a batch or the whole month) and yield one exception row
+per failing bill and check, written to the Exceptions sheet of reconciliation - <month>.xlsx next to the books.
+A report path passes the columns it has in the layout below, checks needing other columns are skipped.
+
+    Transaction Type, Transaction ID, Transaction Date, Bill Date (AD datetime64), Reference No,
+    Bill Receiveable Person, PAN (Vat Pan No as fetched), Grand Total, Taxable, VAT (of the bill header),
+    Item Taxable, Item VAT (sums of its items)
+
+The amounts are integer paisa (reportrows.to_paisa), so the checks compare them exactly.
+"""
+import re
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from bs_ad_date_helpers import ReportingPeriod, ad_to_bs_strings
+from reportrows import PAISA
+from reportwriters import XlsxRowWriter
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+RECONCILIATION_FILE = 'reconciliation - {month}.xlsx'
+EXCEPTIONS_SHEET = 'Exceptions'
+EXCEPTION_COLUMNS = ['Check', 'Transaction Type', 'Transaction ID', 'Reference No', 'Transaction Date', 'Bill Date',
+                     'Bill Receiveable Person', 'PAN', 'Expected', 'Actual', 'Difference', 'Detail']
+
+VAT_PERCENT = 13
+AMOUNT_TOLERANCE = 1  # paisa, sums of amounts
+VAT_TOLERANCE = 5  # paisa, VAT is rounded per item
+PAN_RE = re.compile(r'\d{9}')
+# Reference No of a purchase is the invoice number of the supplier, only unique per supplier
+PARTY_REFERENCE_TYPES = (1,)
+# columns kept from every batch to find duplicate reference numbers across the month
+REFERENCE_COLUMNS = ['Transaction Type', 'Transaction ID', 'Reference No', 'Transaction Date', 'Bill Date',
+                     'Bill Receiveable Person', 'PAN']
+
+
+def from_report_rows(records: pd.DataFrame) -> pd.DataFrame:
+    """Reconciliation layout of typed master query rows (reportrows.rows_to_frame)"""
+    return pd.DataFrame({
+        'Transaction Type': records['Transaction Type'].to_numpy(),
+        'Transaction ID': records['Transaction ID'].to_numpy(),
+        'Transaction Date': records['Date AD'].to_numpy(),
+        'Bill Date': records['Date'].to_numpy(),
+        'Reference No': records['PurchaseInvoiceNo'].to_numpy(),
+        'Bill Receiveable Person': records['Bill Receiveable Person'].array,
+        'PAN': records['Vat Pan No'].array,
+        'Grand Total': records['Total'].array,
+        'Taxable': records['Taxable'].array,
+        'VAT': records['VAT'].array,
+        'Item Taxable': records['Item Taxable'].array,
+        'Item VAT': records['Item VAT'].array,
+    })
+
+
+def exception_rows(bills: pd.DataFrame, mask: np.ndarray, check: str, detail, expected=None, actual=None,
+                   period: ReportingPeriod = None) -> pd.DataFrame:
+    """
+    Exceptions of the bills selected by mask, the amounts are arrays of all bills, detail one of the selected ones.
+    The dates are in B.S., the ones in the range of period as days of its month like in the books
+    """
+    rows = bills[mask]
+    count = len(rows)
+    exceptions = {'Check': np.full(count, check, dtype=object)}
+    for column in ['Transaction Type', 'Transaction ID', 'Reference No', 'Bill Receiveable Person', 'PAN']:
+        exceptions[column] = rows[column].to_numpy(object) if column in rows else None
+    for column in ['Transaction Date', 'Bill Date']:
+        exceptions[column] = ad_to_bs_strings(rows[column].to_numpy('datetime64[D]'), zero_pad=False, period=period) \
+            if column in rows else None
+    if expected is not None:  # paisa, written in rupees
+        exceptions['Expected'] = expected[mask] / PAISA
+        exceptions['Actual'] = actual[mask] / PAISA
+        exceptions['Difference'] = (actual[mask] - expected[mask]) / PAISA
+    exceptions['Detail'] = detail
+    return pd.DataFrame(exceptions, columns=EXCEPTION_COLUMNS)
+
+
+def amount_checks(bills: pd.DataFrame) -> list:
+    """(check, expected, actual, tolerance, detail) of the amounts the bills have"""
+    def has(*columns):
+        return all(column in bills for column in columns)
+
+    def amounts(column):
+        # whole paisa are exact in float64, which has NaN for the missing ones
+        return bills[column].to_numpy(np.float64, na_value=np.nan)
+
+    checks = []
+    if has('Grand Total', 'Taxable', 'VAT'):
+        checks.append(('Grand Total', amounts('Taxable') + amounts('VAT'), amounts('Grand Total'), AMOUNT_TOLERANCE,
+                       'Grand Total is not Taxable + VAT'))
+    if has('Taxable', 'Item Taxable'):
+        checks.append(('Item Taxable', amounts('Item Taxable'), amounts('Taxable'), AMOUNT_TOLERANCE,
+                       'Taxable Amount is not the sum of the items'))
+    if has('VAT', 'Item VAT'):
+        checks.append(('Item VAT', amounts('Item VAT'), amounts('VAT'), AMOUNT_TOLERANCE,
+                       'Tax Amount is not the sum of the items'))
+    if not has('Taxable') and has('Grand Total', 'Item Taxable', 'Item VAT'):
+        checks.append(('Item Total', amounts('Item Taxable') + amounts('Item VAT'), amounts('Grand Total'), AMOUNT_TOLERANCE,
+                       'Grand Total is not the sum of the items'))
+    taxable, vat = ('Taxable', 'VAT') if has('Taxable', 'VAT') else ('Item Taxable', 'Item VAT')
+    if has(taxable, vat):
+        checks.append(('VAT Rate', np.round(amounts(taxable) * VAT_PERCENT / 100), amounts(vat), VAT_TOLERANCE,
+                       f'VAT is not {VAT_PERCENT}% of Taxable'))
+    return checks
+
+
+def malformed_PANs(values) -> np.ndarray:
+    """Mask of the PANs given that are not 9 digits, blank and 0 ones are no PAN"""
+    # each distinct value is checked once, there are far fewer accounts than bills
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    text = [str(value).strip() for value in uniques]
+    malformed = np.array([value not in ('', '0') and PAN_RE.fullmatch(value) is None for value in text] + [False])
+    return malformed[codes]  # code -1 of missing values is the trailing False
+
+
+def check_bills(bills: pd.DataFrame, period: ReportingPeriod = None) -> pd.DataFrame:
+    """Exceptions of the checks of single bills: amounts, VAT rate, Bill Date and PAN"""
+    exceptions = []
+    for check, expected, actual, tolerance, detail in amount_checks(bills):
+        mask = ~(np.abs(actual - expected) <= tolerance)  # missing amounts too
+        if mask.any():
+            exceptions.append(exception_rows(bills, mask, check, detail, expected, actual, period))
+
+    undated = np.zeros(len(bills), dtype=bool)
+    if 'Bill Date' in bills:
+        # bills whose Bill Date has no B.S. date are left out of the books
+        bill_dates = bills['Bill Date'].to_numpy('datetime64[D]')
+        undated = pd.isna(ad_to_bs_strings(bill_dates, period=period))
+        if undated.any():
+            detail = ['Bill Date is missing' if np.isnat(date) else f'Bill Date {date} has no B.S. date'
+                      for date in bill_dates[undated]]
+            exceptions.append(exception_rows(bills, undated, 'Bill Date', detail, period=period))
+
+    if 'Transaction Date' in bills and 'Bill Date' in bills:
+        days = (bills['Bill Date'].to_numpy('datetime64[D]') - bills['Transaction Date'].to_numpy('datetime64[D]')).astype(np.int64)
+        mask = (days != 0) & ~undated
+        if mask.any():
+            detail = [f'Bill Date is {abs(day)} day{"s" if abs(day) > 1 else ""} {"after" if day > 0 else "before"} Transaction Date'
+                      for day in days[mask]]
+            exceptions.append(exception_rows(bills, mask, 'Bill Date', detail, period=period))
+
+    if 'PAN' in bills:
+        mask = malformed_PANs(bills['PAN'])
+        if mask.any():
+            exceptions.append(exception_rows(bills, mask, 'PAN', 'PAN is not 9 digits', period=period))
+    return concat_exceptions(exceptions)
+
+
+def check_duplicate_references(bills: pd.DataFrame, period: ReportingPeriod = None) -> pd.DataFrame:
+    """Exceptions of the bills sharing a Reference No with another bill of their transaction type (and supplier)"""
+    if 'Reference No' not in bills or not len(bills):
+        return concat_exceptions([])
+    references = bills['Reference No'].to_numpy(object)
+    types = bills['Transaction Type'].to_numpy()
+    party = np.where(np.isin(types, PARTY_REFERENCE_TYPES), bills['Bill Receiveable Person'].to_numpy(object), '')
+    keys = pd.DataFrame({'type': types, 'party': party, 'reference': references})
+    counts = keys.groupby(['type', 'party', 'reference'], sort=False, dropna=False)['reference'].transform('size').to_numpy()
+    mask = (counts > 1) & pd.notna(references) & (references != '')
+    if not mask.any():
+        return concat_exceptions([])
+    detail = [f'{count} bills have this Reference No' for count in counts[mask]]
+    return exception_rows(bills, mask, 'Duplicate Reference No', detail, period=period)
+
+
+def concat_exceptions(exceptions: List[pd.DataFrame]) -> pd.DataFrame:
+    if not exceptions:
+        return pd.DataFrame(columns=EXCEPTION_COLUMNS)
+    return pd.concat(exceptions, ignore_index=True)
+
+
+class Reconciler:
+    """
+    Reconciles the bills of a month batch by batch: the checks of single bills run on every batch,
+    duplicate reference numbers are looked for across the bills of all batches in finish.
+    The dates of the bills in the range of period are written as days of its month
+    """
+
+    def __init__(self, period: ReportingPeriod = None) -> None:
+        self.period = period
+        self.bills = 0
+        self._exceptions = []
+        self._references = []
+
+    def add_batch(self, bills: pd.DataFrame):
+        self.bills += len(bills)
+        exceptions = check_bills(bills, self.period)
+        if len(exceptions):
+            self._exceptions.append(exceptions)
+        if 'Reference No' in bills:
+            self._references.append(bills[[column for column in REFERENCE_COLUMNS if column in bills]])
+
+    def finish(self) -> pd.DataFrame:
+        """Returns the exceptions of every bill added"""
+        if self._references:
+            self._exceptions.append(check_duplicate_references(pd.concat(self._references, ignore_index=True), self.period))
+            self._references = []
+        exceptions = concat_exceptions([exceptions for exceptions in self._exceptions if len(exceptions)])
+        return exceptions.sort_values(['Transaction Type', 'Check'], kind='stable', ignore_index=True)
+
+
+def reconcile(bills: pd.DataFrame) -> pd.DataFrame:
+    """Returns the exceptions of the bills of a whole month"""
+    reconciler = Reconciler()
+    reconciler.add_batch(bills)
+    return reconciler.finish()
+
+
+def log_summary(exceptions: pd.DataFrame, bills: int):
+    counts = exceptions['Check'].value_counts(sort=False)
+    summary = ', '.join(f'{check}: {count}' for check, count in counts.items()) or 'none'
+    logger.info(f'Reconciled {bills} bills, exceptions: {summary}')
+
+
+def write_exceptions(path: Path, exceptions: pd.DataFrame, append: bool = False) -> Path:
+    """
+    Writes the exceptions to the Exceptions sheet of path, a new workbook unless append
+    adds them below the ones there already
+    """
+    path = Path(path)
+    if not (append and path.exists()):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = EXCEPTIONS_SHEET
+        sheet.append(EXCEPTION_COLUMNS)
+        sheet.freeze_panes = 'A2'
+        workbook.save(path)
+    with XlsxRowWriter(path, EXCEPTIONS_SHEET) as writer:
+        writer.append_rows(exceptions.itertuples(index=False, name=None))
+    return path
@@ -0,0 +1,122 @@
+"""
+Sidecar manifest of the books written into a month folder.
+It records how far every book got (last Transaction ID and Transaction Date, the row of its Column_Total,
+running totals and PAN aggregates) so an append run only has to write the bills entered since.
+"""
+import hashlib
+import json
+import os
+from decimal import Decimal
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'report_manifest.json'
+MANIFEST_VERSION = 2  # 2: PAN totals in paisa
+
+
+def to_json(value):
+    """Transaction IDs as numpy scalars or Decimals of the driver"""
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class ContentHasher:
+    """
+    Stable hash of the record frames of a month per transaction type and the other inputs its reports are
+    rendered from (repr of each), independent of how the records were batched.
+    The frames are fed one at a time, in order, so the records of a month never have to be held.
+    """
+
+    def __init__(self, transaction_types: Iterable[int], inputs: list):
+        self.inputs = inputs
+        self.type_hashers = {transaction_type: hashlib.sha256(str(transaction_type).encode())
+                             for transaction_type in transaction_types}
+        self.rows = 0
+
+    def update(self, transaction_type: int, frame):
+        from pandas.util import hash_pandas_object
+        self.type_hashers[transaction_type].update(hash_pandas_object(frame, index=False).to_numpy().tobytes())
+        self.rows += len(frame)
+
+    def hexdigest(self) -> str:
+        hasher = hashlib.sha256()
+        for value in self.inputs:
+            hasher.update(repr(value).encode() + b'\0')
+        for _, type_hasher in sorted(self.type_hashers.items()):
+            hasher.update(type_hasher.digest())
+        return hasher.hexdigest()
+
+
+@dataclass
+class BookState:
+    """What has been written to the sheet of a transaction type"""
+    transaction_type: int
+    file: str  # name of the book within the month folder
+    sheet_name: str
+    rows: int  # invoice rows below the header rows
+    total_row: int  # 1 based row of Column_Total, replaced by the next append
+    last_transaction_id: Any  # highest Transaction ID written, None for an empty book
+    last_date: Optional[str]  # latest Transaction Date written, ISO
+    columns: List[str]
+    totals: Dict[str, str]  # exact Decimal column sums as text
+    PAN_totals: List[list]  # [PAN No, Bill Receiveable Person, Taxable, Total], amounts in paisa
+    size: int = 0  # of the book when the manifest was saved, a book changed since can't be appended to
+    mtime_ns: int = 0
+
+    def stamp(self, folder: Path):
+        stat = (folder / self.file).stat()
+        self.size, self.mtime_ns = stat.st_size, stat.st_mtime_ns
+
+    def unchanged(self, folder: Path) -> bool:
+        try:
+            stat = (folder / self.file).stat()
+        except FileNotFoundError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (self.size, self.mtime_ns)
+
+
+@dataclass
+class ReportManifest:
+    month: str  # B.S. 'YYYY-MM'
+    voided: Optional[list] = None  # voided Transaction IDs of the month when written, None when not known
+    books: Dict[int, BookState] = field(default_factory=dict)
+    version: int = MANIFEST_VERSION
+    content_hash: Optional[str] = None  # of the records and inputs of a full run, see ContentHasher
+
+    @classmethod
+    def load(cls, folder: Path) -> Optional['ReportManifest']:
+        """Returns the manifest of a month folder, None if there is none or it is unreadable"""
+        path = Path(folder) / MANIFEST_FILE
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+            if data.get('version') != MANIFEST_VERSION:
+                logger.info(f'Ignoring {path} of manifest version {data.get("version")}')
+                return None
+            books = {int(transaction_type): BookState(**book) for transaction_type, book in data['books'].items()}
+            return cls(data['month'], data['voided'], books, data['version'], data.get('content_hash'))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f'Ignoring unreadable {path}: {e}')
+            return None
+
+    def save(self, folder: Path):
+        """Writes the manifest next to the books, stamping them as they are now"""
+        folder = Path(folder)
+        for book in self.books.values():
+            book.stamp(folder)
+        path = folder / MANIFEST_FILE
+        tmp = path.with_name(path.name + f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(asdict(self), indent=1, ensure_ascii=False, default=to_json), encoding='utf-8')
+        os.replace(tmp, path)
+        logger.debug(f'Saved {path}')
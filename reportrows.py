@@ -0,0 +1,146 @@
+"""
+Typed columnar layout of the master query rows.
+A batch of cursor rows is transposed once into one typed array per column instead of being
+copied row by row into lists and fixed up afterwards.
+"""
+import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# master query columns in order and their types in a rows frame
+COLUMNS = ['Date AD', 'Date', 'Transaction ID', 'PurchaseInvoiceNo', 'Bill Receiveable Person', 'PAN No', 'Item',
+           'Item_in', 'Item_out', 'Total', 'Taxable', 'VAT', 'Item Taxable', 'Item VAT', 'Transaction Type']
+# the Vat Pan No as fetched, PAN No can't hold a malformed one
+FRAME_COLUMNS = COLUMNS + ['Vat Pan No']
+# columns only read by the reconciliation, not written to the books
+RECONCILIATION_COLUMNS = ['Item Taxable', 'Item VAT', 'Vat Pan No']
+# money is kept in exact integer paisa, it becomes float rupees only where it is written (to_rupees)
+AMOUNT_COLUMNS = ['Total', 'Taxable', 'VAT', 'Item Taxable', 'Item VAT']
+PAISA = 100  # per rupee
+DTYPES = {
+    'Date AD': 'datetime64[ns]',  # Transaction Date
+    'Date': 'datetime64[ns]',  # Bill Date, in B.S. once written (main.build_report_frame), NaT for NULL
+    'Transaction ID': 'object',
+    'PurchaseInvoiceNo': 'object',  # Reference No
+    'Bill Receiveable Person': 'category',
+    'PAN No': 'Int64',  # <NA> for customers without PAN
+    'Item': 'category',
+    'Item_in': 'float64',  # litres
+    'Item_out': 'float64',
+    'Total': 'Int64',  # paisa
+    'Taxable': 'Int64',
+    'VAT': 'Int64',
+    'Item Taxable': 'Int64',  # sums of the items
+    'Item VAT': 'Int64',
+    'Transaction Type': 'int8',
+    'Vat Pan No': 'category',
+}
+
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def to_dates(values: Sequence) -> np.ndarray:
+    """datetime64[D] of date, datetime or ISO text (TransactionCache) values, NaT for NULL"""
+    if values and isinstance(values[0], str):
+        return np.array(values, dtype='datetime64[D]')
+    # numpy parses date objects one by one through its generic path, ordinals are way faster
+    try:
+        ordinals = np.fromiter(map(datetime.date.toordinal, values), np.int64, len(values))
+    except TypeError:  # NULLs
+        return np.array(values, dtype='datetime64[D]')
+    return (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+
+
+def to_float(values: Sequence) -> np.ndarray:
+    """float64 of Decimal, numeric or numeric text values"""
+    try:
+        return np.fromiter(map(float, values), np.float64, len(values))
+    except TypeError:
+        return np.array(values, dtype=np.float64)  # NULLs to NaN
+
+
+def paisa(value) -> Optional[int]:
+    """
+    Exact paisa of a Decimal, numeric or numeric text amount, rounded half up, None for NULL and NaN.
+    Floats are taken as their shortest text, 0.1 is 10 paisa and not the binary fraction below it
+    """
+    if value is None or value is pd.NA or value != value:
+        return None
+    amount = value if isinstance(value, Decimal) else Decimal(str(value))
+    return int(amount.scaleb(2).to_integral_value(ROUND_HALF_UP))
+
+
+def to_paisa(values: Sequence) -> pd.arrays.IntegerArray:
+    """Int64 paisa of the amounts of a column, see paisa"""
+    try:
+        # Decimals of the driver are quantized one by one, numpy converts them even slower
+        if values and isinstance(values[0], Decimal):
+            raise TypeError
+        cents = np.array(values, dtype=np.float64) * PAISA
+    except (TypeError, ValueError):  # NULLs
+        return pd.array([paisa(value) for value in values], dtype='Int64')
+    # the nearest float of an amount is off by far less than half a paisa, so rounding its cents is exact,
+    # except about half a paisa off (sub-paisa amounts), beyond the integers of a float and for NaN
+    rounded = np.rint(cents)
+    inexact = ~(np.abs(cents - rounded) <= 0.49) | (np.abs(cents) >= 2 ** 52)
+    result = np.where(inexact, 0, rounded).astype(np.int64)
+    missing = np.zeros(len(result), dtype=bool)
+    for position in np.flatnonzero(inexact):
+        exact = paisa(values[position])
+        missing[position] = exact is None
+        result[position] = exact or 0
+    return pd.arrays.IntegerArray(result, missing)
+
+
+def to_rupees(amounts) -> np.ndarray:
+    """float64 rupees of paisa amounts, missing ones NaN, for the workbooks and logs"""
+    return pd.array(amounts, dtype='Int64').to_numpy(np.float64, na_value=np.nan) / PAISA
+
+
+def amounts_in_rupees(df: pd.DataFrame, columns=AMOUNT_COLUMNS) -> pd.DataFrame:
+    """Copy of a frame with its paisa columns (of columns) in float rupees"""
+    return df.assign(**{column: to_rupees(df[column]) for column in columns if column in df})
+
+
+def to_PAN(values: Sequence) -> pd.arrays.IntegerArray:
+    """Vat Pan No to nullable integers, blank, 0 and non numeric PANs are missing"""
+    values = np.array(values, dtype=object)
+    values[values == ''] = None
+    numbers = pd.to_numeric(values, errors='coerce').astype(np.float64)
+    numbers[numbers == 0] = np.nan
+    return pd.array(numbers, dtype='Int64')
+
+
+def rows_to_frame(rows: Sequence[Sequence]) -> pd.DataFrame:
+    """Frame of master query rows (e.g. a fetchmany batch) with the types of DTYPES"""
+    columns = list(zip(*rows)) or [()] * len(COLUMNS)
+    (transaction_date, bill_date, transaction_id, reference_no, person, PAN_no, item,
+     item_in, item_out, total, taxable, vat, item_taxable, item_vat, transaction_type) = columns
+    return pd.DataFrame({
+        'Date AD': to_dates(transaction_date),
+        'Date': to_dates(bill_date),
+        'Transaction ID': np.array(transaction_id, dtype=object),
+        'PurchaseInvoiceNo': np.array(reference_no, dtype=object),
+        'Bill Receiveable Person': pd.Categorical(person),
+        'PAN No': to_PAN(PAN_no),
+        'Item': pd.Categorical(item),
+        'Item_in': to_float(item_in),
+        'Item_out': to_float(item_out),
+        'Total': to_paisa(total),
+        'Taxable': to_paisa(taxable),
+        'VAT': to_paisa(vat),
+        'Item Taxable': to_paisa(item_taxable),
+        'Item VAT': to_paisa(item_vat),
+        'Transaction Type': np.fromiter(map(int, transaction_type), np.int8, len(transaction_type)),
+        'Vat Pan No': pd.Categorical(PAN_no),
+    }, columns=FRAME_COLUMNS)
+
+
+def split_by_transaction_type(frame: pd.DataFrame, transaction_types: Sequence[int]) -> Dict[int, pd.DataFrame]:
+    """Returns {transaction_type: rows of that type}"""
+    types = frame['Transaction Type'].to_numpy()
+    return {transaction_type: frame[types == transaction_type] for transaction_type in transaction_types}
@@ -0,0 +1,297 @@
+"""
+Report service, generates reports on request over HTTP on localhost.
+Its worker processes are started once and kept warm: pandas and the report modules imported, the db config
+parsed, a pooled database connection open, the calendar table loaded and the rendered templates cached,
+so an ad-hoc report only pays for its own queries and writes.
+
+    python reportservice.py --port 8765 --workers 2 --output-root D:/reports
+
+    POST /reports {"month": "2080-04", "transaction_types": [2], "output": "adhoc", "append": false}
+        runs a job and answers with its files and stage timings once it is done,
+        with "wait": false it answers at once and GET /reports/<id> tells how far it got
+    GET /reports/<id>
+    GET /health
+
+A job takes month (B.S. 'YYYY-MM', the previous month by default) or current_month, transaction_types
+(all by default), output (folder the sheets/<FY>/<month> folders go to, relative to the --output-root of the
+service, which is the working directory by default and which jobs can't write outside of),
+exports (e.g. ["csv", "parquet"]) and the append, annex_only, force and refresh options of main.generate_report. Jobs of one month folder run one
+after another. Give jobs of some transaction types their own output, their annex only has those.
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from batch import parse_month
+from bs_ad_date_helpers import get_end_date_of_current_month, get_end_date_of_month, reporting_period
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 16  # jobs accepted beyond the running ones
+KEEPALIVE_SECONDS = 60  # pooled connections of the workers are used at least this often
+MAX_FINISHED_JOBS = 1000  # finished jobs kept for GET /reports/<id>
+OPTIONS = ('append', 'annex_only', 'force', 'refresh')
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class ReportJob:
+    id: int
+    month: Tuple[int, int]  # B.S. (year, month)
+    transaction_types: Optional[List[int]] = None
+    output: str = '.'  # resolved, within the output root of the service
+    exports: Optional[List[str]] = None
+    options: dict = field(default_factory=dict)
+    status: str = 'queued'  # running, done or failed
+    submitted: float = field(default_factory=time.time)
+    seconds: Optional[float] = None  # from submission to the end, waiting included
+    files: Dict[str, str] = field(default_factory=dict)
+    stages: list = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def folder_key(self) -> tuple:
+        """Jobs of the same month folder can't run at once"""
+        period = reporting_period(get_end_date_of_month(*self.month))
+        return Path(self.output), period.fiscal_year_folder, period.month_name
+
+    def to_dict(self) -> dict:
+        job = asdict(self)
+        job['month'] = f'{self.month[0]}-{self.month[1]:02}'
+        return job
+
+
+def output_folder(output, output_root='.') -> Path:
+    """The folder of the output of a job, resolved within output_root. Raises ValueError on ones outside of it"""
+    root = Path(output_root).resolve()
+    if output is None:
+        return root
+    if not isinstance(output, str):
+        raise ValueError(f'output is a folder name, not {output!r}')
+    folder = (root / output).resolve()
+    if folder != root and root not in folder.parents:
+        raise ValueError(f'output {output} is outside of the output root {root}')
+    return folder
+
+
+def parse_job(job_id: int, request: dict, output_root='.') -> ReportJob:
+    """ReportJob of a request body, its output within output_root. Raises ValueError on invalid ones"""
+    unknown = set(request) - {'month', 'current_month', 'transaction_types', 'output', 'exports', 'wait', *OPTIONS}
+    if unknown:
+        raise ValueError(f'Unknown fields {sorted(unknown)}')
+    if request.get('current_month'):
+        end_date = get_end_date_of_current_month()
+        month = (end_date.year, end_date.month)
+    elif request.get('month'):
+        try:
+            month = parse_month(str(request['month']))
+        except ValueError:
+            raise ValueError(f'month is a B.S. month like 2080-04, not {request["month"]}') from None
+    else:
+        end_date = reporting_period().end_date_np
+        month = (end_date.year, end_date.month)
+    transaction_types = request.get('transaction_types')
+    if transaction_types is not None:
+        from main import check_transaction_types
+        transaction_types = check_transaction_types(transaction_types)
+    exports = request.get('exports')
+    if exports is not None:
+        from reportwriters import check_exports
+        exports = check_exports(exports if isinstance(exports, list) else [exports])
+    options = {option: bool(request[option]) for option in OPTIONS if option in request}
+    output = str(output_folder(request.get('output'), output_root))
+    return ReportJob(job_id, month, transaction_types, output, exports, options)
+
+
+def warm_worker(db_config: str):
+    """Initializer of the worker processes, loads what every report needs once"""
+    import openpyxl  # noqa: F401, loaded lazily by the reports
+    import main, filehandlers, panindex, reconciliation, reportrows, reportwriters  # noqa: F401, main imports them per report
+    from bs_ad_date_helpers import get_calendar_index
+    from dbconnection import DBConnection
+
+    get_calendar_index()
+    config = DBConnection.get_config(db_config)
+    try:
+        DBConnection(db_config).close()  # the connection stays in the pool of the process
+    except BaseException as e:  # SystemExit when the server can't be reached, the jobs will tell
+        logger.warning(f'Worker could not connect to the database yet: {e}')
+        return
+    idle_timeout = config.get('pool', {}).get('idle_timeout')
+    interval = min(KEEPALIVE_SECONDS, idle_timeout / 2) if idle_timeout else KEEPALIVE_SECONDS
+    threading.Thread(target=keep_alive, args=(db_config, interval), daemon=True).start()
+
+
+def keep_alive(db_config: str, interval: float):
+    """Uses a pooled connection now and then so the pool doesn't close it as idle"""
+    from dbconnection import DBConnection
+    while True:
+        time.sleep(interval)
+        try:
+            DBConnection(db_config).close()
+        except BaseException as e:
+            logger.warning(f'Keep alive connection failed: {e}')
+
+
+def run_job(month: Tuple[int, int], transaction_types, output, exports, options: dict, db_config: str) -> dict:
+    """Worker entry point, generates the reports of a job. Returns its files and stage timings"""
+    from instrumentation import instrumentation
+    from main import generate_report
+    files = generate_report(get_end_date_of_month(*month), db_config=db_config, output_root=output,
+                            transaction_types=transaction_types, exports=exports, **options)
+    return {'files': {name: str(path) for name, path in files.items()}, 'stages': instrumentation.report()['stages']}
+
+
+class ReportService:
+    """
+    Runs report jobs on a pool of warm worker processes.
+    At most workers jobs run at once and queue_size more wait, further ones are refused with QueueFull.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, db_config='db_config.toml',
+                 output_root='.') -> None:
+        self.db_config = db_config
+        self.output_root = output_root
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(db_config,))
+        # a thread per accepted job hands it to the workers once its month folder is free
+        self.dispatcher = ThreadPoolExecutor(max_workers=workers + queue_size, thread_name_prefix='job')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._folder_locks = {}
+        self.jobs: Dict[int, ReportJob] = {}
+        # start the workers now instead of on the first job
+        for future in [self.executor.submit(time.sleep, 0) for _ in range(workers)]:
+            future.result()
+
+    def submit(self, request: dict):
+        """Queues the job of a request, returns (job, future of its end)"""
+        with self._lock:
+            job = parse_job(next(self._ids), request, self.output_root)
+        folder_key = job.folder_key
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull('Too many report jobs queued, try again later')
+        with self._lock:
+            finished = [job_id for job_id, other in self.jobs.items() if other.status in ('done', 'failed')]
+            for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self.jobs[job_id]
+            self.jobs[job.id] = job
+            folder_lock = self._folder_locks.setdefault(folder_key, threading.Lock())
+        return job, self.dispatcher.submit(self._run, job, folder_lock)
+
+    def _run(self, job: ReportJob, folder_lock: threading.Lock):
+        try:
+            with folder_lock:
+                job.status = 'running'
+                result = self.executor.submit(run_job, job.month, job.transaction_types, job.output, job.exports,
+                                              job.options, self.db_config).result()
+            job.files, job.stages = result['files'], result['stages']
+            job.status = 'done'
+        except BaseException as e:  # SystemExit from DBConnection included
+            job.status, job.error = 'failed', f'{type(e).__name__}: {e}'
+            logger.error(f'Report job {job.id} failed: {job.error}')
+        finally:
+            job.seconds = time.time() - job.submitted
+            self._slots.release()
+        logger.info(f'Report job {job.id} {job.status} in {job.seconds:.2f}s')
+
+    def shutdown(self):
+        self.dispatcher.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    server: 'ReportServer'
+
+    def do_GET(self):
+        if self.path == '/health':
+            return self.reply(HTTPStatus.OK, {'status': 'ok', 'jobs': len(self.server.service.jobs)})
+        prefix = '/reports/'
+        if self.path.startswith(prefix) and self.path[len(prefix):].isdigit():
+            job = self.server.service.jobs.get(int(self.path[len(prefix):]))
+            if job is not None:
+                return self.reply(HTTPStatus.OK, job.to_dict())
+        self.reply(HTTPStatus.NOT_FOUND, {'error': f'No {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/reports':
+            return self.reply(HTTPStatus.NOT_FOUND, {'error': f'No {self.path}'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('A job is a JSON object')
+            job, future = self.server.service.submit(request)
+        except QueueFull as e:
+            return self.reply(HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(e)})
+        except (ValueError, TypeError, ImportError) as e:
+            return self.reply(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+        if not request.get('wait', True):
+            return self.reply(HTTPStatus.ACCEPTED, job.to_dict())
+        future.result()
+        self.reply(HTTPStatus.OK if job.status == 'done' else HTTPStatus.INTERNAL_SERVER_ERROR, job.to_dict())
+
+    def reply(self, status: HTTPStatus, body: dict):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} {format % args}')
+
+
+class ReportServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: ReportService) -> None:
+        super().__init__(address, ReportRequestHandler)
+        self.service = service
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+          db_config='db_config.toml', output_root='.'):
+    service = ReportService(workers, queue_size, db_config, output_root)
+    with ReportServer((host, port), service) as server:
+        logger.info(f'Serving reports on http://{host}:{server.server_address[1]} with {workers} workers')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.shutdown()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve VAT reports to local clients')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='only local clients by default')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='reports generated at once')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='jobs waiting beyond the running ones')
+    parser.add_argument('--db-config', default='db_config.toml')
+    parser.add_argument('--output-root', default='.', help='folder the outputs of the jobs are kept within, '
+                                                           'the working directory by default')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.queue_size, args.db_config, args.output_root)
@@ -0,0 +1,389 @@
+"""
+Writers for the report workbooks and their exports.
+Rows are streamed straight into the sheet xml of the copied format templates,
+so writing a book takes time linear in the new rows and constant memory.
+The same rows can be exported next to the books as csv or Parquet (EXPORT_WRITERS),
+written batch by batch as well. Every writer takes frames with append_frame and
+replaces its file on close, or leaves it as it was on discard.
+"""
+import math
+import os
+from abc import ABC, abstractmethod
+import posixpath
+import re
+import shutil
+import tempfile
+import zipfile
+from decimal import Decimal
+from numbers import Integral, Real
+from pathlib import Path
+from typing import Any, Iterable, Sequence
+from xml.sax.saxutils import escape
+
+import numpy as np
+from pandas import NA
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+MARKER_TAIL = 256  # bytes kept between chunks so a <row ...> or </sheetData> marker split by a chunk is still found
+
+SHEET_RE = re.compile(rb'<sheet\b[^>]*?name=("[^"]*"|\'[^\']*\')[^>]*?r:id="([^"]+)"')
+RELATIONSHIP_RE = re.compile(rb'<Relationship\b[^>]*?Id="([^"]+)"[^>]*?Target="([^"]+)"|<Relationship\b[^>]*?Target="([^"]+)"[^>]*?Id="([^"]+)"')
+DIMENSION_RE = re.compile(rb'<dimension\s+ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"\s*/>')
+SHEET_DATA_END_RE = re.compile(rb'</sheetData>|<sheetData\s*/>')
+
+
+def column_index_from_string(letters: str) -> int:
+    """1 based index of a column letter, 'A' -> 1, 'AA' -> 27 (openpyxl.utils costs a full openpyxl import)"""
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def get_column_letter(index: int) -> str:
+    """Column letter of a 1 based index, 27 -> 'AA'"""
+    letters = ''
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def find_sheet_xml(zf: zipfile.ZipFile, sheet_name: str) -> str:
+    """Returns the path of the xml part holding `sheet_name` inside an xlsx archive"""
+    workbook = zf.read('xl/workbook.xml')
+    rels = zf.read('xl/_rels/workbook.xml.rels')
+    targets = {}
+    for match in RELATIONSHIP_RE.finditer(rels):
+        rel_id, target = (match.group(1), match.group(2)) if match.group(1) else (match.group(4), match.group(3))
+        targets[rel_id] = target.decode()
+    for match in SHEET_RE.finditer(workbook):
+        name = match.group(1)[1:-1].decode()
+        if name == escape(sheet_name, {'"': '&quot;', "'": '&apos;'}):
+            target = targets[match.group(2)]
+            return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+    raise KeyError(f'Sheet {sheet_name} not found')
+
+
+def read_dimension(path: Path, sheet_name: str):
+    """
+    Returns (last column letter, last row) of a sheet from its <dimension> metadata
+    without loading the workbook
+    """
+    with zipfile.ZipFile(path) as zf:
+        with zf.open(find_sheet_xml(zf, sheet_name)) as sheet:
+            head = b''
+            while b'<sheetData' not in head:
+                chunk = sheet.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                head += chunk
+    match = DIMENSION_RE.search(head)
+    if match is None:
+        raise ValueError(f'{path} has no dimension for sheet {sheet_name}')
+    if match.group(3):
+        return match.group(3).decode(), int(match.group(4))
+    return match.group(1).decode(), int(match.group(2))
+
+
+def cell_xml(ref: str, value: Any) -> str:
+    """Returns the <c> element of a value, nothing for blanks"""
+    if value is None or value is NA or value == '':
+        return ''
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, Integral):
+        return f'<c r="{ref}"><v>{int(value)}</v></c>'
+    if isinstance(value, (Real, Decimal)):
+        number = float(value)
+        if not math.isfinite(number):
+            return ''
+        text = str(value) if isinstance(value, Decimal) else repr(number)
+        return f'<c r="{ref}"><v>{text.removesuffix(".0")}</v></c>'
+    text = str(value)
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return f'<c r="{ref}" t="inlineStr"><is><t{space}>{escape(text)}</t></is></c>'
+
+
+class XlsxRowWriter:
+    """
+    Appends rows below the existing content of a sheet in an xlsx workbook.
+    Rows are serialized to a spooled temporary file as they are written and spliced into
+    the sheet xml in a single pass on close, every other part of the workbook is copied as is.
+    """
+
+    def __init__(self, path: Path, sheet_name: str, replace_from: int = None, source: Path = None) -> None:
+        """
+        Rows from replace_from on (e.g. a previous Column_Total row) are replaced by the appended ones.
+        With source the rows are appended to that workbook instead, it replaces path on close.
+        """
+        self.path = Path(path)
+        self.source = Path(source) if source is not None else self.path
+        self.sheet_name = sheet_name
+        self.last_col, self.header_rows = read_dimension(self.source, sheet_name)
+        self.replace_from = replace_from
+        if replace_from is not None:
+            if not 1 < replace_from <= self.header_rows + 1:
+                raise ValueError(f'Row {replace_from} is not within the rows of {self.path.name} [{sheet_name}]')
+            self.header_rows = replace_from - 1
+        self.rows = 0
+        self.max_col = column_index_from_string(self.last_col)
+        self._letters = []
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE * 16, mode='w+b')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    @property
+    def next_row(self) -> int:
+        """1 based row number the next appended row is written to"""
+        return self.header_rows + self.rows + 1
+
+    def _letter(self, index: int) -> str:
+        while len(self._letters) <= index:
+            self._letters.append(get_column_letter(len(self._letters) + 1))
+        return self._letters[index]
+
+    def append(self, values: Sequence[Any]):
+        row = self.next_row
+        cells = ''.join(cell_xml(f'{self._letter(i)}{row}', value) for i, value in enumerate(values))
+        self._buffer.write(f'<row r="{row}">{cells}</row>'.encode())
+        self.max_col = max(self.max_col, len(values))
+        self.rows += 1
+
+    def append_rows(self, rows: Iterable[Sequence[Any]]):
+        for values in rows:
+            self.append(values)
+
+    def append_frame(self, df):
+        self.append_rows(df.itertuples(index=False, name=None))
+
+    def close(self):
+        """Writes the workbook with the appended rows"""
+        if self._buffer.closed:
+            return
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with zipfile.ZipFile(self.source) as zin, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+            sheet_xml = find_sheet_xml(zin, self.sheet_name)
+            for info in zin.infolist():
+                with zin.open(info) as src, zout.open(info, 'w') as dst:
+                    if info.filename == sheet_xml:
+                        self._splice(src, dst)
+                    else:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        self._buffer.close()
+        os.replace(tmp_path, self.path)
+        logger.debug(f'Appended {self.rows} rows to {self.path.name} [{self.sheet_name}]')
+
+    def discard(self):
+        """Drops the appended rows, the workbook is left as is"""
+        self._buffer.close()
+
+    def _splice(self, src, dst):
+        """
+        Copies the sheet xml updating <dimension> and inserting the buffered rows at the end of <sheetData>,
+        in place of the rows from replace_from on
+        """
+        dimension = f'<dimension ref="A1:{get_column_letter(self.max_col)}{max(self.header_rows + self.rows, 1)}" />'.encode()
+        replaced_row = None
+        if self.replace_from is not None:
+            replaced_row = re.compile(rb'<row\s[^>]*?\br="%d"' % self.replace_from)
+        pending = b''
+        dimension_done = False
+        rows_done = False
+        replacing = False
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            pending += chunk
+            if not dimension_done:
+                match = DIMENSION_RE.search(pending)
+                if match:
+                    dst.write(pending[:match.start()] + dimension)
+                    pending = pending[match.end():]
+                    dimension_done = True
+                elif b'<sheetData' in pending:
+                    dimension_done = True  # sheet without dimension, nothing to update
+                else:
+                    continue
+            if not rows_done:
+                if replaced_row is not None and not replacing:
+                    match = replaced_row.search(pending)
+                    if match:
+                        dst.write(pending[:match.start()])
+                        pending = pending[match.start():]
+                        replacing = True
+                match = SHEET_DATA_END_RE.search(pending)
+                if match is None:
+                    # keep enough of the tail to match a marker split across chunks, replaced rows are dropped
+                    if not replacing:
+                        dst.write(pending[:-MARKER_TAIL])
+                    pending = pending[-MARKER_TAIL:]
+                    continue
+                if replaced_row is not None and not replacing:
+                    raise ValueError(f'Row {self.replace_from} not found in sheet {self.sheet_name} of {self.path}')
+                if not replacing:
+                    dst.write(pending[:match.start()])
+                if match.group().startswith(b'<sheetData'):
+                    dst.write(b'<sheetData>')
+                self._buffer.seek(0)
+                shutil.copyfileobj(self._buffer, dst, CHUNK_SIZE)
+                dst.write(b'</sheetData>')
+                pending = pending[match.end():]
+                rows_done = True
+            dst.write(pending)
+            pending = b''
+        dst.write(pending)
+        if not rows_done:
+            raise ValueError(f'No sheetData found for sheet {self.sheet_name} in {self.path}')
+
+
+def export_path(path: Path, export: str) -> Path:
+    """File of an export of the book or annex at path, e.g. sales - Shrawan.csv"""
+    return Path(path).with_suffix(f'.{export}')
+
+
+class ExportWriter(ABC):
+    """
+    Writes frames to a new file next to path, replacing path on close.
+    With append the rows already in path are kept ahead of the new ones.
+    """
+    def __init__(self, path: Path, append: bool = False) -> None:
+        self.path = Path(path)
+        self.append = append and self.path.exists()
+        self.rows = 0
+        self._tmp_path = self.path.with_name(self.path.name + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    @abstractmethod
+    def append_frame(self, df):
+        """Writes the rows of df after the ones written so far"""
+
+    def _close(self):
+        pass
+
+    def close(self):
+        self._close()
+        if self._tmp_path.exists():
+            os.replace(self._tmp_path, self.path)
+            logger.debug(f'{"Appended" if self.append else "Wrote"} {self.rows} rows to {self.path.name}')
+
+    def discard(self):
+        self._close()
+        self._tmp_path.unlink(missing_ok=True)
+
+
+class CsvRowWriter(ExportWriter):
+    """UTF-8 csv with a header row of the column names"""
+
+    def __init__(self, path: Path, append: bool = False) -> None:
+        super().__init__(path, append)
+        if self.append:
+            shutil.copyfile(self.path, self._tmp_path)
+        self._file = open(self._tmp_path, 'a' if self.append else 'w', encoding='utf-8', newline='')
+        self._header = not self.append
+
+    def append_frame(self, df):
+        df.to_csv(self._file, header=self._header, index=False)
+        self._header = False
+        self.rows += len(df)
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetRowWriter(ExportWriter):
+    """
+    Parquet file with a row group per frame, text and categorical columns are stored as strings
+    so every batch has the schema of the first. Needs pyarrow.
+    """
+
+    def __init__(self, path: Path, append: bool = False) -> None:
+        require_pyarrow()
+        super().__init__(path, append)
+        import pyarrow.parquet as pq
+        self._pq = pq
+        self._writer = None
+        if self.append:
+            # the row groups written before are copied one at a time
+            existing = pq.ParquetFile(self.path)
+            self._open(existing.schema_arrow)
+            for index in range(existing.num_row_groups):
+                self._writer.write_table(existing.read_row_group(index))
+            existing.close()
+
+    def _open(self, schema):
+        self._schema = schema
+        self._writer = self._pq.ParquetWriter(self._tmp_path, schema)
+
+    def append_frame(self, df):
+        import pyarrow as pa
+        df = df.astype({column: 'string' for column, dtype in df.dtypes.items()
+                        if dtype == object or str(dtype) == 'category'})
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._open(table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+EXPORT_WRITERS = {'csv': CsvRowWriter, 'parquet': ParquetRowWriter}
+
+
+def require_pyarrow():
+    """Raises ImportError telling how to install pyarrow when it is missing, Parquet can't be written without it"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError('Parquet exports need pyarrow, which is not installed: '
+                          'pip install pyarrow (pinned in requirements.txt) or leave out the parquet export') from None
+
+
+def check_exports(exports: Iterable[str]) -> list:
+    """The export formats given, raises ValueError on unknown ones and ImportError when Parquet can't be written"""
+    exports = list(dict.fromkeys(exports))
+    unknown = set(exports) - set(EXPORT_WRITERS)
+    if unknown:
+        raise ValueError(f'Unknown export formats {sorted(unknown)}, choose from {list(EXPORT_WRITERS)}')
+    if 'parquet' in exports:
+        require_pyarrow()
+    return exports
+
+
+def export_writers(path: Path, exports: Iterable[str], append: bool = False) -> list:
+    """A writer of each export format of the book or annex at path"""
+    return [EXPORT_WRITERS[export](export_path(path, export), append) for export in exports]
+
+
+def remove_exports(path: Path, keep: Iterable[str] = ()):
+    """Removes the exports of the book or annex at path not in keep, they would be stale"""
+    for export in set(EXPORT_WRITERS) - set(keep):
+        stale = export_path(path, export)
+        if stale.exists():
+            logger.debug(f'Removing stale {stale.name}')
+            stale.unlink()
@@ -1,114 +1,313 @@
 """
-This module helps to restore the backup file present in current working directory /backup
-It scans for the recent file and performs restoring of the backup
+This module helps to restore the backup files present in current working directory /backup
+It reads the backup sets of every file (RESTORE HEADERONLY), plans the restore chain of the latest
+full backup with its latest differential and the transaction logs after it, and restores it.
+What was restored is kept in a local state file, so a run with no new backups restores nothing
+and new log backups are applied on top of a database left in standby.
+
+    python restore_db.py [--force] [--standby]
 """
+import argparse
+import datetime
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path, PureWindowsPath
+from typing import Dict, List, Optional
 
 import pyodbc as odbc
-import logging
-from my_logging import log_setup
-import os
 import tomli
 from dotenv import load_dotenv
-from datetime import datetime
+
+from dbconnection import cursor_messages
+from my_logging import log_setup
+import logging
 
 log_setup()  # Initializing logging configurations
 logger = logging.getLogger(__name__)
 
-curr_path = os.path.dirname(os.path.realpath(__file__))
-db_config_file = os.path.join(curr_path, 'config.toml')
-if not os.path.exists(db_config_file):
-    logger.error(f'Config file {db_config_file} does not exist')
-    exit(1)
+curr_path = Path(__file__).resolve().parent
+CONFIG_FILE = curr_path / 'config.toml'
+BACKUP_DIR = curr_path / 'backup'
+STATE_FILE = curr_path / '.cache' / 'restore_state.json'
+MSSQL_DATA_DIR = '/var/opt/mssql/data'
+STATS_PERCENT = 10  # progress message every 10 percent of a restore
+
+FULL, LOG, DIFFERENTIAL = 1, 2, 5  # BackupType of RESTORE HEADERONLY
+BACKUP_TYPE_NAMES = {FULL: 'full', LOG: 'log', DIFFERENTIAL: 'differential'}
+
+
+@dataclass
+class BackupSet:
+    """A backup set of a backup file as listed by RESTORE HEADERONLY"""
+    file: str
+    position: int
+    backup_type: int
+    database_name: str
+    first_lsn: int
+    last_lsn: int
+    checkpoint_lsn: int
+    differential_base_lsn: Optional[int]
+    finish_date: str
+
+    @property
+    def key(self) -> list:
+        return [self.file, self.position, self.last_lsn]
+
+    def __str__(self) -> str:
+        return f'{BACKUP_TYPE_NAMES.get(self.backup_type, self.backup_type)} backup {self.file}:{self.position} ({self.finish_date})'
+
+
+def sql_string(value: str) -> str:
+    """N'' literal of a value, RESTORE takes the file names inline"""
+    return "N'" + str(value).replace("'", "''") + "'"
+
+
+def log_chain(backup_sets: List[BackupSet], after_lsn: int) -> List[BackupSet]:
+    """Log backups restorable in order after a restore ending at after_lsn, up to the first gap"""
+    logs = sorted((backup_set for backup_set in backup_sets if backup_set.backup_type == LOG), key=lambda s: s.first_lsn)
+    chain = []
+    for log in logs:
+        if log.first_lsn <= after_lsn < log.last_lsn:
+            chain.append(log)
+            after_lsn = log.last_lsn
+    return chain
+
+
+def plan_restore(backup_sets: List[BackupSet]) -> List[BackupSet]:
+    """
+    Returns the backup sets to restore in order: the latest full backup, the latest differential
+    based on it and the chain of log backups following them
+    """
+    fulls = [backup_set for backup_set in backup_sets if backup_set.backup_type == FULL]
+    if not fulls:
+        return []
+    full = max(fulls, key=lambda s: s.last_lsn)
+    sets = [backup_set for backup_set in backup_sets if backup_set.database_name == full.database_name]
+    differentials = [backup_set for backup_set in sets if backup_set.backup_type == DIFFERENTIAL
+                     and backup_set.differential_base_lsn == full.checkpoint_lsn]
+    plan = [full] + ([max(differentials, key=lambda s: s.last_lsn)] if differentials else [])
+    return plan + log_chain(sets, plan[-1].last_lsn)
 
-# Set the path to the backup file
-backup_file_path = os.path.join(curr_path, 'backup')
-if not os.path.exists(backup_file_path):
-    logger.error(f"Couldn't find backup directory: {backup_file_path}")
-    exit(1)
 
+class RestoreState:
+    """
+    restore_state.json: the backup sets of every backup file by its size and mtime, so unchanged files
+    are not read again, and the chain restored last per database
+    """
 
-def get_recent_file(directory_path):
-    most_recent_file = None
-    most_recent_time = 0
+    def __init__(self, state_file: Path = STATE_FILE) -> None:
+        self.state_file = Path(state_file)
+        try:
+            data = json.loads(self.state_file.read_text())
+        except FileNotFoundError:
+            data = {}
+        except ValueError as e:
+            logger.warning(f'Ignoring unreadable {self.state_file}: {e}')
+            data = {}
+        self.files: Dict[str, dict] = data.get('files', {})
+        self.databases: Dict[str, dict] = data.get('databases', {})
 
-    # iterate over the files in the directory using os.scandir
-    for entry in os.scandir(directory_path):
-        if entry.is_file():
-            # get the modification time of the file using entry.stat().st_mtime_ns
-            mod_time = entry.stat().st_mtime_ns
-            if mod_time > most_recent_time:
-                # update the most recent file and its modification time
-                most_recent_file = entry.name
-                most_recent_time = mod_time
-    print(
-        f"Found file {most_recent_file} with latest modification time {datetime.fromtimestamp(most_recent_time//1000000000)}")
-    return most_recent_file
+    def backup_sets(self, name: str, stat: os.stat_result) -> Optional[List[BackupSet]]:
+        """Backup sets read before from a file, None if it is new or changed since"""
+        entry = self.files.get(name)
+        if entry is None or (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return [BackupSet(**backup_set) for backup_set in entry['sets']]
 
+    def set_backup_sets(self, name: str, stat: os.stat_result, backup_sets: List[BackupSet]):
+        self.files[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                            'sets': [asdict(backup_set) for backup_set in backup_sets]}
 
-backup_file_name = get_recent_file(backup_file_path)
-logger.info(f"[*] Using file {backup_file_name}")
-backup_file = os.path.join(backup_file_path, backup_file_name)
+    def restored(self, database_name: str) -> dict:
+        return self.databases.get(database_name, {'sets': [], 'standby': False})
 
-curr_os_mssql_files_path = '/var/opt/mssql/data'
+    def set_restored(self, database_name: str, backup_sets: List[BackupSet], standby: bool):
+        self.databases[database_name] = {'sets': [backup_set.key for backup_set in backup_sets], 'standby': standby,
+                                         'restored_at': datetime.datetime.now().isoformat(timespec='seconds')}
 
-logger.debug('Loading database connection configuration...')
+    def save(self):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_file.with_name(self.state_file.name + f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps({'files': self.files, 'databases': self.databases}, indent=1))
+        os.replace(tmp, self.state_file)
 
-with open(db_config_file, 'rb') as config_file:
-    config_data: dict = tomli.load(config_file)
 
-# Set the database connection details
-DRIVER_NAME = config_data['driver']['name']
-SERVER_NAME = config_data['server']['name']
-DATABASE_NAME = config_data['database']['name']
-USERNAME = config_data['user']['name']
-logger.debug('Configurations loaded successfully')
+class RestoreManager:
+    """Restores the backups of backup_dir into database_name, skipping what is already restored"""
 
-load_dotenv()  # Load the environment containing db password
-password = os.getenv('DBpassword')
+    def __init__(self, conn, database_name: str, backup_dir: Path = BACKUP_DIR, data_dir: str = MSSQL_DATA_DIR,
+                 state: RestoreState = None, standby: bool = False) -> None:
+        self.conn = conn
+        self.database_name = database_name
+        self.backup_dir = Path(backup_dir)
+        self.data_dir = data_dir
+        self.state = state or RestoreState()
+        self.standby = standby
 
-# Connect to the database
-try:
+    def execute(self, sql: str):
+        """Runs a statement and returns its result rows as dicts, logging the server messages (STATS progress)"""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql)
+            rows = []
+            while True:
+                for message in cursor_messages(cursor):
+                    logger.info(message)
+                if cursor.description is not None:
+                    columns = [column[0] for column in cursor.description]
+                    rows.extend(dict(zip(columns, row)) for row in cursor.fetchall())
+                if not cursor.nextset():
+                    break
+            return rows
+        finally:
+            cursor.close()
+
+    def read_backup_sets(self, path: Path) -> List[BackupSet]:
+        return [BackupSet(file=path.name, position=int(row['Position']), backup_type=int(row['BackupType']),
+                          database_name=row['DatabaseName'], first_lsn=int(row['FirstLSN']), last_lsn=int(row['LastLSN']),
+                          checkpoint_lsn=int(row['CheckpointLSN']),
+                          differential_base_lsn=None if row['DifferentialBaseLSN'] is None else int(row['DifferentialBaseLSN']),
+                          finish_date=str(row['BackupFinishDate']))
+                for row in self.execute(f'RESTORE HEADERONLY FROM DISK = {sql_string(path)}')]
+
+    def backup_sets(self) -> List[BackupSet]:
+        """Backup sets of every file in backup_dir, only new or changed files are read from the server"""
+        backup_sets = []
+        for entry in sorted(os.scandir(self.backup_dir), key=lambda entry: entry.name):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            file_sets = self.state.backup_sets(entry.name, stat)
+            if file_sets is None:
+                logger.info(f'Reading the backup sets of {entry.name}')
+                try:
+                    file_sets = self.read_backup_sets(Path(entry.path))
+                except odbc.Error as e:
+                    logger.warning(f'Skipping {entry.name}, not a readable backup: {e}')
+                    file_sets = []
+                self.state.set_backup_sets(entry.name, stat, file_sets)
+            backup_sets.extend(file_sets)
+        self.state.files = {name: entry for name, entry in self.state.files.items() if (self.backup_dir / name).exists()}
+        return backup_sets
+
+    def database_state(self) -> Optional[str]:
+        """ONLINE, RESTORING, STANDBY ... of the database on the server, None if it does not exist"""
+        rows = self.execute(f"""
+            SELECT CASE WHEN is_in_standby = 1 THEN 'STANDBY' ELSE state_desc END AS state
+            FROM sys.databases WHERE name = {sql_string(self.database_name)}""")
+        return rows[0]['state'] if rows else None
+
+    def pending(self, plan: List[BackupSet], force=False) -> List[BackupSet]:
+        """The sets of plan still to restore: none when it is restored, the new logs on a database in standby"""
+        database_state = self.database_state()
+        if force or database_state is None:
+            return plan
+        restored = self.state.restored(self.database_name)
+        keys = [backup_set.key for backup_set in plan]
+        if restored['sets'] == keys and database_state in ('ONLINE', 'STANDBY'):
+            return []
+        if restored['standby'] and database_state == 'STANDBY' and restored['sets'] == keys[:len(restored['sets'])] \
+                and all(backup_set.backup_type == LOG for backup_set in plan[len(restored['sets']):]):
+            return plan[len(restored['sets']):]
+        return plan
+
+    def file_moves(self, backup_set: BackupSet) -> str:
+        """MOVE clauses placing every file of a backup into data_dir"""
+        files = self.execute(f'RESTORE FILELISTONLY FROM DISK = {sql_string(self.backup_dir / backup_set.file)} '
+                             f'WITH FILE = {backup_set.position}')
+        return ', '.join(f"MOVE {sql_string(file['LogicalName'])} TO "
+                         f"{sql_string(os.path.join(self.data_dir, PureWindowsPath(file['PhysicalName']).name))}"
+                         for file in files)
+
+    def restore_set(self, backup_set: BackupSet, last: bool):
+        if not last:
+            recovery = 'NORECOVERY'
+        elif self.standby:
+            undo_file = os.path.join(self.data_dir, f'{self.database_name}_undo.bak')
+            recovery = f'STANDBY = {sql_string(undo_file)}'
+        else:
+            recovery = 'RECOVERY'
+        options = [f'FILE = {backup_set.position}', recovery, f'STATS = {STATS_PERCENT}']
+        if backup_set.backup_type == FULL:
+            options[1:1] = ['REPLACE', self.file_moves(backup_set)]
+        kind = 'LOG' if backup_set.backup_type == LOG else 'DATABASE'
+        logger.info(f'Restoring {backup_set}')
+        self.execute(f'RESTORE {kind} [{self.database_name}] FROM DISK = {sql_string(self.backup_dir / backup_set.file)} '
+                     f'WITH {", ".join(options)}')
+
+    def restore(self, force=False) -> List[BackupSet]:
+        """Restores what is missing of the latest restore chain, returns the restored sets"""
+        plan = plan_restore(self.backup_sets())
+        if not plan:
+            self.state.save()
+            raise FileNotFoundError(f'No full backup found in {self.backup_dir}')
+        pending = self.pending(plan, force)
+        if not pending:
+            self.state.save()
+            logger.info(f'{self.database_name} is up to date with {plan[-1]}, nothing to restore')
+            return []
+        if len(pending) < len(plan):
+            logger.info(f'Applying {len(pending)} new log backups on {self.database_name} in standby')
+        for index, backup_set in enumerate(pending):
+            last = index == len(pending) - 1
+            self.restore_set(backup_set, last)
+            # a failure part way leaves the database restoring, the next run starts the chain over
+            self.state.set_restored(self.database_name, plan[:plan.index(backup_set) + 1], self.standby and last)
+            self.state.save()
+        logger.info(f'Database {self.database_name} restored up to {plan[-1]}')
+        return pending
+
+
+def load_config(config_file: Path = CONFIG_FILE) -> dict:
+    with open(config_file, 'rb') as file:
+        config_data: dict = tomli.load(file)
+    load_dotenv()  # Load the environment containing db password
+    config_data['password'] = os.getenv('DBpassword')
+    logger.debug('Configurations loaded successfully')
+    return config_data
+
+
+def connect(config_data: dict):
+    """Connection to the master database, restores can't run in a transaction"""
     logger.debug('Connecting to database...')
     conn = odbc.connect(
-        f'driver={DRIVER_NAME}',
-        host=SERVER_NAME,
+        f"driver={config_data['driver']['name']}",
+        host=config_data['server']['name'],
         database='master',
-        user=USERNAME,
-        password=password
+        user=config_data['user']['name'],
+        password=config_data['password']
     )
     conn.autocommit = True
-
-except Exception as e:
-    logger.error(e)
-    print('---- Error connecting to database ----')
-else:
     logger.info('---- Database connected ! ----')
-    # Restore the backup
-    cursor = conn.cursor()
-    cursor.execute(f"""
-    RESTORE FILELISTONLY FROM DISK = N'{backup_file}'
-    """)
-
-    filelist_dict: dict = {}
-    for row in cursor.fetchall():
-        filelist_dict[row[2]] = {
-            'logical_name': row[0],
-            'physical_name': row[1].split('\\')[-1]
-        }
-
-    cursor.execute(f"""
-        RESTORE DATABASE {DATABASE_NAME} FROM DISK=N'{backup_file}' WITH REPLACE,
-        MOVE '{filelist_dict['D']['logical_name']}' TO '{os.path.join(curr_os_mssql_files_path, filelist_dict['D']['physical_name'])}',
-        MOVE '{filelist_dict['L']['logical_name']}' TO '{os.path.join(curr_os_mssql_files_path, filelist_dict['L']['physical_name'])}'
-        """)
-    while cursor.nextset():
-        logger.info("Restoring database...")
-
-    logger.info('Database backup restored successfully!')
-finally:
+    return conn
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Restore the latest backups of the backup directory')
+    parser.add_argument('--force', action='store_true', help='restore the whole chain even if it is restored already')
+    parser.add_argument('--standby', action='store_true',
+                        help='leave the database read only in standby so later log backups can be applied on top')
+    args = parser.parse_args()
+
+    if not CONFIG_FILE.exists():
+        logger.error(f'Config file {CONFIG_FILE} does not exist')
+        exit(1)
+    if not BACKUP_DIR.exists():
+        logger.error(f"Couldn't find backup directory: {BACKUP_DIR}")
+        exit(1)
+
+    config_data = load_config()
+    try:
+        conn = connect(config_data)
+    except Exception as e:
+        logger.error(e)
+        print('---- Error connecting to database ----')
+        exit(1)
     try:
-        cursor.close()
+        standby = args.standby or config_data.get('restore', {}).get('standby', False)
+        RestoreManager(conn, config_data['database']['name'], standby=standby).restore(args.force)
+    finally:
         conn.close()
         logger.info('Connection closed successfully')
-    except NameError as name_error:
-        logger.error(f'Terminating forcefully with error {name_error}')
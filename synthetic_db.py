@@ -0,0 +1,208 @@
+"""
+Synthetic stand-in for the VatBillingSoftware database.
+Generates the tables touched by the master query and zzz.py into a SQLite file and
+exposes it through SQLiteDBConnection, a DBConnection compatible adapter that
+translates the T-SQL of queries.py, so the pipeline can be measured without SQL Server.
+"""
+import datetime
+import itertools
+import random
+import re
+import sqlite3
+from decimal import Decimal
+from pathlib import Path
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode()))
+sqlite3.register_converter('DECIMAL', lambda value: Decimal(value.decode()))
+
+SCHEMA = """
+    CREATE TABLE SystemTransaction (
+        [Transaction ID] INTEGER PRIMARY KEY,
+        [Transaction Type] INTEGER,
+        [Transaction Date] DATE,
+        [Bill Date] DATE,
+        [Transaction Amount] DECIMAL,
+        [Bill Receiveable Person] TEXT,
+        [Reference No] TEXT,
+        Status TEXT
+    );
+    CREATE INDEX SystemTransactionDate ON SystemTransaction ([Transaction Date]);
+    CREATE TABLE SystemTransactionPurchaseSalesAmount (
+        [Transaction ID] INTEGER PRIMARY KEY,
+        [Account ID] INTEGER,
+        [Grand Total] DECIMAL,
+        [Taxable Amount] DECIMAL,
+        [Tax Amount] DECIMAL
+    );
+    CREATE TABLE SystemTransactionPurchaseSalesItem (
+        [Transaction ID] INTEGER,
+        [Inventory Item Code] TEXT,
+        [Item In] DECIMAL,
+        [Item Out] DECIMAL,
+        [ACCOUNT ID] INTEGER,
+        [VATABLE AMOUNT] DECIMAL,
+        [VAT AMOUNT] DECIMAL
+    );
+    CREATE INDEX SystemTransactionPurchaseSalesItemID ON SystemTransactionPurchaseSalesItem ([Transaction ID]);
+    CREATE TABLE AccountProfileProduct (
+        [ACCOUNT ID] INTEGER PRIMARY KEY,
+        [Vat Pan No] TEXT
+    );
+    CREATE TABLE InventoryItem (
+        [Inventory ID] TEXT PRIMARY KEY,
+        [Inventory Name] TEXT
+    );
+    CREATE TABLE SystemCalenderDate (
+        [English Date] DATE PRIMARY KEY,
+        [Year] INTEGER,
+        [Month] INTEGER,
+        [Day] INTEGER
+    );
+    """
+
+# code: (name, rate per litre incl. VAT)
+INVENTORY_ITEMS = {
+    '01-0001': ('Petrol', Decimal('178.00')),
+    '01-0002': ('Diesel', Decimal('166.00')),
+}
+VAT_RATE = Decimal('0.13')
+CENT = Decimal('0.01')
+
+
+def generate(db_path: Path, bills: int, start_date: datetime.date, end_date: datetime.date, seed: int = 0):
+    """
+    Writes a database with `bills` transactions dated between start_date and end_date.
+    Roughly a quarter are purchases, 15% carry more than one item, one in five accounts has a PAN
+    and a few bills are voided or billed on the previous day.
+    """
+    from bs_ad_date_helpers import get_calendar_index
+
+    rnd = random.Random(seed)
+    db_path = Path(db_path)
+    db_path.unlink(missing_ok=True)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+
+    conn.executemany('INSERT INTO InventoryItem VALUES (?, ?)', [(code, name) for code, (name, _) in INVENTORY_ITEMS.items()])
+
+    # calendar rows of the whole generated range plus a margin for the bill dates
+    days = (end_date - start_date).days + 1
+    ad_dates = [start_date + datetime.timedelta(days=day) for day in range(-1, days)]
+    years, months, bs_days = get_calendar_index().to_bs(ad_dates)
+    conn.executemany('INSERT INTO SystemCalenderDate VALUES (?, ?, ?, ?)',
+                     zip(map(datetime.date.isoformat, ad_dates), years.tolist(), months.tolist(), bs_days.tolist()))
+
+    accounts = max(50, bills // 20)
+    conn.executemany('INSERT INTO AccountProfileProduct VALUES (?, ?)',
+                     [(account, str(300000000 + rnd.randrange(699999999)) if rnd.random() < 0.2 else '')
+                      for account in range(1, accounts + 1)])
+    # a few regular customers account for most of the bills
+    account_ids = range(1, accounts + 1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in account_ids))
+
+    codes = list(INVENTORY_ITEMS)
+    chunk = 50_000
+    for first in range(1, bills + 1, chunk):
+        transactions, amounts, items = [], [], []
+        for transaction_id in range(first, min(first + chunk, bills + 1)):
+            transaction_type = 1 if rnd.random() < 0.25 else 2
+            transaction_date = start_date + datetime.timedelta(days=rnd.randrange(days))
+            bill_date = transaction_date - datetime.timedelta(days=1) if rnd.random() < 0.02 else transaction_date
+            account = rnd.choices(account_ids, cum_weights=cum_weights)[0]
+            item_count = rnd.choices([1, 2, 3], [85, 12, 3])[0]
+            taxable_total = vat_total = Decimal(0)
+            for code in rnd.sample(codes * 2, item_count):
+                litres = Decimal(rnd.randrange(1000, 200000)) / 1000
+                taxable = (litres * INVENTORY_ITEMS[code][1] / (1 + VAT_RATE)).quantize(CENT)
+                vat = (taxable * VAT_RATE).quantize(CENT)
+                taxable_total += taxable
+                vat_total += vat
+                item_in, item_out = (litres, 0) if transaction_type == 1 else (0, litres)
+                items.append((transaction_id, code, item_in, item_out, account, taxable, vat))
+            grand_total = taxable_total + vat_total
+            status = '001-03' if rnd.random() < 0.01 else '001-01'
+            transactions.append((transaction_id, transaction_type, transaction_date.isoformat(), bill_date.isoformat(),
+                                 grand_total, f'Customer {account}', f'INV-{transaction_id:07}', status))
+            amounts.append((transaction_id, account, grand_total, taxable_total, vat_total))
+        conn.executemany('INSERT INTO SystemTransaction VALUES (?, ?, ?, ?, ?, ?, ?, ?)', transactions)
+        conn.executemany('INSERT INTO SystemTransactionPurchaseSalesAmount VALUES (?, ?, ?, ?, ?)', amounts)
+        conn.executemany('INSERT INTO SystemTransactionPurchaseSalesItem VALUES (?, ?, ?, ?, ?, ?, ?)', items)
+    conn.commit()
+    conn.close()
+    logger.info(f'Generated {bills} synthetic bills into {db_path}')
+
+
+def to_sqlite_sql(sql: str) -> str:
+    """Translates the T-SQL used by queries.py to SQLite"""
+    sql = re.sub(r'\[?VatBillingSoftware\]?\.\[?dbo\]?\.', '', sql)
+    sql = re.sub(r'STRING_AGG\(', 'GROUP_CONCAT(', sql, flags=re.IGNORECASE)
+    # CONCAT_WS(sep, a, b, ...) of plain columns
+    sql = re.sub(r"CONCAT_WS\(\s*('[^']*')\s*,([^()]*)\)",
+                 lambda match: '(' + f' || {match.group(1)} || '.join(arg.strip() for arg in match.group(2).split(',')) + ')',
+                 sql, flags=re.IGNORECASE)
+    return sql
+
+
+def to_sqlite_params(params):
+    return [value.isoformat() if isinstance(value, datetime.date) else value for value in params or ()]
+
+
+class SQLiteDBConnection:
+    """DBConnection compatible access to a synthetic database"""
+
+    def __init__(self, db_path, batch_size=5000) -> None:
+        self.db_path = db_path
+        self.BATCH_SIZE = batch_size
+        self._conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._cursor = self._conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def connection(self):
+        return self._conn
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def execute(self, sql, params=None):
+        self.cursor.execute(to_sqlite_sql(sql), to_sqlite_params(params))
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def query(self, sql, params=None):
+        self.execute(sql, params)
+        return self.fetchall()
+
+    def query_batches(self, sql, params=None, batch_size=None):
+        batch_size = batch_size or self.BATCH_SIZE
+        self.execute(sql, params)
+        while True:
+            rows = self.cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+    def query_many(self, queries, max_workers=None) -> list:
+        # sqlite connections are bound to their thread, the queries run one after another
+        return [self.query(sql, params) for sql, params in queries]
@@ -0,0 +1,188 @@
+"""
+Generates the reports of several outlets at once. Every outlet (tenant) listed in tenants.toml has its own
+VatBillingSoftware database (db config file), taxpayer PAN and name for the sheet headers and output folder.
+Each tenant is generated by its own worker process, so all of them take about as long as the slowest one.
+
+    python tenants.py --workers 4
+    python tenants.py --month 2080-04 --only main branch-2
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import tomli
+
+from batch import parse_month
+from bs_ad_date_helpers import get_end_date_of_current_month, get_end_date_of_month
+from filehandlers import Taxpayer
+
+from my_logging import log_setup, show_full_frames
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+TENANTS_FILE = 'tenants.toml'
+
+
+@dataclass(frozen=True)
+class Tenant:
+    name: str
+    taxpayer: Taxpayer
+    output: Path  # reports go to output/sheets/<FY>/<month>
+    db_config: str = 'db_config.toml'
+
+
+@dataclass
+class TenantResult:
+    name: str
+    seconds: float = 0.0
+    files: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def load_tenants(tenants_file=TENANTS_FILE) -> List[Tenant]:
+    with open(tenants_file, 'rb') as file:
+        config_data: dict = tomli.load(file)
+    tenants = [Tenant(entry['name'], Taxpayer(str(entry['pan']), entry['taxpayer']), Path(entry.get('output', entry['name'])),
+                      entry.get('db_config', 'db_config.toml'))
+               for entry in config_data.get('tenants', [])]
+    check_tenants(tenants)
+    return tenants
+
+
+def local_state_files(tenant: Tenant) -> dict:
+    """Local files a tenant writes besides its reports, they must not be shared by different databases"""
+    from dbconnection import DBConnection
+    from panindex import DEFAULT_INDEX_FILE
+    from transactioncache import DEFAULT_CACHE_FILE
+
+    config = DBConnection.get_config(tenant.db_config)
+    files = {}
+    if config.get('cache', {}).get('enabled', False):
+        files['transaction cache'] = Path(config['cache'].get('file', DEFAULT_CACHE_FILE)).resolve()
+    if config.get('pan_index', {}).get('enabled', False):
+        files['PAN index'] = Path(config['pan_index'].get('file', DEFAULT_INDEX_FILE)).resolve()
+    return files
+
+
+def check_tenants(tenants: List[Tenant]):
+    """Raises ValueError when tenants would overwrite each others reports or local state"""
+    problems = []
+    names, outputs, state_files = {}, {}, {}
+    for tenant in tenants:
+        if tenant.name in names:
+            problems.append(f'tenant {tenant.name} is listed twice')
+        names[tenant.name] = tenant
+        output = tenant.output.resolve()
+        if output in outputs:
+            problems.append(f'{outputs[output].name} and {tenant.name} share the output folder {tenant.output}')
+        outputs[output] = tenant
+        for kind, path in local_state_files(tenant).items():
+            other = state_files.get((kind, path))
+            # a cache of the same database can be shared
+            if other is not None and other.db_config != tenant.db_config:
+                problems.append(f'{other.name} and {tenant.name} share the {kind} {path}, set its file in {tenant.db_config}')
+            state_files[(kind, path)] = tenant
+    if problems:
+        raise ValueError('Invalid tenants: ' + '; '.join(problems))
+
+
+def generate_tenant(tenant: Tenant, month: Optional[tuple] = None, **options) -> tuple:
+    """Worker entry point, generates the reports of one tenant. Returns (files, seconds)"""
+    from main import generate_report
+    start = time.perf_counter()
+    end_date = get_end_date_of_month(*month) if month else None
+    files = generate_report(end_date, db_config=tenant.db_config, output_root=tenant.output, taxpayer=tenant.taxpayer, **options)
+    return files, time.perf_counter() - start
+
+
+def generate_tenants(tenants: List[Tenant], month: Optional[tuple] = None, workers=None, **options) -> Dict[str, TenantResult]:
+    """
+    Generates the reports of every tenant on a pool of at most workers processes, options are passed on
+    to main.generate_report. Returns {name: TenantResult}, failures are logged and kept in the results.
+    """
+    # tenants mostly wait on their own database servers, so there can be more of them than CPUs
+    workers = workers or min(len(tenants), (os.cpu_count() or 1) + 4)
+    results = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(generate_tenant, tenant, month, **options): tenant for tenant in tenants}
+        for future in as_completed(futures):
+            tenant = futures[future]
+            try:
+                files, seconds = future.result()
+                results[tenant.name] = TenantResult(tenant.name, seconds, files)
+                logger.info(f'---- Generated reports of {tenant.name} in {seconds:.1f}s ----')
+            except BaseException as e:  # SystemExit from DBConnection included
+                results[tenant.name] = TenantResult(tenant.name, error=f'{type(e).__name__}: {e}')
+                logger.error(f'---- Failed to generate reports of {tenant.name} ----')
+                logger.exception(e)
+    elapsed = time.perf_counter() - start
+    slowest = max((result.seconds for result in results.values()), default=0)
+    failed = sum(not result.ok for result in results.values())
+    logger.info(f'Generated {len(tenants) - failed}/{len(tenants)} tenants in {elapsed:.1f}s with {workers} workers '
+                f'(slowest {slowest:.1f}s)')
+    return {tenant.name: results[tenant.name] for tenant in tenants}
+
+
+def print_results(results: Dict[str, TenantResult]):
+    print(f"{'tenant':<24} {'status':<8} {'seconds':>8}  output")
+    for result in results.values():
+        output = result.error if not result.ok else next(iter(result.files.values()), Path()).parent
+        print(f"{result.name:<24} {'ok' if result.ok else 'FAILED':<8} {result.seconds:>8.1f}  {output}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate the VAT reports of every tenant in parallel')
+    parser.add_argument('--tenants-file', default=TENANTS_FILE)
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='only these tenants')
+    period = parser.add_mutually_exclusive_group()
+    period.add_argument('--month', type=parse_month, help='B.S. month as 2080-04, the previous month by default')
+    period.add_argument('--current-month', action='store_true', help='report the current month so far')
+    parser.add_argument('--workers', type=int, help='worker processes, one per tenant up to the CPU count + 4 by default')
+    parser.add_argument('--annex-only', action='store_true', help='only build transactions_above_1L.xls')
+    parser.add_argument('--append', action='store_true', help='only add the bills entered since the last run')
+    parser.add_argument('--force', action='store_true', help='rewrite the reports even if their records are unchanged')
+    parser.add_argument('--refresh', action='store_true', help='fetch the whole month into the local caches again')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=None,
+                        help='query the databases directly, bypassing the local caches')
+    parser.add_argument('--export', nargs='+', choices=['csv', 'parquet'], metavar='FORMAT',
+                        help='also export the books and the annex as csv and/or parquet')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log whole frames instead of their head and tail')
+    args = parser.parse_args()
+    if args.export:
+        from reportwriters import check_exports
+        try:
+            check_exports(args.export)
+        except ImportError as e:  # before any tenant is fetched
+            parser.error(str(e))
+
+    if args.verbose:
+        show_full_frames()
+
+    tenants = load_tenants(args.tenants_file)
+    if args.only:
+        unknown = set(args.only) - {tenant.name for tenant in tenants}
+        if unknown:
+            parser.error(f'unknown tenants: {", ".join(sorted(unknown))}')
+        tenants = [tenant for tenant in tenants if tenant.name in args.only]
+    month = args.month
+    if args.current_month:
+        end_date = get_end_date_of_current_month()
+        month = (end_date.year, end_date.month)
+
+    results = generate_tenants(tenants, month, args.workers, annex_only=args.annex_only, append=args.append,
+                               force=args.force, exports=args.export, use_cache=args.use_cache, refresh=args.refresh)
+    print_results(results)
+    sys.exit(0 if all(result.ok for result in results.values()) else 1)
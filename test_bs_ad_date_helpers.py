@@ -0,0 +1,80 @@
+import datetime
+from collections import Counter
+
+import numpy as np
+from pyBSDate import convert_AD_to_BS, convert_BS_to_AD
+from pyBSDate.DateMap import DATE_MAP
+
+from bs_ad_date_helpers import BSCalendarIndex, get_end_date_of_month, reporting_period
+
+
+def bs_days():
+    """Every (year, month, day) of the pyBSDate calendar"""
+    return [(int(year), month, day)
+            for year in sorted(DATE_MAP, key=int)
+            for month, length in enumerate(DATE_MAP[year]['daysonmonth'], start=1)
+            for day in range(1, length + 1)]
+
+
+def period_days(period):
+    return np.arange(period.start_date_ad, period.end_date_ad + datetime.timedelta(days=1), dtype='datetime64[D]')
+
+
+def test_index_matches_pyBSDate_day_by_day():
+    index = BSCalendarIndex.build()
+    days = bs_days()
+    keys = [year * 10000 + month * 100 + day for year, month, day in days]
+    in_month = index.days <= np.array([DATE_MAP[str(year)]['daysonmonth'][month - 1]
+                                       for year, month in zip(index.years.tolist(), index.months.tolist())])
+    assert index.bs_keys[in_month].tolist() == keys
+
+    expected = [datetime.date(*convert_BS_to_AD(*day)) for day in days]
+    assert index.to_ad(keys).astype(object).tolist() == expected
+
+    # AD -> BS inverts pyBSDate's BS -> AD wherever a single B.S. day converts to the AD day
+    converted = Counter(expected)
+    unique = [(ad, day) for ad, day in zip(expected, days) if converted[ad] == 1]
+    years, months, month_days = index.to_bs([ad for ad, _ in unique])
+    assert list(zip(years.tolist(), months.tolist(), month_days.tolist())) == [day for _, day in unique]
+
+
+def test_index_matches_pyBSDate_ad_to_bs():
+    index = BSCalendarIndex.build()
+    for ad, bs in [(datetime.date(2025, 5, 14), '2082.01.31'), (datetime.date(2025, 12, 1), '2082.08.15')]:
+        assert index.to_bs_strings([ad])[0] == bs
+        assert '%d.%02d.%02d' % convert_AD_to_BS(ad.year, ad.month, ad.day) == bs
+
+
+def test_days_between_years_continue_the_month_before():
+    index = BSCalendarIndex.build()
+    # pyBSDate's 2092 ends on 2036-04-12 and 2093 starts on 2036-04-14
+    assert index.to_bs_strings([datetime.date(2036, 4, 13)])[0] == '2092.12.31'
+    assert index.to_ad([20921231])[0] == np.datetime64('2036-04-13')
+    # from pyBSDate's 2064 to its last year every AD day has a B.S. day
+    start, end = index.to_ad([20640101, index.bs_keys[-1]])
+    assert None not in index.to_bs_strings(np.arange(start, end + 1)).tolist()
+    assert index.to_bs_strings(np.array(['NaT', index.ad_end + 1], dtype='datetime64[D]')).tolist() == [None, None]
+
+
+def test_bills_of_a_period_fall_in_its_month():
+    index = BSCalendarIndex.build()
+    periods = [reporting_period(get_end_date_of_month(year, month)) for year in range(2075, 2091) for month in range(1, 13)]
+    in_periods = Counter(day for period in periods for day in period_days(period).tolist())
+    for period in periods[:-12]:
+        year, month = period.end_date_np.year, period.end_date_np.month
+        days = period_days(period)
+        assert index.to_bs_strings(days, period=period).tolist() == \
+               [f'{year}.{month:02}.{day:02}' for day in range(1, len(days) + 1)]
+        # without the period only the days the range shares with the next period are days of another month
+        unlabelled = [day for day, bs in zip(days.tolist(), index.to_bs_strings(days).tolist())
+                      if not bs.startswith(f'{year}.{month:02}.')]
+        assert all(in_periods[day] == 2 for day in unlabelled)
+
+    # the last day of Chaitra 2082 is the first of Baisakh 2083 as well
+    chaitra, baisakh = reporting_period(get_end_date_of_month(2082, 12)), reporting_period(get_end_date_of_month(2083, 1))
+    last_day = [datetime.date(2026, 4, 14)]
+    assert index.to_bs_strings(last_day, period=chaitra)[0] == '2082.12.30'
+    assert index.to_bs_strings(last_day, period=baisakh)[0] == '2083.01.01'
+    for year, month in [(2082, 12), (2085, 12)]:
+        period = reporting_period(get_end_date_of_month(year, month))
+        assert index.to_bs_strings([period.end_date_ad], period=period)[0] == f'{year}.12.{period.end_date_np.day:02}'
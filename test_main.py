@@ -0,0 +1,108 @@
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+# main fetches through dbconnection, pyodbc fails to import without the unixODBC library
+pytest.importorskip('pyodbc', exc_type=ImportError)
+
+import openpyxl  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import main  # noqa: E402
+from bs_ad_date_helpers import get_end_date_of_month, get_start_to_end_date_object_in_ad  # noqa: E402
+from dbconnection import DBConnection  # noqa: E402
+from synthetic_db import SQLiteDBConnection, generate  # noqa: E402
+
+REPO = Path(__file__).resolve().parent
+DB_CONFIG = str(REPO / 'db_config.toml')
+END_DATE = get_end_date_of_month(2080, 4)
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A synthetic month the reports are generated from, with the format templates in the working directory"""
+    shutil.copytree(REPO / 'sheets' / 'format', tmp_path / 'sheets' / 'format')
+    annex = tmp_path / 'sheets' / 'format' / 'transactionAbove1L'
+    annex.mkdir()
+    pd.DataFrame([['1', 'x', 'E', 'S', 1, 0], ['2', 'y', 'E', 'P', 2, 0]],
+                 columns=['PAN', 'Name', 'Type', 'Trans', 'Amount', 'Exempt']).to_excel(annex / 'template.xls', index=False)
+    monkeypatch.chdir(tmp_path)
+
+    path = tmp_path / 'synthetic.sqlite'
+    generate(path, 1500, *get_start_to_end_date_object_in_ad(END_DATE), seed=11)
+
+    class SyntheticDBConnection(SQLiteDBConnection):
+        get_config = DBConnection.get_config
+
+        def __init__(self, db_config_filename):
+            super().__init__(path)
+
+    monkeypatch.setattr(main, 'DBConnection', SyntheticDBConnection)
+    return path
+
+
+def generate_report(output_root: Path, **kwargs) -> dict:
+    return main.generate_report(END_DATE, use_cache=False, db_config=DB_CONFIG, output_root=output_root, **kwargs)
+
+
+def book_values(files: dict) -> dict:
+    """Cell values of the books and the rows of the annex"""
+    values = {}
+    for key, file in files.items():
+        if file.suffix == '.xlsx':
+            workbook = openpyxl.load_workbook(file)
+            values[key] = {sheet.title: [[cell.value for cell in row] for row in sheet.iter_rows()] for sheet in workbook}
+        elif file.suffix == '.xls':
+            values[key] = pd.read_excel(file).values.tolist()
+    return values
+
+
+def book_rows(file: Path) -> tuple:
+    """The header rows of a book, its bills sorted by Transaction ID and the Column_Total row it ends with"""
+    header, bills = [], []
+    *rows, total = openpyxl.load_workbook(file).active.iter_rows(values_only=True)
+    for row in rows:
+        (bills if str(row[0]).startswith('2080.') else header).append(row)
+    return header, sorted(bills, key=lambda row: str(row[1])), total
+
+
+def test_parallel_books_match_the_sequential_ones(db_path, tmp_path):
+    sequential = book_values(generate_report(tmp_path / 'sequential', parallel_books=False))
+    parallel = book_values(generate_report(tmp_path / 'parallel', parallel_books=True))
+    assert parallel == sequential
+    assert {'sales', 'purchase', '1L'} <= set(sequential)
+
+
+def test_append_matches_a_forced_rewrite(db_path, tmp_path, monkeypatch):
+    # the bills entered after the first run
+    with sqlite3.connect(db_path) as connection:
+        last_id = connection.execute('SELECT MAX("Transaction ID") FROM SystemTransaction').fetchone()[0]
+        later = connection.execute('SELECT * FROM SystemTransaction WHERE "Transaction ID" > ?', [last_id - 300]).fetchall()
+        connection.execute('DELETE FROM SystemTransaction WHERE "Transaction ID" > ?', [last_id - 300])
+    connection.close()
+    generate_report(tmp_path / 'appended', append=True)
+    with sqlite3.connect(db_path) as connection:
+        connection.executemany(f'INSERT INTO SystemTransaction VALUES ({", ".join("?" * len(later[0]))})', later)
+    connection.close()
+
+    resumed = []
+    resume_books = main.resume_books
+
+    def recorded_resume_books(*args, **kwargs):
+        books = resume_books(*args, **kwargs)
+        resumed.append(books is not None)
+        return books
+
+    monkeypatch.setattr(main, 'resume_books', recorded_resume_books)
+    appended = generate_report(tmp_path / 'appended', append=True)
+    assert resumed == [True]
+
+    rewritten = generate_report(tmp_path / 'rewritten', force=True)
+    # the bills entered later follow the ones written before instead of going in date order
+    for key in ['sales', 'purchase']:
+        header, bills, total = book_rows(appended[key])
+        assert (header, bills, total) == book_rows(rewritten[key])
+        assert total[1] is None and total[7] == pytest.approx(sum(bill[7] for bill in bills if bill[7] is not None))
+    assert book_values(appended)['1L'] == book_values(rewritten)['1L']
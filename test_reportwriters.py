@@ -0,0 +1,86 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from reportwriters import XlsxRowWriter
+
+TEMPLATE = Path(__file__).resolve().parent / 'sheets' / 'format' / 'sales-format.xlsx'
+SHEET = 'Nepali SB'
+
+
+def book_rows(first_id: int, count: int) -> pd.DataFrame:
+    """
+    Rows in the layout of a sales book with the kinds of values build_report_frame leaves in them,
+    amounts are paisa in rupees
+    """
+    ids = np.arange(first_id, first_id + count)
+    return pd.DataFrame({
+        'Date': [f'2080.4.{day % 31 + 1}' for day in ids],
+        'Transaction ID': ids,
+        'Bill Receiveable Person': [' Customer & Sons' if i % 7 == 0 else f'Customer <{i % 5}>' for i in ids],
+        'PAN No': pd.array([None if i % 3 == 0 else 300000000 + i for i in ids], dtype='Int64'),
+        'Item': np.where(ids % 4 == 0, 'Diesel/Petrol', 'Petrol'),
+        'Quantity': ids * 1.125,
+        'unit': 'L',
+        'Total': [float('nan') if i % 11 == 0 else i * 17805 / 100 for i in ids],
+        'blank': '',
+        'Taxable': ids * 15757 / 100,
+        'Tax': ids * 2048 / 100,
+    })
+
+
+def total_row(df: pd.DataFrame) -> pd.DataFrame:
+    """The Column_Total row, sums rounded to the decimals of the rows like the exact totals of TransactionReport"""
+    totals = df.drop(columns='PAN No').select_dtypes('number').sum().round(3)
+    return pd.DataFrame([totals.to_dict()], columns=df.columns, index=['Column_Total'])
+
+
+def write_with_excel_writer(path: Path, df: pd.DataFrame, startrow: int):
+    """How the books were written before XlsxRowWriter, overlaying the rows from the 0 based startrow on"""
+    with pd.ExcelWriter(path, mode='a', engine='openpyxl', if_sheet_exists='overlay') as writer:
+        df.to_excel(writer, index=False, header=False, sheet_name=SHEET, startrow=startrow)
+
+
+def cell_values(path: Path) -> dict:
+    workbook = openpyxl.load_workbook(path)
+    return {sheet.title: [[cell.value for cell in row] for row in sheet.iter_rows()] for sheet in workbook}
+
+
+def test_rows_read_back_like_the_ones_of_excel_writer(tmp_path):
+    df = book_rows(1, 40)
+    rows = pd.concat([df, total_row(df)])
+    written, overlaid = tmp_path / 'written.xlsx', tmp_path / 'overlaid.xlsx'
+    shutil.copyfile(TEMPLATE, written)
+    shutil.copyfile(TEMPLATE, overlaid)
+
+    with XlsxRowWriter(written, SHEET) as writer:
+        writer.append_frame(rows)
+    write_with_excel_writer(overlaid, rows, startrow=len(pd.read_excel(overlaid)) + 1)
+
+    assert cell_values(written) == cell_values(overlaid)
+
+
+def test_resumed_append_replaces_the_total_row_like_excel_writer(tmp_path):
+    first, later = book_rows(1, 25), book_rows(26, 15)
+    written, overlaid = tmp_path / 'written.xlsx', tmp_path / 'overlaid.xlsx'
+    shutil.copyfile(TEMPLATE, written)
+    with XlsxRowWriter(written, SHEET) as writer:
+        writer.append_frame(pd.concat([first, total_row(first)]))
+        total_row_number = writer.next_row - 1
+    shutil.copyfile(written, overlaid)
+
+    # a later run carries on from the book, its rows and totals take the place of the Column_Total row
+    both = pd.concat([first, later])
+    with XlsxRowWriter(written, SHEET, replace_from=total_row_number) as writer:
+        writer.append_frame(pd.concat([later, total_row(both)]))
+    write_with_excel_writer(overlaid, pd.concat([later, total_row(both)]), startrow=total_row_number - 1)
+
+    assert cell_values(written) == cell_values(overlaid)
+    fresh = tmp_path / 'fresh.xlsx'
+    shutil.copyfile(TEMPLATE, fresh)
+    with XlsxRowWriter(fresh, SHEET) as writer:
+        writer.append_frame(pd.concat([both, total_row(both)]))
+    assert cell_values(written) == cell_values(fresh)
@@ -0,0 +1,120 @@
+import re
+from pathlib import Path
+
+import pytest
+
+# restore_db connects with pyodbc, which fails to import without the unixODBC library
+pytest.importorskip('pyodbc', exc_type=ImportError)
+
+from restore_db import (DIFFERENTIAL, FULL, LOG, BackupSet, RestoreManager, RestoreState, log_chain,  # noqa: E402
+                        plan_restore)
+
+DATABASE = 'VatBillingSoftware'
+
+
+def backup_set(backup_type, first_lsn, last_lsn, checkpoint_lsn=None, differential_base_lsn=None, file='backup.bak',
+               position=1, database_name=DATABASE):
+    return BackupSet(file, position, backup_type, database_name, first_lsn, last_lsn,
+                     checkpoint_lsn if checkpoint_lsn is not None else first_lsn, differential_base_lsn, '2024-01-01')
+
+
+def header_row(backup_set: BackupSet) -> dict:
+    """The row RESTORE HEADERONLY lists for a backup set"""
+    return {'Position': backup_set.position, 'BackupType': backup_set.backup_type, 'DatabaseName': backup_set.database_name,
+            'FirstLSN': backup_set.first_lsn, 'LastLSN': backup_set.last_lsn, 'CheckpointLSN': backup_set.checkpoint_lsn,
+            'DifferentialBaseLSN': backup_set.differential_base_lsn, 'BackupFinishDate': backup_set.finish_date}
+
+
+class Cursor:
+    """pyodbc cursor answering RESTORE HEADERONLY from the header rows of each file and the state of sys.databases"""
+
+    def __init__(self, server) -> None:
+        self.server = server
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql: str):
+        if sql.startswith('RESTORE HEADERONLY'):
+            file = Path(re.search(r"DISK = N'(.*)'", sql).group(1)).name
+            self.rows = [header_row(backup_set) for backup_set in self.server.backup_sets if backup_set.file == file]
+            columns = list(header_row(self.server.backup_sets[0]))
+        else:
+            assert 'sys.databases' in sql
+            self.rows = [{'state': self.server.database_state}] if self.server.database_state else []
+            columns = ['state']
+        self.description = [(column,) for column in columns]
+
+    def fetchall(self):
+        return [tuple(row.values()) for row in self.rows]
+
+    def nextset(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class Server:
+    def __init__(self, backup_sets, database_state=None) -> None:
+        self.backup_sets = backup_sets
+        self.database_state = database_state
+
+    def cursor(self):
+        return Cursor(self)
+
+
+def test_log_chain_stops_at_a_broken_LSN_chain():
+    logs = [backup_set(LOG, 100, 200), backup_set(LOG, 200, 300), backup_set(LOG, 350, 400)]
+    assert log_chain(logs, 150) == logs[:2]
+    # logs ending before the restore are skipped, the chain starts with the one containing after_lsn
+    assert log_chain(logs, 250) == [logs[1]]
+    assert log_chain(logs, 300) == []
+
+
+def test_plan_restore_takes_the_latest_full_its_latest_differential_and_the_logs_after():
+    old_full = backup_set(FULL, 50, 110, checkpoint_lsn=100)
+    full = backup_set(FULL, 480, 510, checkpoint_lsn=500)
+    differentials = [backup_set(DIFFERENTIAL, 600, 700, differential_base_lsn=500),
+                     backup_set(DIFFERENTIAL, 600, 800, differential_base_lsn=500),
+                     backup_set(DIFFERENTIAL, 200, 900, differential_base_lsn=100)]
+    logs = [backup_set(LOG, 510, 750), backup_set(LOG, 750, 850), backup_set(LOG, 850, 950),
+            backup_set(LOG, 850, 990, database_name='Other')]
+    assert plan_restore([old_full, full] + differentials + logs) == [full, differentials[1]] + logs[1:3]
+    assert plan_restore(logs + differentials) == []
+
+
+def test_plan_restore_leaves_out_a_differential_without_its_base():
+    full = backup_set(FULL, 880, 910, checkpoint_lsn=900)
+    differential = backup_set(DIFFERENTIAL, 600, 950, differential_base_lsn=500)  # of an earlier full
+    logs = [backup_set(LOG, 900, 1000), backup_set(LOG, 1000, 1100)]
+    assert plan_restore([full, differential] + logs) == [full] + logs
+
+
+def test_pending_sets_of_the_backups_read_with_restore_headeronly(tmp_path):
+    backup_dir = tmp_path / 'backup'
+    backup_dir.mkdir()
+    full = backup_set(FULL, 480, 510, checkpoint_lsn=500, file='full.bak')
+    differential = backup_set(DIFFERENTIAL, 600, 700, differential_base_lsn=500, file='diff.bak')
+    logs = [backup_set(LOG, 510, 650, file='logs.bak'), backup_set(LOG, 650, 850, file='logs.bak', position=2)]
+    for file in ['full.bak', 'diff.bak', 'logs.bak']:
+        (backup_dir / file).write_bytes(b'')
+    server = Server([full, differential] + logs)
+    manager = RestoreManager(server, DATABASE, backup_dir, state=RestoreState(tmp_path / 'restore_state.json'))
+    plan = plan_restore(manager.backup_sets())
+    assert plan == [full, differential, logs[1]]
+
+    # a new database gets the whole chain
+    assert manager.pending(plan) == plan
+    # the full backup and the rest of the chain are restored already
+    server.database_state = 'ONLINE'
+    manager.state.set_restored(DATABASE, plan, standby=False)
+    assert manager.pending(plan) == []
+    assert manager.pending(plan, force=True) == plan
+    # only the new log on a database left in standby
+    server.database_state = 'STANDBY'
+    manager.state.set_restored(DATABASE, plan[:2], standby=True)
+    assert manager.pending(plan) == [logs[1]]
+    # a database restored and recovered can't take more logs, the chain is restored again
+    server.database_state = 'ONLINE'
+    manager.state.set_restored(DATABASE, plan[:2], standby=False)
+    assert manager.pending(plan) == plan
@@ -0,0 +1,83 @@
+import pytest
+from pyBSDate import addate
+
+# zzz fetches through dbconnection, pyodbc fails to import without the unixODBC library
+pytest.importorskip('pyodbc', exc_type=ImportError)
+
+import pandas as pd  # noqa: E402
+
+from bs_ad_date_helpers import get_end_date_of_month, get_start_to_end_date_object_in_ad  # noqa: E402
+from queries import ACCOUNT_PAN_QUERY, SYSTEM_TRANSACTION_QUERY, TRANSACTION_ITEMS_QUERY  # noqa: E402
+from synthetic_db import SQLiteDBConnection, generate  # noqa: E402
+from zzz import extract_transactions, inventroy_item_code  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    start_date, end_date = get_start_to_end_date_object_in_ad(get_end_date_of_month(2080, 4))
+    path = tmp_path_factory.mktemp('zzz') / 'synthetic.sqlite'
+    generate(path, 600, start_date, end_date, seed=5)
+    with SQLiteDBConnection(path) as db:
+        # the first transaction of each type goes without items
+        db.execute('DELETE FROM SystemTransactionPurchaseSalesItem WHERE [Transaction ID] IN '
+                   '(SELECT MIN([Transaction ID]) FROM SystemTransaction GROUP BY [Transaction Type])')
+        db.connection.commit()
+        yield db, [start_date, end_date]
+
+
+def extract_per_transaction(db, rows, lookup) -> list:
+    """The rows zzz.py extracted with two queries per transaction before the bulk fetch"""
+    extracted = []
+    for row in rows:
+        inner_rows = db.query("""
+            SELECT [Inventory Item Code], [Item In], [Item Out], [ACCOUNT ID], [VATABLE AMOUNT], [VAT AMOUNT]
+            FROM VatBillingSoftware.dbo.SystemTransactionPurchaseSalesItem
+            WHERE [Transaction ID] = ?
+            """, [row[0]])
+        if not inner_rows:
+            continue  # the loop failed on inner_rows[0], extract_transactions leaves them out
+        curr_pan_no = db.query("""
+            SELECT [Vat Pan No]
+            FROM VatBillingSoftware.dbo.AccountProfileProduct
+            WHERE [ACCOUNT ID] = ?
+            """, [inner_rows[0][3]])[0][0]
+        if curr_pan_no == "":
+            curr_pan_no = 9999999999
+        bs_date = addate(year=row[2].year, month=row[2].month, day=row[2].day).bsdate.strftime("%Y.%m.%d")
+        if len(inner_rows) > 1:
+            total_litres = amount = vat = 0
+            for inner_row in inner_rows:
+                total_litres += inner_row[lookup]
+                amount += inner_row[4]
+                vat += inner_row[5]
+            extracted.append([bs_date, row[0], '', row[5], curr_pan_no, 'Diesel/Petrol', round(total_litres, 2), 'L',
+                              amount + vat, '', amount, vat])
+            continue
+        amount = inner_rows[0][4]
+        vat = inner_rows[0][5]
+        extracted.append([bs_date, row[0], '', row[5], curr_pan_no, inventroy_item_code[inner_rows[0][0]],
+                          round(inner_rows[0][lookup], 2), 'L', amount + vat, '', amount, vat])
+    return extracted
+
+
+@pytest.mark.parametrize('lookup', [1, 2])
+def test_extract_transactions_matches_the_per_transaction_queries(db, lookup):
+    db, dates = db
+    params = dates + [lookup]
+    rows, item_rows, pan_rows = db.query_many([(SYSTEM_TRANSACTION_QUERY, params), (TRANSACTION_ITEMS_QUERY, params),
+                                               (ACCOUNT_PAN_QUERY, params)])
+    transactions_df = pd.DataFrame.from_records(
+        rows, columns=['Transaction ID', 'Transaction Type', 'Transaction Date', 'Bill Date', 'Transaction Amount',
+                       'Bill Receiveable Person'])
+    items_df = pd.DataFrame.from_records(
+        item_rows, columns=['Transaction ID', 'Inventory Item Code', 'Item In', 'Item Out', 'ACCOUNT ID', 'VATABLE AMOUNT',
+                            'VAT AMOUNT'])
+    extracted, _ = extract_transactions(transactions_df, items_df, {account_id: pan_no for account_id, pan_no in pan_rows},
+                                        lookup)
+
+    expected = extract_per_transaction(db, rows, lookup)
+    assert extracted.values.tolist() == expected
+    # what the synthetic month has to cover
+    assert any(row[5] == 'Diesel/Petrol' for row in expected)
+    assert any(row[4] == 9999999999 for row in expected) and any(row[4] != 9999999999 for row in expected)
+    assert len(expected) < len(rows)
@@ -0,0 +1,152 @@
+"""
+Local cache of the extracted master query rows per B.S. month.
+Rows are kept in a SQLite file together with a watermark (highest Transaction ID and Transaction Date)
+of each month, so later runs only fetch the rows changed since the last sync and
+regenerating a closed month needs no database at all.
+"""
+import datetime
+import sqlite3
+from decimal import Decimal
+from pathlib import Path
+from typing import Sequence
+
+from dbconnection import DBConnection, DEFAULT_BATCH_SIZE
+from masterquery import master_query_batches, query_strategy as config_query_strategy
+from queries import build_voided_transactions_query
+
+from my_logging import log_setup
+import logging
+
+log_setup()  # Initializing logging configurations
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = Path('.cache') / 'transactions.sqlite'
+DEFAULT_REFRESH_DAYS = 3  # trailing days re-fetched on every sync to pick up edited bills
+
+# same columns as the master query, transaction type last
+COLUMNS = ['transaction_date', 'bill_date', 'transaction_id', 'reference_no', 'person', 'pan_no',
+           'item', 'item_in', 'item_out', 'grand_total', 'taxable', 'tax', 'item_taxable', 'item_tax', 'transaction_type']
+
+SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS transactions (
+        month TEXT NOT NULL,
+        {', '.join(COLUMNS)},
+        PRIMARY KEY (month, transaction_type, transaction_id)
+    );
+    CREATE INDEX IF NOT EXISTS transactions_by_date ON transactions (month, transaction_date);
+    CREATE TABLE IF NOT EXISTS watermarks (
+        month TEXT PRIMARY KEY,
+        transaction_types TEXT NOT NULL,
+        transaction_id,
+        transaction_date TEXT,
+        synced_at TEXT NOT NULL,
+        closed INTEGER NOT NULL
+    );
+    """
+
+
+def to_sqlite(value):
+    """Decimals are kept as text to stay exact, dates as ISO dates"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+class TransactionCache:
+
+    def __init__(self, db_config_filename='db_config.toml', cache_file: Path = None, refresh_days: int = None,
+                 query_strategy: str = None) -> None:
+        self.db_config_filename = db_config_filename
+        self.query_strategy = query_strategy or config_query_strategy(DBConnection.get_config(db_config_filename))
+        cache_config = DBConnection.get_config(db_config_filename).get('cache', {})
+        self.batch_size = DBConnection.get_config(db_config_filename).get('query', {}).get('batch_size', DEFAULT_BATCH_SIZE)
+        self.cache_file = Path(cache_file or cache_config.get('file', DEFAULT_CACHE_FILE))
+        self.refresh_days = refresh_days if refresh_days is not None else cache_config.get('refresh_days', DEFAULT_REFRESH_DAYS)
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # concurrent batch processes wait on each others writes instead of failing
+        self.conn = sqlite3.connect(self.cache_file, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def watermark(self, month: str):
+        return self.conn.execute(
+            'SELECT transaction_types, transaction_id, transaction_date, closed FROM watermarks WHERE month = ?',
+            [month]).fetchone()
+
+    def sync(self, month: str, transaction_types: Sequence[int], start_date, end_date, refresh=False, batch_size=None):
+        """
+        Brings the cached rows of a month up to date with the database.
+        A full fetch is done on the first sync (or with refresh), later syncs fetch rows dated within the
+        trailing refresh_days of the watermark or entered after it, and drop voided transactions.
+        Closed months are served from the cache without connecting.
+        """
+        transaction_types = sorted(transaction_types)
+        types_key = ','.join(map(str, transaction_types))
+        watermark = None if refresh else self.watermark(month)
+        if watermark is not None and watermark[0] != types_key:
+            watermark = None  # fetched for other transaction types
+        if watermark is not None and watermark[3]:
+            logger.info(f'Using cached transactions of closed month {month}')
+            return
+
+        with DBConnection(self.db_config_filename) as db, self.conn:
+            if watermark is None or watermark[2] is None:
+                logger.info(f'Fetching all transactions of {month} into the local cache')
+                self.conn.execute('DELETE FROM transactions WHERE month = ?', [month])
+                delta = False
+                params = [*transaction_types, start_date, end_date]
+            else:
+                _, after_id, watermark_date, _ = watermark
+                since = max(start_date, datetime.date.fromisoformat(watermark_date) - datetime.timedelta(days=self.refresh_days))
+                logger.info(f'Fetching transactions of {month} since {since} or after Transaction ID {after_id}')
+                # rows of the trailing window are replaced, so edited or voided bills there are refreshed
+                self.conn.execute('DELETE FROM transactions WHERE month = ? AND transaction_date >= ?', [month, since.isoformat()])
+                voided = db.query(build_voided_transactions_query(transaction_types), [*transaction_types, start_date, end_date])
+                self.conn.executemany('DELETE FROM transactions WHERE month = ? AND transaction_id = ?',
+                                      [(month, row[0]) for row in voided])
+                delta = True
+                params = [*transaction_types, start_date, end_date, since, after_id]
+
+            fetched = 0
+            for rows in master_query_batches(db, transaction_types, params, self.query_strategy, delta=delta,
+                                             batch_size=batch_size):
+                self.conn.executemany(
+                    f'INSERT OR REPLACE INTO transactions (month, {", ".join(COLUMNS)}) VALUES (?, {", ".join("?" * len(COLUMNS))})',
+                    [(month, *map(to_sqlite, row)) for row in rows])
+                fetched += len(rows)
+
+            max_id, max_date = self.conn.execute(
+                'SELECT MAX(transaction_id), MAX(transaction_date) FROM transactions WHERE month = ?', [month]).fetchone()
+            closed = datetime.date.today() > end_date + datetime.timedelta(days=self.refresh_days)
+            self.conn.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?, ?)',
+                              [month, types_key, max_id, max_date, datetime.datetime.now().isoformat(), int(closed)])
+        logger.info(f'Fetched {fetched} rows of {month}, watermark {max_id} / {max_date}{" (closed)" if closed else ""}')
+
+    def query_batches(self, month: str, transaction_types: Sequence[int], batch_size=None, after_transaction_id=None):
+        """
+        Yields the cached rows of a month in the layout and order of the master query,
+        only the ones entered after after_transaction_id if given
+        """
+        after = '' if after_transaction_id is None else 'AND transaction_id > ? '
+        cursor = self.conn.execute(
+            f'SELECT {", ".join(COLUMNS)} FROM transactions WHERE month = ? '
+            f'AND transaction_type IN ({", ".join("?" * len(transaction_types))}) {after}ORDER BY transaction_date, transaction_id',
+            [month, *transaction_types] + ([] if after_transaction_id is None else [after_transaction_id]))
+        while True:
+            rows = cursor.fetchmany(batch_size or self.batch_size)
+            if not rows:
+                break
+            yield rows
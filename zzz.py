@@ -1,169 +1,192 @@
 import os
-from pyBSDate import addate
-from my_logging import log_setup
+from bs_ad_date_helpers import ad_to_bs_strings
+from my_logging import log_frame, log_setup
 import logging
 import pandas as pd
 import shutil
 from pathlib import Path
+from typing import Tuple
 
 from dbconnection import DBConnection
+from queries import SYSTEM_TRANSACTION_QUERY, TRANSACTION_ITEMS_QUERY, ACCOUNT_PAN_QUERY
+from reconciliation import RECONCILIATION_FILE, log_summary, reconcile, write_exceptions
+from reportrows import to_paisa
 
 log_setup()  # Initializing logging configurations
 logger = logging.getLogger(__name__)
 
-curr_path = Path.cwd()
-sheets_format_directory = curr_path.joinpath('sheets', 'format')
-
-logger.debug('Loading database connection configuration...')
-
-print("""### Report Generator ###
+inventroy_item_code = {
+    '01-0001': 'Petrol',
+    '01-0002': 'Diesel'
+}
+
+
+def extract_transactions(transactions_df: pd.DataFrame, items_df: pd.DataFrame, pan_nos: dict,
+                         lookup: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Joins the bulk fetched transactions with their items and account PANs.
+    Returns one row per transaction in the column layout of the format templates
+    and the reconciliation exceptions of the transactions.
+    """
+    # litres are summed from Item In for purchase and Item Out for sales
+    litres_col = 'Item In' if lookup == 1 else 'Item Out'
+    items = items_df.groupby('Transaction ID', sort=False).agg(
+        item_code=('Inventory Item Code', 'first'),
+        item_count=('Inventory Item Code', 'size'),
+        litres=(litres_col, 'sum'),
+        amount=('VATABLE AMOUNT', 'sum'),
+        vat=('VAT AMOUNT', 'sum'),
+        account_id=('ACCOUNT ID', 'first'),
+    )
+    df = transactions_df.join(items, on='Transaction ID', how='inner')
+    if len(df) < len(transactions_df):
+        logger.warning(f'{len(transactions_df) - len(df)} transactions without items skipped')
+
+    total = df['amount'] + df['vat']
+    # Transaction Amount against the item sums, VAT rate, Bill Date and PAN (no header Taxable here)
+    exceptions = reconcile(pd.DataFrame({
+        'Transaction Type': lookup,
+        'Transaction ID': df['Transaction ID'].to_numpy(),
+        'Transaction Date': pd.to_datetime(df['Transaction Date']).to_numpy(),
+        'Bill Date': pd.to_datetime(df['Bill Date']).to_numpy(),
+        'Bill Receiveable Person': df['Bill Receiveable Person'].to_numpy(),
+        'PAN': df['account_id'].map(pan_nos).to_numpy(),
+        'Grand Total': to_paisa(df['Transaction Amount'].tolist()),
+        'Item Taxable': to_paisa(df['amount'].tolist()),
+        'Item VAT': to_paisa(df['vat'].tolist()),
+    }))
+    log_summary(exceptions, len(df))
+
+    pan_no = df['account_id'].map(pan_nos).fillna('')
+    pan_no = pan_no.mask(pan_no == '', 9999999999)
+
+    item = df['item_code'].map(inventroy_item_code).mask(df['item_count'] > 1, 'Diesel/Petrol')
+
+    extracted = pd.DataFrame({
+        0: ad_to_bs_strings(df['Transaction Date'].to_numpy()),
+        1: df['Transaction ID'],
+        2: '',
+        3: df['Bill Receiveable Person'],
+        4: pan_no,
+        5: item,
+        6: df['litres'].apply(round, args=(2,)),
+        7: 'L',
+        8: total,
+        9: '',
+        10: df['amount'],
+        11: df['vat'],
+    })
+    return extracted.reset_index(drop=True), exceptions
+
+
+if __name__ == '__main__':
+
+    curr_path = Path.cwd()
+    sheets_format_directory = curr_path.joinpath('sheets', 'format')
+
+    logger.debug('Loading database connection configuration...')
+
+    print("""### Report Generator ###
 1. Purchase
 2. Sales
 """)
-while True:
-    try:
-        lookup = int(input('Enter 1 or 2: '))
-    except ValueError as ve:
-        print("! Please enter specified values only...")
-    if lookup == 1:
-        file_name = 'purchase'
-        sheet_name = 'Nepali PB'
-        break
-    elif lookup == 2:
-        file_name = 'sales'
-        sheet_name = 'Nepali SB'
-        break
-    else:
-        print("! Invalid input")
-        continue
-
-
-
-
-from bs_ad_date_helpers import get_previous_month_name_np, get_end_date_of_previous_month, get_start_to_end_date_object_in_ad
-
-end_date_of_previous_month = get_end_date_of_previous_month()
-
-previous_month_np = get_previous_month_name_np()
-
-logger.info(
-    f"#### Fetching {file_name} transactions for {end_date_of_previous_month.year} {previous_month_np} ####")
-
-files = {}
-for entry in os.scandir(sheets_format_directory):
-    if entry.is_file():
-        original_name = entry.name
-        if file_name in original_name:
-            book_name = original_name.split(".")[0].split("-")[0]
-            Path().cwd().joinpath('sheets', previous_month_np).mkdir(parents=True, exist_ok=True)
-            dest = curr_path.joinpath('sheets', previous_month_np, book_name + " - " +
-                                previous_month_np + ".xlsx")
-            files[book_name] = dest
-            shutil.copyfile(os.path.join(
-                sheets_format_directory, original_name), dest)
-            
-START_DATE, END_DATE = get_start_to_end_date_object_in_ad(
-    end_date_of_previous_month)
-
-# START_DATE = datetime.datetime(year=2022, month=7, day=17)
-
-# END_DATE = datetime.datetime(year=2023, month=7, day=16)
-
-
-with DBConnection('db_config.toml') as db:
-
-    cursor = db.cursor
-    cursor.execute("""
-        SELECT [Transaction ID], [Transaction Type], [Transaction Date], [Bill Date], [Transaction Amount], [Bill Receiveable Person]
-        FROM VatBillingSoftware.dbo.SystemTransaction
-        WHERE [Transaction Date] >= ? AND [Transaction Date] <= ? AND [Transaction Type] = ?
-        """,
-                    [START_DATE, END_DATE, lookup]
-                    )
-    rows = cursor.fetchall()
-    logger.debug('SystemTransaction fetch complete')
-
-    extracted_data = []
-
-    inventroy_item_code = {
-        '01-0001': 'Petrol',
-        '01-0002': 'Diesel'
-    }
-
-    for row in rows:
-        # print(row[0], row[5], row[2])
-        if row[2] != row[3]:
-            print(row[2], row[3])
-            print(f'{row[0]:-^20}')
-        cursor.execute("""
-            SELECT [Inventory Item Code], [Item In], [Item Out], [ACCOUNT ID], [VATABLE AMOUNT], [VAT AMOUNT]
-            FROM VatBillingSoftware.dbo.SystemTransactionPurchaseSalesItem
-            WHERE [Transaction ID] = ?
-        """,
-                        [row[0]]
-
-                        )
-        inner_rows = cursor.fetchall()
-        curr_pan_no = cursor.execute("""
-        SELECT [Vat Pan No]
-        FROM VatBillingSoftware.dbo.AccountProfileProduct
-        WHERE [ACCOUNT ID] = ?
-        """, inner_rows[0][3]).fetchval()
-        if curr_pan_no == "":
-            curr_pan_no = 9999999999
-        bs_date = addate(year=row[2].year, month=row[2].month,
-                            day=row[2].day).bsdate.strftime("%Y.%m.%d")
-        # formatted_bs_date = bs_date.strftime("%Y.%m.%d")
-        # print(formatted_bs_date)
-
-        if len(inner_rows) > 1:
-            total_litres = 0
-            amount = 0
-            vat = 0
-            for inner_row in inner_rows:
-                total_litres += inner_row[lookup]
-                amount += inner_row[4]
-                vat += inner_row[5]
-            if amount+vat != row[4]:
-                print('[+] Diff:', row[0], amount+vat, row[4], sep=' | ')
-            extracted_data.append((bs_date, row[0], '', row[5], curr_pan_no, 'Diesel/Petrol', round(
-                total_litres, 2), 'L', amount+vat, '', amount, vat))
+    while True:
+        try:
+            lookup = int(input('Enter 1 or 2: '))
+        except ValueError as ve:
+            print("! Please enter specified values only...")
+        if lookup == 1:
+            file_name = 'purchase'
+            sheet_name = 'Nepali PB'
+            break
+        elif lookup == 2:
+            file_name = 'sales'
+            sheet_name = 'Nepali SB'
+            break
+        else:
+            print("! Invalid input")
             continue
-        amount = inner_rows[0][4]
-        vat = inner_rows[0][5]
-        if amount+vat != row[4]:
-            print('[+] Diff:', row[0], amount+vat, row[4], sep=' | ')
-        extracted_data.append((bs_date, row[0], '', row[5], curr_pan_no, inventroy_item_code[inner_rows[0][0]], round(
-            inner_rows[0][lookup], 2), 'L', amount+vat, '', amount, vat))
-    logger.info("---- Extraction complete ! ----")
-    # with open(file_name, 'w') as f:
-    #     f.writelines(
-    #         [f"{data[0]},{data[1]},{data[2]},{data[3]},{data[4]},{data[5]},{data[6]},{data[7]},{data[8]},{data[9]},{data[10]}\n" for data in extracted_data])
-    #     logger.info(f"{file_name} saved successfully")
-    sheet = files[file_name]
-
-    reader = pd.read_excel(sheet)
-    df = pd.DataFrame(extracted_data)
-    print(df)
-    df[4] = df[4].astype(int)
-    df[6] = df[6].astype(float)
-    df[8] = df[8].astype(float)
-    df[10] = df[10].astype(float)
-    df[11] = df[11].astype(float)
-
-    df[4].mask(df[4] == 9999999999, '', inplace=True)
-
-    if lookup == 2:
-        df.drop(df.columns[2], axis=1, inplace=True)
-
-    with pd.ExcelWriter(
-        sheet,
-        mode="a",
-        engine="openpyxl",
-        if_sheet_exists="overlay",
-        # engine_kwargs={'options': {'strings_to_numbers': True}},
-    ) as writer:
-        df.to_excel(writer, index=False, header=False,
-                    sheet_name=sheet_name, startrow=len(reader) + 1)
 
 
+
+
+    from bs_ad_date_helpers import get_previous_month_name_np, get_end_date_of_previous_month, get_start_to_end_date_object_in_ad
+
+    end_date_of_previous_month = get_end_date_of_previous_month()
+
+    previous_month_np = get_previous_month_name_np()
+
+    logger.info(
+        f"#### Fetching {file_name} transactions for {end_date_of_previous_month.year} {previous_month_np} ####")
+
+    files = {}
+    for entry in os.scandir(sheets_format_directory):
+        if entry.is_file():
+            original_name = entry.name
+            if file_name in original_name:
+                book_name = original_name.split(".")[0].split("-")[0]
+                Path().cwd().joinpath('sheets', previous_month_np).mkdir(parents=True, exist_ok=True)
+                dest = curr_path.joinpath('sheets', previous_month_np, book_name + " - " +
+                                    previous_month_np + ".xlsx")
+                files[book_name] = dest
+                shutil.copyfile(os.path.join(
+                    sheets_format_directory, original_name), dest)
+
+    START_DATE, END_DATE = get_start_to_end_date_object_in_ad(
+        end_date_of_previous_month)
+
+    # START_DATE = datetime.datetime(year=2022, month=7, day=17)
+
+    # END_DATE = datetime.datetime(year=2023, month=7, day=16)
+
+
+    with DBConnection('db_config.toml') as db:
+
+        params = [START_DATE, END_DATE, lookup]
+        # one round trip per table for the whole date range instead of two queries per transaction,
+        # the three queries run at once on separate pooled connections
+        rows, item_rows, pan_rows = db.query_many([
+            (SYSTEM_TRANSACTION_QUERY, params),
+            (TRANSACTION_ITEMS_QUERY, params),
+            (ACCOUNT_PAN_QUERY, params),
+        ])
+        pan_nos = {account_id: pan_no for account_id, pan_no in pan_rows}
+        logger.debug('SystemTransaction, SystemTransactionPurchaseSalesItem and AccountProfileProduct fetch complete')
+
+        transactions_df = pd.DataFrame.from_records(
+            rows, columns=['Transaction ID', 'Transaction Type', 'Transaction Date', 'Bill Date', 'Transaction Amount', 'Bill Receiveable Person'])
+        items_df = pd.DataFrame.from_records(
+            item_rows, columns=['Transaction ID', 'Inventory Item Code', 'Item In', 'Item Out', 'ACCOUNT ID', 'VATABLE AMOUNT', 'VAT AMOUNT'])
+
+        df, exceptions = extract_transactions(transactions_df, items_df, pan_nos, lookup)
+        logger.info("---- Extraction complete ! ----")
+        write_exceptions(curr_path.joinpath('sheets', previous_month_np,
+                                            RECONCILIATION_FILE.format(month=f'{file_name} - {previous_month_np}')), exceptions)
+        # with open(file_name, 'w') as f:
+        #     f.writelines(
+        #         [f"{data[0]},{data[1]},{data[2]},{data[3]},{data[4]},{data[5]},{data[6]},{data[7]},{data[8]},{data[9]},{data[10]}\n" for data in extracted_data])
+        #     logger.info(f"{file_name} saved successfully")
+        sheet = files[file_name]
+
+        reader = pd.read_excel(sheet)
+        log_frame(logger, df, f'{file_name} transactions')
+        df[4] = df[4].astype(int)
+        df[6] = df[6].astype(float)
+        df[8] = df[8].astype(float)
+        df[10] = df[10].astype(float)
+        df[11] = df[11].astype(float)
+
+        df[4].mask(df[4] == 9999999999, '', inplace=True)
+
+        if lookup == 2:
+            df.drop(df.columns[2], axis=1, inplace=True)
+
+        with pd.ExcelWriter(
+            sheet,
+            mode="a",
+            engine="openpyxl",
+            if_sheet_exists="overlay",
+            # engine_kwargs={'options': {'strings_to_numbers': True}},
+        ) as writer:
+            df.to_excel(writer, index=False, header=False,
+                        sheet_name=sheet_name, startrow=len(reader) + 1)